@@ -1,4 +1,5 @@
-from models import Badge, Assignment, AssignmentSubmission, Course, User
+from models import Badge, Course, User
+from progress import load_course_records
 
 def check_and_award_badges(student: User, course: Course):
     """
@@ -18,21 +19,13 @@ def _check_course_completion_badge(student: User, course: Course):
     if existing_badge:
         return
 
-    # 2. Get all assignments for the course
-    all_assignments = []
-    for module in course.modules:
-        if module.assignment:
-            all_assignments.append(module.assignment)
-
-    if not all_assignments:
+    # 2. Get all assignments for the course with the student's submissions
+    assignments = load_course_records(student.id, [course])[course.id].assignments
+    if not assignments:
         return # No assignments in this course to complete
 
     # 3. Check if all assignments have a passing grade
-    for assignment in all_assignments:
-        submission = AssignmentSubmission.query.filter_by(
-            student_id=student.id,
-            assignment_id=assignment.id
-        ).first()
+    for assignment, submission in assignments:
         # To pass, submission must exist, have a grade, and the grade must be 'pass' (case-insensitive)
         if not submission or not submission.grade or submission.grade.lower() != 'pass':
             return # Not all assignments are passed yet
@@ -1,12 +1,16 @@
-from flask import Blueprint, render_template, abort, flash, redirect, url_for, request, current_app, jsonify, send_from_directory
+from flask import Blueprint, render_template, abort, flash, redirect, url_for, request, current_app, jsonify
 from flask_login import login_required, current_user
 import os
 
-from models import User, Course, Category, LibraryMaterial, PlatformSetting, Enrollment, CertificateRequest, Certificate, LibraryPurchase, ChatRoom, ChatRoomMember, MutedUser, ReportedMessage, ReportedGroup, AdminLog, GroupRequest, Community, ReportedPost, PremiumSubscriptionRequest
+from models import User, Course, Category, LibraryMaterial, PlatformSetting, Enrollment, CertificateRequest, Certificate, LibraryPurchase, ChatRoom, ChatRoomMember, MutedUser, ReportedMessage, ReportedGroup, AdminLog, GroupRequest, Community, ReportedPost, PremiumSubscriptionRequest, StorageUsage
 from extensions import db
-from pdf_generator import generate_certificate_pdf
+from certificate_renderer import certificate_renderer
 from utils import save_chat_room_cover_image, get_or_create_platform_setting
+from room_acl import room_access
+from storage import quota_for
+from file_delivery import send_protected
 import secrets
+import uuid
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -265,6 +269,7 @@ def manage_chat_members(room_id):
                 db.session.delete(member)
 
         db.session.commit()
+        room_access.invalidate(room_id=room.id)
         flash('Room members updated successfully.', 'success')
         return redirect(url_for('admin.manage_chat_members', room_id=room.id))
 
@@ -335,11 +340,18 @@ def manage_users():
     # We still need this for the count in the sidebar
     pending_instructors = User.query.filter_by(role='instructor', approved=False).all()
 
+    storage_used = dict(db.session.query(StorageUsage.owner_id, StorageUsage.bytes).filter(
+        StorageUsage.owner_type == 'user',
+        StorageUsage.owner_id.in_([user.id for user in users_to_display])
+    )) if users_to_display else {}
+
     return render_template(
         'admin/manage_users.html',
         users_to_display=users_to_display,
         pending_instructors=pending_instructors,
-        current_filter=role_filter
+        current_filter=role_filter,
+        storage_used=storage_used,
+        quota_for=quota_for
     )
 
 @admin_bp.route('/user/<int:user_id>/approve', methods=['POST'])
@@ -350,6 +362,25 @@ def approve_user(user_id):
     flash(f'User {user.name} has been approved.', 'success')
     return redirect(url_for('admin.manage_users'))
 
+@admin_bp.route('/user/<int:user_id>/storage-quota', methods=['POST'])
+def set_storage_quota(user_id):
+    user = User.query.get_or_404(user_id)
+    quota_mb = request.form.get('quota_mb', '').strip()
+    if not quota_mb:
+        user.storage_quota = None
+    else:
+        try:
+            user.storage_quota = int(float(quota_mb) * 1024 * 1024)
+        except ValueError:
+            flash('Quota must be a number of megabytes.', 'danger')
+            return redirect(url_for('admin.manage_users'))
+        if user.storage_quota < 0:
+            flash('Quota cannot be negative.', 'danger')
+            return redirect(url_for('admin.manage_users'))
+    db.session.commit()
+    flash(f'Storage quota for {user.name} updated.', 'success')
+    return redirect(url_for('admin.manage_users'))
+
 @admin_bp.route('/user/<int:user_id>/toggle-ban', methods=['POST'])
 def toggle_ban(user_id):
     user = User.query.get_or_404(user_id)
@@ -674,6 +705,7 @@ def approve_payment(enrollment_id):
     enrollment = Enrollment.query.get_or_404(enrollment_id)
     enrollment.status = 'approved'
     db.session.commit()
+    room_access.invalidate(user_id=enrollment.user_id)
     flash(f'Payment for {enrollment.student.name} for course "{enrollment.course.title}" has been approved.', 'success')
     return redirect(url_for('admin.pending_payments'))
 
@@ -697,8 +729,7 @@ def payment_proof(filename):
     if filename.startswith('payment_proofs/'):
         filename = filename.split('/')[-1]
 
-    proofs_dir = os.path.join(current_app.root_path, 'static', 'payment_proofs')
-    return send_from_directory(proofs_dir, filename)
+    return send_protected(f'payment_proofs/{filename}', as_attachment=False)
 
 @admin_bp.route('/library/<int:material_id>/delete', methods=['POST'])
 def delete_library_material(material_id):
@@ -713,32 +744,61 @@ def manage_certificate_requests():
     pending_requests = CertificateRequest.query.filter_by(status='pending').order_by(CertificateRequest.requested_at).all()
     approved_requests = CertificateRequest.query.filter_by(status='approved').order_by(CertificateRequest.reviewed_at.desc()).limit(20).all()
     rejected_requests = CertificateRequest.query.filter_by(status='rejected').order_by(CertificateRequest.reviewed_at.desc()).limit(20).all()
+
+    # Render status of the approved requests' certificates, in one query
+    certificates_by_request = {}
+    if approved_requests:
+        for certificate in Certificate.query.filter(
+            Certificate.user_id.in_({req.user_id for req in approved_requests}),
+            Certificate.course_id.in_({req.course_id for req in approved_requests})
+        ).order_by(Certificate.id):
+            certificates_by_request[(certificate.user_id, certificate.course_id)] = certificate
     return render_template('admin/manage_certificate_requests.html',
                            pending_requests=pending_requests,
                            approved_requests=approved_requests,
-                           rejected_requests=rejected_requests)
+                           rejected_requests=rejected_requests,
+                           certificates_by_request=certificates_by_request)
+
+def _approve_certificate_requests(requests):
+    """Approves pending requests and queues their certificates for rendering. Returns the approved requests."""
+    approved = [req for req in requests if req.status == 'pending']
+    certificates = []
+    for req in approved:
+        req.status = 'approved'
+        req.reviewed_at = datetime.utcnow()
+        certificates.append(Certificate(
+            user_id=req.user_id,
+            course_id=req.course_id,
+            certificate_uid=str(uuid.uuid4()),
+            issued_at=datetime.utcnow(),
+            file_path='', # Set once the PDF has been rendered
+            status='queued'
+        ))
+    db.session.add_all(certificates)
+    db.session.commit()
+    certificate_renderer.enqueue([certificate.id for certificate in certificates])
+    return approved
 
 @admin_bp.route('/certificate-request/<int:request_id>/approve', methods=['POST'])
 def approve_certificate_request(request_id):
     req = CertificateRequest.query.get_or_404(request_id)
-    req.status = 'approved'
-    req.reviewed_at = datetime.utcnow()
-
-    import uuid
-    new_certificate = Certificate(
-        user_id=req.user_id,
-        course_id=req.course_id,
-        certificate_uid=str(uuid.uuid4()),
-        issued_at=datetime.utcnow(),
-        file_path='' # Initialize with empty string to satisfy NOT NULL constraint
-    )
+    if not _approve_certificate_requests([req]):
+        flash('This certificate request has already been reviewed.', 'warning')
+        return redirect(url_for('admin.manage_certificate_requests'))
+    flash(f'Certificate request for {req.user.name} has been approved and the certificate is being generated.', 'success')
+    return redirect(url_for('admin.manage_certificate_requests'))
 
-    # Generate the PDF and update the certificate's file_path
-    new_certificate = generate_certificate_pdf(new_certificate, req.user, req.course, current_app)
+@admin_bp.route('/certificate-requests/approve', methods=['POST'])
+def bulk_approve_certificate_requests():
+    request_ids = request.form.getlist('request_ids', type=int)
+    if not request_ids:
+        flash('Select at least one certificate request to approve.', 'warning')
+        return redirect(url_for('admin.manage_certificate_requests'))
 
-    db.session.add(new_certificate)
-    db.session.commit()
-    flash(f'Certificate request for {req.user.name} has been approved and the certificate has been generated.', 'success')
+    approved = _approve_certificate_requests(
+        CertificateRequest.query.filter(CertificateRequest.id.in_(request_ids)).all()
+    )
+    flash(f'Approved {len(approved)} certificate requests. Their certificates are being generated.', 'success')
     return redirect(url_for('admin.manage_certificate_requests'))
 
 @admin_bp.route('/certificate-request/<int:request_id>/reject', methods=['POST'])
@@ -756,6 +816,11 @@ def reject_certificate_request(request_id):
     flash(f'Certificate request for {req.user.name} has been rejected.', 'success')
     return redirect(url_for('admin.manage_certificate_requests'))
 
+@admin_bp.route('/api/room_acl_stats')
+def room_acl_stats():
+    """Hit/miss counters of this worker's room authorization cache."""
+    return jsonify(room_access.stats())
+
 @admin_bp.route('/chat/room/<int:room_id>/mute', methods=['POST'])
 @login_required
 def mute_user_in_room(room_id):
@@ -785,6 +850,7 @@ def mute_user_in_room(room_id):
     )
     db.session.add(new_mute)
     db.session.commit()
+    room_access.invalidate(user_id=int(user_id_to_mute), room_id=room_id)
 
     return jsonify({'status': 'User muted successfully'}), 200
 
@@ -808,6 +874,7 @@ def unmute_user_in_room(room_id):
     if mute:
         db.session.delete(mute)
         db.session.commit()
+        room_access.invalidate(user_id=int(user_id_to_unmute), room_id=room_id)
         return jsonify({'status': 'User unmuted successfully'}), 200
 
     return jsonify({'status': 'User was not muted'}), 200
@@ -1,5 +1,5 @@
 from flask import Flask
-from extensions import db, login_manager, socketio
+from extensions import db, login_manager, socketio, presence
 from models import *
 import os
 import click
@@ -9,9 +9,28 @@ from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
 from markupsafe import Markup
 from flask_migrate import Migrate
-from push_notifications import initialize_firebase
+from push_notifications import initialize_firebase, notification_dispatcher, FakeTransport
 from apscheduler.schedulers.background import BackgroundScheduler
-from tasks import publish_scheduled_posts, snapshot_community_analytics
+from tasks import publish_scheduled_posts, snapshot_community_analytics, reap_expired_content, archive_old_messages
+from room_acl import room_access
+from progress import progress_cache
+from grading import answer_keys, regrade_exam, regrade_quiz
+from certificate_renderer import certificate_renderer
+from image_pipeline import image_pipeline, image_url, image_srcset, is_image_path, UPLOAD_IMAGE_FOLDERS
+from search_index import search_index, SEARCHABLE
+from timeline import rebuild_timeline
+from engagement import reconcile_counters, COUNTED
+from blob_store import rehome_uploads, collect_garbage
+from storage import reconcile_storage
+from chunked_uploads import clean_stale_uploads
+from file_delivery import download_counter
+from link_previews import link_previewer
+from status_tray import status_tray
+from polls import reconcile_poll_counts, poll_updates
+from socket_limits import socket_limiter
+from typing_indicators import typing_tracker
+from expiry import reap_expired, summarize
+from chat_archive import archive_chat_history
 import atexit
 import humanize
 
@@ -50,7 +69,15 @@ def create_app(config_object=None):
             SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///' + os.path.join(app.instance_path, 'app.db'),
             SQLALCHEMY_TRACK_MODIFICATIONS = False,
             SECRET_KEY = 'dev', # Change for production
-            MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
+            MAX_CONTENT_LENGTH = 50 * 1024 * 1024,  # 50 MB
+            # Use 'sqlite' (or a shared PRESENCE_DB_PATH) plus a message queue when running several Socket.IO workers
+            PRESENCE_BACKEND = os.environ.get('PRESENCE_BACKEND', 'memory'),
+            PRESENCE_DB_PATH = os.environ.get('PRESENCE_DB_PATH'),
+            SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+            # 'x-accel' (nginx) or 'x-sendfile' once the front-end server is set up to send protected files
+            FILE_DELIVERY = os.environ.get('FILE_DELIVERY', 'direct'),
+            # Rooms without their own retention_days archive messages older than this; unset keeps everything
+            CHAT_RETENTION_DAYS = int(os.environ['CHAT_RETENTION_DAYS']) if os.environ.get('CHAT_RETENTION_DAYS') else None
         )
 
     # Ensure the instance folder exists
@@ -62,8 +89,17 @@ def create_app(config_object=None):
     # Initialize extensions
     db.init_app(app)
     login_manager.init_app(app)
-    socketio.init_app(app)
-    migrate = Migrate(app, db)
+    socketio.init_app(app, message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+    presence.init_app(app)
+    room_access.init_app(app)
+    progress_cache.init_app(app)
+    status_tray.init_app(app)
+    poll_updates.init_app(app)
+    socket_limiter.init_app(app)
+    typing_tracker.init_app(app)
+    answer_keys.init_app(app)
+    search_index.init_app(app)
+    migrate = Migrate(app, db, include_object=search_index.include_object)
     login_manager.login_view = 'main.login'
 
     @login_manager.user_loader
@@ -92,6 +128,9 @@ def create_app(config_object=None):
     from glooba_routes import glooba_bp
     app.register_blueprint(glooba_bp)
 
+    from upload_routes import uploads_bp
+    app.register_blueprint(uploads_bp)
+
     # Register chat events
     from chat_events import register_chat_events
     register_chat_events(socketio)
@@ -99,10 +138,17 @@ def create_app(config_object=None):
     # Register custom Jinja filters
     app.jinja_env.filters['secure_embeds'] = secure_embeds_filter
     app.jinja_env.filters['naturaltime'] = humanize.naturaltime
+    app.jinja_env.globals['image_url'] = image_url
+    app.jinja_env.globals['image_srcset'] = image_srcset
 
-    # Initialize Firebase Admin SDK
+    # Initialize Firebase Admin SDK and the background notification dispatcher
     with app.app_context():
         initialize_firebase()
+    notification_dispatcher.init_app(app)
+    certificate_renderer.init_app(app)
+    image_pipeline.init_app(app)
+    download_counter.init_app(app)
+    link_previewer.init_app(app)
 
     @app.context_processor
     def inject_notifications():
@@ -138,16 +184,168 @@ def create_app(config_object=None):
         db.create_all()
         print("Database reset.")
 
-    @app.cli.command("clean-chat-history")
-    @click.option("--days", default=30, type=int, help="Delete messages older than this many days.")
-    def clean_chat_history(days):
-        """Deletes old chat messages from the database."""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
+    @app.cli.command("archive-chat-history")
+    @click.option("--days", type=int, help="Archive messages older than this many days in rooms without their own policy.")
+    @click.option("--room-id", "room_ids", multiple=True, type=int, help="Only archive this room (repeatable).")
+    @click.option("--batch-size", default=500, type=int, help="Messages moved per transaction.")
+    def archive_chat_history_command(days, room_ids, batch_size):
+        """Moves chat messages past their room's retention period into the compressed archive."""
+        if days is not None:
+            app.config['CHAT_RETENTION_DAYS'] = days
+        report = archive_chat_history(batch_size=batch_size, room_ids=room_ids)
+        print(f"Archived {sum(report.values())} messages from {len(report)} rooms.")
+
+    @app.cli.command("rebuild-search-index")
+    @click.option("--kind", "kinds", multiple=True, type=click.Choice(sorted(SEARCHABLE)), help="Only rebuild this index (repeatable).")
+    def rebuild_search_index(kinds):
+        """Rebuilds the full-text search index from the existing tables."""
+        rebuilt = search_index.rebuild(kinds)
+        print(f"Rebuilt {search_index.backend.name} search index for: {', '.join(rebuilt)}.")
+
+    @app.cli.command("rebuild-timelines")
+    @click.option("--user-id", type=int, help="Only rebuild this user's timeline.")
+    def rebuild_timelines(user_id):
+        """Rebuilds home feed timelines from the follow graph (e.g. after the first deploy)."""
+        user_ids = [user_id] if user_id else [uid for (uid,) in db.session.query(User.id)]
+        for uid in user_ids:
+            rebuild_timeline(uid)
+            db.session.commit()
+        print(f"Rebuilt {len(user_ids)} timelines.")
+
+    @app.cli.command("reconcile-engagement-counters")
+    @click.option("--kind", "kinds", multiple=True, type=click.Choice(sorted(COUNTED)), help="Only reconcile this content type (repeatable).")
+    def reconcile_engagement_counters(kinds):
+        """Recomputes stored like, comment and share counts and fixes any that drifted."""
+        corrected = reconcile_counters(kinds)
+        db.session.commit()
+        for kind, count in corrected.items():
+            print(f"{kind}: corrected {count} counters.")
 
-        num_deleted = db.session.query(ChatMessage).filter(ChatMessage.timestamp < cutoff_date).delete()
+    @app.cli.command("reconcile-poll-counts")
+    def reconcile_poll_vote_counts():
+        """Recomputes stored poll option vote counts and fixes any that drifted."""
+        corrected = reconcile_poll_counts()
+        db.session.commit()
+        print(f"Corrected {corrected} poll option counts.")
+
+    @app.cli.command("reap-expired")
+    @click.option("--batch-size", default=500, type=int, help="Rows deleted per transaction.")
+    @click.option("--max-batches", type=int, help="Stop after this many batches of each kind.")
+    def reap_expired_command(batch_size, max_batches):
+        """Deletes expired statuses and stories with their views, polls, link previews and media."""
+        report = reap_expired(batch_size=batch_size, max_batches=max_batches)
+        print(summarize(report))
+
+    @app.cli.command("migrate-uploads")
+    def migrate_uploads():
+        """Moves existing uploads from the flat upload folders into the content-addressed blob store."""
+        moved = rehome_uploads()
+        print(f"Moved {len(moved)} files into {len(set(moved.values()))} blobs.")
+
+    @app.cli.command("collect-blobs")
+    @click.option("--grace-hours", default=24, type=int, help="Keep unreferenced blobs stored within this many hours.")
+    def collect_blobs(grace_hours):
+        """Reconciles blob reference counts and deletes blobs nothing uses any more."""
+        deleted = collect_garbage(timedelta(hours=grace_hours))
+        print(f"Deleted {deleted} unreferenced blobs.")
+
+    @app.cli.command("clean-uploads")
+    @click.option("--hours", default=24, type=int, help="Delete upload sessions untouched for this many hours.")
+    def clean_uploads(hours):
+        """Deletes abandoned resumable uploads and their partial files."""
+        deleted = clean_stale_uploads(timedelta(hours=hours))
+        print(f"Deleted {deleted} abandoned uploads.")
+
+    @app.cli.command("reconcile-storage")
+    def reconcile_storage_totals():
+        """Recomputes per-room and per-user storage totals from messages, posts and blob sizes."""
+        corrected = reconcile_storage()
+        db.session.commit()
+        print(f"Corrected {corrected} storage totals.")
+
+    @app.cli.command("regrade")
+    @click.option("--exam-id", type=int, help="Final exam whose submissions are re-scored.")
+    @click.option("--quiz-id", type=int, help="Quiz whose submissions are re-scored.")
+    def regrade(exam_id, quiz_id):
+        """Re-scores every submission of an exam or quiz after its answer key changed."""
+        if exam_id:
+            exam = db.session.get(FinalExam, exam_id)
+            if not exam:
+                print(f"Error: Exam {exam_id} does not exist.")
+                return
+            count = regrade_exam(exam)
+            course_id = exam.course_id
+        elif quiz_id:
+            quiz = db.session.get(Quiz, quiz_id)
+            if not quiz:
+                print(f"Error: Quiz {quiz_id} does not exist.")
+                return
+            count = regrade_quiz(quiz)
+            course_id = quiz.module.course_id
+        else:
+            print("Error: Pass --exam-id or --quiz-id.")
+            return
         db.session.commit()
+        progress_cache.invalidate(course_id=course_id)
+        print(f"Regraded {count} submissions.")
+
+    @app.cli.command("render-certificates")
+    @click.option("--failed", is_flag=True, help="Also retry certificates whose rendering failed.")
+    def render_certificates(failed):
+        """Renders certificates left queued or half-rendered, e.g. by a restart."""
+        statuses = ['queued', 'rendering'] + (['failed'] if failed else [])
+        certificate_ids = [cid for (cid,) in db.session.query(Certificate.id).filter(Certificate.status.in_(statuses))]
+        certificate_renderer.enqueue(certificate_ids)
+        certificate_renderer.join()
+        ready = Certificate.query.filter(Certificate.id.in_(certificate_ids), Certificate.status == 'ready').count() if certificate_ids else 0
+        print(f"Rendered {ready} of {len(certificate_ids)} certificates.")
+
+    @app.cli.command("process-images")
+    @click.option("--folder", "folders", multiple=True, help="Only scan this folder of the static directory (repeatable).")
+    @click.option("--failed", is_flag=True, help="Also retry images whose processing failed.")
+    def process_images(folders, failed):
+        """Builds image variants for uploads that have none yet, e.g. ones made before the pipeline existed."""
+        folders = folders or UPLOAD_IMAGE_FOLDERS
+        statuses = ['ready'] if failed else ['ready', 'failed']
+        done = {path for (path,) in db.session.query(ImageAsset.path).filter(ImageAsset.status.in_(statuses))}
+        queued = 0
+        for folder in folders:
+            for root, dirs, files in os.walk(os.path.join(app.static_folder, folder)):
+                dirs[:] = [d for d in dirs if d != 'variants']
+                for filename in files:
+                    path = os.path.relpath(os.path.join(root, filename), app.static_folder).replace(os.sep, '/')
+                    if path not in done and is_image_path(path):
+                        image_pipeline.enqueue(path)
+                        queued += 1
+        image_pipeline.join()
+        db.session.commit()
+        print(f"Processed {queued} images.")
+
+    @app.cli.command("push-load-test")
+    @click.option("--room-id", required=True, type=int, help="Room whose members receive the notifications.")
+    @click.option("--messages", default=100, type=int, help="Number of chat messages to simulate.")
+    @click.option("--latency", default=0.05, type=float, help="Simulated Firebase round trip in seconds.")
+    def push_load_test(room_id, messages, latency):
+        """Fans out notifications through a fake transport to measure dispatcher throughput."""
+        room = ChatRoom.query.get(room_id)
+        if not room:
+            print(f"Error: Room {room_id} does not exist.")
+            return
+
+        transport = FakeTransport(latency=latency)
+        previous_transport = notification_dispatcher.transport
+        notification_dispatcher.transport = transport
+        try:
+            start = datetime.utcnow()
+            for i in range(messages):
+                notification_dispatcher.notify_room(room.id, room.created_by_id, "Load test", f"Message {i}")
+            notification_dispatcher.join()
+            elapsed = (datetime.utcnow() - start).total_seconds()
+        finally:
+            notification_dispatcher.transport = previous_transport
 
-        print(f"Deleted {num_deleted} messages older than {days} days.")
+        tokens_sent = sum(len(batch['tokens']) for batch in transport.sent)
+        print(f"Sent {len(transport.sent)} multicasts ({tokens_sent} tokens) in {elapsed:.2f}s; dropped {notification_dispatcher.dropped}.")
 
     @app.cli.command("create-admin")
     @click.option("--name", required=True, help="The name of the admin user.")
@@ -292,6 +490,8 @@ def create_app(config_object=None):
         scheduler = BackgroundScheduler(daemon=True)
         scheduler.add_job(func=publish_scheduled_posts, args=[app], trigger='interval', minutes=1)
         scheduler.add_job(func=snapshot_community_analytics, args=[app], trigger='cron', hour=0) # Run daily at midnight
+        scheduler.add_job(func=reap_expired_content, args=[app], trigger='interval', minutes=15)
+        scheduler.add_job(func=archive_old_messages, args=[app], trigger='cron', hour=3) # Nightly, when rooms are quiet
         scheduler.start()
 
         # Shut down the scheduler when exiting the app
@@ -0,0 +1,86 @@
+import queue
+import threading
+from extensions import db
+
+class WorkerPool:
+    """
+    A queue of jobs served by a pool of daemon threads, each job handled in its own app context.
+
+    Subclasses implement `process(job)` and call `init_app(app, num_workers)` from their own
+    `init_app`; `submit` starts the threads on first use. A job that raises is logged and its
+    session rolled back, and the session is removed after every job. `job_done(job)` runs after
+    each job however it ended. Re-initializing (e.g. one app per test) retires the threads bound
+    to the previous app.
+    """
+
+    # Prefix of the worker threads' names
+    name = 'worker'
+
+    def __init__(self, app=None):
+        self.app = None
+        self.num_workers = 0
+        self.queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, num_workers=1, queue_size=0):
+        self.shutdown()
+        with self._lock:
+            self.app = app
+            self.num_workers = num_workers
+            self.queue = queue.Queue(maxsize=queue_size)
+
+    def process(self, job):
+        raise NotImplementedError
+
+    def job_done(self, job):
+        pass
+
+    def submit(self, job, block=True):
+        """Queues a job. With block=False a full queue raises queue.Full instead of waiting."""
+        self._start_workers()
+        self.queue.put(job, block=block)
+
+    def join(self):
+        """Blocks until every queued job has been processed or has failed."""
+        if self.queue is not None:
+            self.queue.join()
+
+    def shutdown(self):
+        """Lets queued jobs finish, then stops the worker threads."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _start_workers(self):
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._work, args=(self.queue,), name=f'{self.name}-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self, job_queue):
+        while True:
+            job = job_queue.get()
+            try:
+                if job is None:
+                    return
+                with self.app.app_context():
+                    try:
+                        self.process(job)
+                    except Exception as e:
+                        print(f"Error in {self.name} processing {job!r}: {e}")
+                        db.session.rollback()
+                    finally:
+                        db.session.remove()
+            finally:
+                if job is not None:
+                    self.job_done(job)
+                job_queue.task_done()
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event, inspect, update
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from image_pipeline import strip_metadata
+from models import (Blob, ImageAsset, ChatMessage, Post, Story, Status, LibraryMaterial, Community, ChatRoom,
+                    User, CreativeWork, UserPage, ChatArchiveSegment)
+
+BLOB_ROOT = 'blobs'
+CHUNK_SIZE = 64 * 1024
+
+# How long an unreferenced blob is kept, so an upload isn't collected before the row using it is saved
+GRACE_PERIOD = timedelta(hours=24)
+
+# Columns that hold paths returned by the upload helpers; Post.media_url and
+# ChatArchiveSegment.file_paths may hold a list of them
+REFERENCES = {
+    ChatMessage: ('file_path',),
+    Post: ('media_url',),
+    Story: ('media_url',),
+    Status: ('content',), # a file path for image, voice and video statuses
+    LibraryMaterial: ('file_path',),
+    Community: ('cover_image',),
+    ChatRoom: ('cover_image',),
+    User: ('profile_banner_url',),
+    CreativeWork: ('media_url', 'cover_image_url'),
+    UserPage: ('profile_pic_url', 'cover_banner_url'),
+    ChatArchiveSegment: ('file_paths',), # the files of archived chat messages
+}
+
+def blob_path(digest, extension):
+    """Two levels of fan-out keep every directory small: blobs/ab/cd/abcd...<ext>."""
+    return posixpath.join(BLOB_ROOT, digest[:2], digest[2:4], digest + extension.lower())
+
+def is_blob_path(value):
+    return isinstance(value, str) and value.startswith(BLOB_ROOT + '/')
+
+def blob_paths(value):
+    """The blob paths held by a reference column's value (a path, a list of paths, or anything else)."""
+    values = value if isinstance(value, list) else [value]
+    return [path for path in values if is_blob_path(path)]
+
+def _write_blob(stream, extension, static_folder):
+    """Streams into a temporary file while hashing, then moves it into place unless that content is already stored."""
+    tmp_dir = os.path.join(static_folder, BLOB_ROOT, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        path = blob_path(digest.hexdigest(), extension)
+        file_path = os.path.join(static_folder, path)
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path, size
+
+def _record_blob(path, size):
+    now = datetime.utcnow()
+    blob = Blob.query.filter_by(path=path).first()
+    if blob is not None:
+        blob.stored_at = now
+        return
+    try:
+        # A savepoint, so the row exists before any reference to it is flushed
+        with db.session.begin_nested():
+            db.session.add(Blob(path=path, size=size, stored_at=now))
+    except IntegrityError:
+        # The same content was uploaded concurrently
+        Blob.query.filter_by(path=path).update({'stored_at': now})
+
+def store_upload(file, extension):
+    """
+    Stores an uploaded FileStorage (or any binary stream) in the blob store and returns its path
+    relative to the static folder. Identical content is stored once; images are stored without
+    their EXIF. Adds the Blob row to the
+    session; the caller commits it along with the row that references the path.
+    """
+    stream = strip_metadata(getattr(file, 'stream', file), extension)
+    path, size = _write_blob(stream, extension, current_app.static_folder)
+    _record_blob(path, size)
+    return path
+
+def _adjust(connection, paths, delta):
+    table = Blob.__table__
+    for path, count in Counter(paths).items():
+        connection.execute(
+            update(table).where(table.c.path == path).values(ref_count=table.c.ref_count + delta * count)
+        )
+
+# Reference counts are updated with SQL on the flush's own connection, so they commit or roll
+# back with the row that changed them. Bulk updates and deletes skip these events (as do in-place
+# changes to Post.media_url lists); `flask collect-blobs` reconciles the counts before collecting.
+
+def _listen(model, columns):
+    @event.listens_for(model, 'after_insert')
+    def _referenced(mapper, connection, target):
+        _adjust(connection, [p for column in columns for p in blob_paths(getattr(target, column))], 1)
+
+    @event.listens_for(model, 'before_delete')
+    def _released(mapper, connection, target):
+        _adjust(connection, [p for column in columns for p in blob_paths(getattr(target, column))], -1)
+
+    @event.listens_for(model, 'after_update')
+    def _changed(mapper, connection, target):
+        state = inspect(target)
+        added, removed = [], []
+        for column in columns:
+            history = state.attrs[column].history
+            if history.has_changes():
+                added += [p for value in history.added for p in blob_paths(value)]
+                removed += [p for value in history.deleted for p in blob_paths(value)]
+        _adjust(connection, added, 1)
+        _adjust(connection, removed, -1)
+
+for _model, _columns in REFERENCES.items():
+    _listen(_model, _columns)
+
+def count_references():
+    """Counter of blob path -> number of references, read from every reference column."""
+    counts = Counter()
+    for model, columns in REFERENCES.items():
+        for column in columns:
+            attr = getattr(model, column)
+            for (value,) in db.session.query(attr).filter(attr.isnot(None)).yield_per(1000):
+                counts.update(blob_paths(value))
+    return counts
+
+def reconcile_blob_refs():
+    """
+    Recomputes every Blob's ref_count from the reference columns and records blobs that are
+    referenced but have no row. Does not commit. Returns the number of blobs corrected.
+    """
+    counts = count_references()
+    corrected = 0
+    for blob in Blob.query.yield_per(1000):
+        actual = counts.pop(blob.path, 0)
+        if blob.ref_count != actual:
+            blob.ref_count = actual
+            corrected += 1
+    static_folder = current_app.static_folder
+    for path, actual in counts.items():
+        file_path = os.path.join(static_folder, path)
+        if os.path.exists(file_path):
+            db.session.add(Blob(path=path, size=os.path.getsize(file_path), ref_count=actual))
+            corrected += 1
+    return corrected
+
+def release_references(paths):
+    """
+    Takes the blob paths held by rows that are about to be bulk-deleted out of the reference
+    counts, which the events would otherwise miss. Does not commit.
+    """
+    _adjust(db.session.connection(), paths, -1)
+
+def _remove_file(static_folder, path):
+    """Deletes a file under the static folder. Returns the bytes freed."""
+    file_path = os.path.join(static_folder, path)
+    try:
+        size = os.path.getsize(file_path)
+        os.remove(file_path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+def _remove_blob_files(static_folder, path):
+    freed = _remove_file(static_folder, path)
+    asset = ImageAsset.query.filter_by(path=path).first()
+    if asset is not None:
+        for variant in (asset.variants or {}).values():
+            for fmt in ('webp', 'jpeg'):
+                freed += _remove_file(static_folder, variant[fmt])
+        db.session.delete(asset)
+    return freed
+
+def remove_unreferenced(paths, grace_period=GRACE_PERIOD):
+    """
+    Deletes those of the given blobs (and their image variants) that nothing references and that
+    weren't stored again within `grace_period`; the rest are left for `collect_garbage`. Does
+    not commit. Returns (files deleted, bytes freed).
+    """
+    paths = set(paths)
+    if not paths:
+        return 0, 0
+    static_folder = current_app.static_folder
+    cutoff = datetime.utcnow() - grace_period
+    deleted = freed = 0
+    for blob in Blob.query.filter(Blob.path.in_(paths), Blob.ref_count <= 0, Blob.stored_at < cutoff).all():
+        freed += _remove_blob_files(static_folder, blob.path)
+        db.session.delete(blob)
+        deleted += 1
+    return deleted, freed
+
+def collect_garbage(grace_period=GRACE_PERIOD):
+    """
+    Reconciles reference counts, then deletes blobs (and their image variants) that nothing has
+    referenced for `grace_period`, plus files in the store that never got a Blob row.
+    Commits. Returns the number of files deleted.
+    """
+    reconcile_blob_refs()
+    db.session.commit()
+
+    static_folder = current_app.static_folder
+    cutoff = datetime.utcnow() - grace_period
+    deleted = 0
+    for blob in Blob.query.filter(Blob.ref_count <= 0, Blob.stored_at < cutoff).all():
+        _remove_blob_files(static_folder, blob.path)
+        db.session.delete(blob)
+        deleted += 1
+    db.session.commit()
+
+    # Uploads whose request failed before committing their Blob row
+    known = {path for (path,) in db.session.query(Blob.path)}
+    cutoff_ts = cutoff.timestamp()
+    for root, dirs, files in os.walk(os.path.join(static_folder, BLOB_ROOT)):
+        dirs[:] = [d for d in dirs if d != 'variants']
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            path = os.path.relpath(file_path, static_folder).replace(os.sep, '/')
+            if path not in known and os.path.getmtime(file_path) < cutoff_ts:
+                _remove_blob_files(static_folder, path)
+                deleted += 1
+    db.session.commit()
+    return deleted
+
+def _rehome(path, static_folder, moved):
+    """The blob path for a legacy upload path, storing the file on first sight; None if it isn't a file."""
+    if path in moved:
+        return moved[path]
+    if not isinstance(path, str) or is_blob_path(path):
+        return None
+    file_path = os.path.normpath(os.path.join(static_folder, path))
+    if not file_path.startswith(static_folder + os.sep) or not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'rb') as f:
+        new_path, size = _write_blob(f, os.path.splitext(path)[1], static_folder)
+    _record_blob(new_path, size)
+    moved[path] = new_path
+    return new_path
+
+def rehome_uploads(batch_size=500):
+    """
+    Moves files referenced by the reference columns from the old flat upload folders into the
+    blob store, rewriting the columns (and ImageAsset paths) as it goes. Duplicates collapse
+    into one blob. Commits after each batch. Returns {old path: blob path}.
+    """
+    static_folder = os.path.normpath(current_app.static_folder)
+    moved = {}
+    for model, columns in REFERENCES.items():
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                for column in columns:
+                    value = getattr(row, column)
+                    if isinstance(value, list):
+                        rehomed = [_rehome(path, static_folder, moved) or path for path in value]
+                        if rehomed != value:
+                            setattr(row, column, rehomed)
+                    elif value:
+                        rehomed = _rehome(value, static_folder, moved)
+                        if rehomed:
+                            setattr(row, column, rehomed)
+            last_id = rows[-1].id
+            db.session.commit()
+
+    for old_path, new_path in moved.items():
+        asset = ImageAsset.query.filter_by(path=old_path).first()
+        if asset is not None:
+            if ImageAsset.query.filter_by(path=new_path).first() is None:
+                asset.path = new_path
+            else:
+                db.session.delete(asset)
+    db.session.commit()
+
+    for old_path in moved:
+        _remove_file(static_folder, old_path)
+    return moved
@@ -0,0 +1,96 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from extensions import db
+from background import WorkerPool
+from models import Certificate
+from pdf_generator import init_worker, render_certificate_html, write_certificate_pdf, certificate_pdf_paths
+
+class CertificateRenderer(WorkerPool):
+    """
+    Renders certificate PDFs in the background so approving requests never waits on WeasyPrint.
+
+    Certificates are queued by id. Each of CERTIFICATE_WORKERS threads takes one, marks it
+    'rendering', fills in the template and hands the HTML to a process pool of the same size,
+    whose processes parse the stylesheet and fonts once at startup. The certificate ends up
+    'ready' or 'failed'. CERTIFICATE_WORKERS = 0 renders inline in the caller instead.
+    Anything still 'queued' or 'rendering' after a restart is picked up again by
+    `flask render-certificates`.
+    """
+
+    name = 'certificate-worker'
+
+    def __init__(self, app=None):
+        self._pool = None
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get('CERTIFICATE_WORKERS', 2))
+
+    def enqueue(self, certificate_ids):
+        """Queues certificates for rendering. Commit them (as 'queued') before calling this."""
+        for certificate_id in certificate_ids:
+            if self.num_workers <= 0:
+                self.process(certificate_id)
+            else:
+                self.submit(certificate_id)
+
+    def shutdown(self):
+        """Lets queued certificates finish, then stops the threads and the process pool."""
+        super().shutdown()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _start_workers(self):
+        with self._lock:
+            if self._pool is None and self.num_workers > 0:
+                self._pool = self._new_pool()
+        super()._start_workers()
+
+    def _new_pool(self):
+        # 'spawn' keeps the render processes free of the threads and sockets of this one
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker
+        )
+
+    def _write_pdf(self, html, file_path):
+        if not self._workers:
+            return write_certificate_pdf(html, file_path)
+        try:
+            return self._pool.submit(write_certificate_pdf, html, file_path).result()
+        except BrokenProcessPool:
+            # A render process died (e.g. killed for memory); replace the pool for the next job
+            with self._lock:
+                broken, self._pool = self._pool, self._new_pool()
+            broken.shutdown(wait=False)
+            raise
+
+    def process(self, certificate_id):
+        certificate = db.session.get(Certificate, certificate_id)
+        if certificate is None or certificate.status == 'ready':
+            return
+        certificate.status = 'rendering'
+        db.session.commit()
+
+        file_path, relative_path = certificate_pdf_paths(certificate, self.app)
+        try:
+            html = render_certificate_html(certificate, certificate.user, certificate.course)
+            self._write_pdf(html, file_path)
+        except Exception as e:
+            db.session.rollback()
+            certificate.status = 'failed'
+            certificate.render_error = str(e)[:500]
+            db.session.commit()
+            print(f"Certificate {certificate.certificate_uid} failed to render: {e}")
+            return
+
+        certificate.file_path = relative_path
+        certificate.status = 'ready'
+        certificate.render_error = None
+        db.session.commit()
+
+certificate_renderer = CertificateRenderer()
@@ -0,0 +1,273 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import joinedload, selectinload
+from extensions import db
+from models import ChatMessage, ChatRoom, ChatArchiveSegment, MessageReaction, ReportedMessage, Poll
+from blob_store import blob_paths, release_references
+from storage import release_messages
+from chat_unread import invalidate_unread_counts
+from chat_history import get_history_page, load_reactions, serialize_message, HISTORY_PAGE_SIZE
+from utils import decode_cursor
+
+DEFAULT_BATCH_SIZE = 500
+# Decompressed segments kept in memory for readers scrolling through archived months
+SEGMENT_CACHE_SIZE = 16
+
+# A message's place in history; encode_cursor accepts it like a ChatMessage
+Position = namedtuple('Position', ['timestamp', 'id'])
+
+def archive_folder():
+    return current_app.config.get('CHAT_ARCHIVE_FOLDER') or os.path.join(current_app.instance_path, 'chat_archive')
+
+def retention_cutoff(room, now=None):
+    """When a room's messages start being archived, or None if it keeps them all."""
+    days = room.retention_days
+    if days is None:
+        days = current_app.config.get('CHAT_RETENTION_DAYS')
+    if not days:
+        return None
+    return (now or datetime.utcnow()) - timedelta(days=days)
+
+def _position(record):
+    return Position(datetime.fromisoformat(record['timestamp'].rstrip('Z')), record['message_id'])
+
+def _archive_record(msg, reactions):
+    record = serialize_message(msg, reactions)
+    record['poll_id'] = msg.poll.id if msg.poll else None
+    record['archived'] = True
+    return record
+
+def _append(segment, records):
+    """
+    Appends records to a segment's file as one more gzip member. The file is first cut back to
+    the length last committed, so a batch whose transaction failed is not written twice.
+    """
+    file_path = os.path.join(archive_folder(), segment.path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    data = gzip.compress(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+    with open(file_path, 'ab') as f:
+        f.truncate(segment.bytes or 0)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    segment.bytes = (segment.bytes or 0) + len(data)
+
+def _segment(room_id, month):
+    segment = ChatArchiveSegment.query.filter_by(room_id=room_id, month=month).first()
+    if segment is None:
+        segment = ChatArchiveSegment(room_id=room_id, month=month, path=f'{room_id}/{month}.jsonl.gz',
+                                     message_count=0, bytes=0, file_paths=[])
+        db.session.add(segment)
+    return segment
+
+def _archive_batch(room, cutoff, batch_size):
+    messages = ChatMessage.query.options(
+        joinedload(ChatMessage.author),
+        joinedload(ChatMessage.forwarded_from),
+        joinedload(ChatMessage.link_preview),
+        joinedload(ChatMessage.poll),
+        selectinload(ChatMessage.replied_to).joinedload(ChatMessage.author),
+    ).filter(
+        ChatMessage.room_id == room.id,
+        ChatMessage.timestamp < cutoff,
+        # Pinned and reported messages stay where the room and the moderators can see them
+        ChatMessage.is_pinned.isnot(True),
+        ~ChatMessage.id.in_(select(ReportedMessage.message_id)),
+    ).order_by(ChatMessage.id).limit(batch_size).all()
+    if not messages:
+        return 0
+
+    reactions = load_reactions(messages)
+    by_month = {}
+    for msg in messages:
+        by_month.setdefault(msg.timestamp.strftime('%Y-%m'), []).append(msg)
+    for month, month_messages in by_month.items():
+        segment = _segment(room.id, month)
+        _append(segment, [_archive_record(msg, reactions[msg.id]) for msg in month_messages])
+        paths = [path for msg in month_messages for path in blob_paths(msg.file_path)]
+        segment.message_count += len(month_messages)
+        segment.first_message_id = min(filter(None, [segment.first_message_id, month_messages[0].id]))
+        segment.last_message_id = max(filter(None, [segment.last_message_id, month_messages[-1].id]))
+        timestamps = [msg.timestamp for msg in month_messages]
+        segment.first_timestamp = min(filter(None, [segment.first_timestamp] + timestamps))
+        segment.last_timestamp = max(filter(None, [segment.last_timestamp] + timestamps))
+        if paths:
+            # A new list, so the blob reference events see the added paths
+            segment.file_paths = (segment.file_paths or []) + paths
+
+    message_ids = [msg.id for msg in messages]
+    db.session.flush()
+    # The segments now hold the file references; the bulk delete below skips the events
+    release_messages(ChatMessage.query.filter(ChatMessage.id.in_(message_ids)))
+    release_references([path for msg in messages for path in blob_paths(msg.file_path)])
+    options = {'synchronize_session': False}
+    db.session.execute(delete(MessageReaction).where(MessageReaction.message_id.in_(message_ids)).execution_options(**options))
+    # Replies still in the table keep the quote of the message they answered
+    for target_id in db.session.execute(select(ChatMessage.replied_to_id.distinct()).where(
+        ChatMessage.replied_to_id.in_(message_ids)
+    )).scalars().all():
+        target = next(msg for msg in messages if msg.id == target_id)
+        db.session.execute(update(ChatMessage).where(ChatMessage.replied_to_id == target_id).values(
+            replied_to_id=None, replied_to_quote={'user_name': target.author.name, 'content': target.content}
+        ).execution_options(**options))
+    # Polls stay with the room; their archived message keeps the poll_id
+    db.session.execute(update(Poll).where(Poll.message_id.in_(message_ids)).values(message_id=None).execution_options(**options))
+    db.session.execute(delete(ChatMessage).where(ChatMessage.id.in_(message_ids)).execution_options(**options))
+    invalidate_unread_counts([room.id])
+    return len(messages)
+
+def archive_room(room, batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """
+    Moves a room's messages older than its retention policy into its archive, oldest first,
+    batch_size messages per transaction. Returns the number of messages archived.
+    """
+    cutoff = retention_cutoff(room, now)
+    if cutoff is None:
+        return 0
+    archived = 0
+    while True:
+        count = _archive_batch(room, cutoff, batch_size)
+        db.session.commit()
+        archived += count
+        if count < batch_size:
+            return archived
+
+def archive_chat_history(batch_size=DEFAULT_BATCH_SIZE, room_ids=None, now=None):
+    """
+    Archives every room's messages older than its retention_days (or CHAT_RETENTION_DAYS) into
+    per-room, per-month gzipped JSON-lines segments under CHAT_ARCHIVE_FOLDER, then deletes
+    them from the hot table in batches. Archived records keep their reactions, reply quotes and
+    link previews, and replies left in the table keep the quote of what they answered. Pinned
+    and reported messages are not archived. Commits after each batch. Returns
+    {room_id: messages archived} for the rooms that had any.
+    """
+    query = ChatRoom.query.order_by(ChatRoom.id)
+    if room_ids:
+        query = query.filter(ChatRoom.id.in_(room_ids))
+    report = {}
+    for room in query.all():
+        archived = archive_room(room, batch_size, now)
+        if archived:
+            report[room.id] = archived
+    return report
+
+def read_segment(segment):
+    """A segment's records as [(Position, record)], oldest first."""
+    file_path = os.path.join(archive_folder(), segment.path)
+    with open(file_path, 'rb') as f:
+        # Only the committed length; anything after it is a batch that never committed
+        data = gzip.decompress(f.read(segment.bytes))
+    return sorted(((_position(record), record) for record in map(json.loads, data.splitlines())),
+                  key=lambda item: item[0])
+
+def iter_archived_records(room_id):
+    """
+    Every archived record of a room, oldest first, one segment in memory at a time. Reads the
+    files directly so a full walk (an export) doesn't push readers' segments out of the cache.
+    """
+    segments = ChatArchiveSegment.query.filter(
+        ChatArchiveSegment.room_id == room_id, ChatArchiveSegment.message_count > 0
+    ).order_by(ChatArchiveSegment.month.asc()).all()
+    for segment in segments:
+        for _, record in read_segment(segment):
+            yield record
+
+class SegmentCache:
+    """The decompressed records of recently read segments, oldest first by (timestamp, id)."""
+
+    def __init__(self, size=SEGMENT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict() # {(path, bytes): [(Position, record)]}
+        self._lock = threading.Lock()
+
+    def get(self, segment):
+        key = (segment.path, segment.bytes)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        records = read_segment(segment)
+        with self._lock:
+            self._entries[key] = records
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return records
+
+segment_cache = SegmentCache()
+
+def load_archived_page(room_id, before=None, after=None, since=None, limit=HISTORY_PAGE_SIZE):
+    """
+    One page of a room's archived messages, as the records written by the archiver, in
+    chronological order. `before`/`after` are Positions. Only the segments that can hold the
+    page are read. Returns (records, has_more).
+    """
+    query = ChatArchiveSegment.query.filter(ChatArchiveSegment.room_id == room_id, ChatArchiveSegment.message_count > 0)
+    if since is not None:
+        query = query.filter(ChatArchiveSegment.last_timestamp >= since)
+    if after is not None:
+        segments = query.filter(ChatArchiveSegment.last_timestamp >= after.timestamp).order_by(ChatArchiveSegment.month.asc())
+    else:
+        if before is not None:
+            query = query.filter(ChatArchiveSegment.first_timestamp <= before.timestamp)
+        segments = query.order_by(ChatArchiveSegment.month.desc())
+
+    page = []
+    for segment in segments:
+        records = segment_cache.get(segment)
+        if after is not None:
+            page += [item for item in records if item[0] > after and (since is None or item[0].timestamp >= since)]
+        else:
+            page = [item for item in records if (before is None or item[0] < before)
+                    and (since is None or item[0].timestamp >= since)] + page
+        if len(page) > limit:
+            break
+
+    page.sort(key=lambda item: item[0])
+    has_more = len(page) > limit
+    page = page[:limit] if after is not None else page[-limit:]
+    return [record for _, record in page], has_more
+
+def get_history(room_id, before=None, after=None, since=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Like get_history_page, but pages continue into the room's archive once they reach messages
+    older than the hot table holds. Returns (payloads, has_more, first Position, last Position),
+    with payloads as produced by serialize_message (archived ones carry 'archived': True).
+    Raises ValueError for a bad cursor.
+    """
+    messages, has_more = get_history_page(room_id, before=before, after=after, since=since, limit=limit)
+    items = [(Position(msg.timestamp, msg.id), msg) for msg in messages]
+
+    newest_archived = db.session.query(func.max(ChatArchiveSegment.last_timestamp)).filter(
+        ChatArchiveSegment.room_id == room_id
+    ).scalar()
+    if newest_archived is not None:
+        if after is not None:
+            position = Position(*decode_cursor(after))
+            needed = position.timestamp <= newest_archived
+        else:
+            position = Position(*decode_cursor(before)) if before else None
+            # The hot page alone is enough if it is full and newer than everything archived
+            needed = not has_more or items[0][0].timestamp <= newest_archived
+        if needed:
+            records, archived_more = load_archived_page(
+                room_id, before=None if after else position, after=position if after else None,
+                since=since, limit=limit
+            )
+            items += [(_position(record), record) for record in records]
+            items.sort(key=lambda item: item[0])
+            has_more = has_more or archived_more or len(items) > limit
+            items = items[:limit] if after is not None else items[-limit:]
+
+    hot = [item for _, item in items if isinstance(item, ChatMessage)]
+    reactions = load_reactions(hot)
+    payloads = [item if isinstance(item, dict) else serialize_message(item, reactions[item.id]) for _, item in items]
+    first = items[0][0] if items else None
+    last = items[-1][0] if items else None
+    return payloads, has_more, first, last
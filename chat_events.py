@@ -1,82 +1,73 @@
-from flask_socketio import emit, join_room, leave_room
+from flask_socketio import emit, join_room, leave_room, rooms
+from sqlalchemy import func
 from flask_login import current_user
-from extensions import db
+from extensions import db, presence
 from datetime import datetime
-from models import ChatRoom, ChatRoomMember, ChatMessage, User, Course, Community, MutedUser, MutedRoom, ReportedMessage, ReportedGroup, MessageReaction, UserLastRead, Poll, PollOption, PollVote, CallHistory, BlockedUser, ChatClearTimestamp, Status
+from models import ChatRoom, ChatRoomMember, ChatMessage, User, Course, Community, MutedRoom, ReportedMessage, ReportedGroup, MessageReaction, Poll, PollOption, PollVote, CallHistory, BlockedUser, ChatClearTimestamp, Status
 from utils import filter_profanity, is_contact, get_or_create_private_room
 from flask import request, url_for
-from push_notifications import send_push_notification
-
-# In-memory stores for call state. In a multi-server setup, this would need to be moved to a shared store like Redis.
-user_sids = {} # {user_id: sid}
-active_calls = {} # {call_id: {user_id: sid, ...}}
+from push_notifications import notification_dispatcher
+from chat_unread import increment_unread_counts, decrement_unread_counts, reset_unread_count, clear_unread_count, mark_read
+from room_acl import room_access
+from chat_history import serialize_message
+from link_previews import link_previewer
+from status_tray import status_tray
+from polls import cast_vote, poll_updates
+from socket_limits import socket_limiter
+from typing_indicators import typing_tracker
 
 def register_chat_events(socketio):
 
+    # Every handler below is registered through the limiter: events past a connection's budget
+    # for that event are dropped before the handler runs (see socket_limits.py).
+    socketio = socket_limiter.wrap(socketio)
+
+    # Presence and group-call membership live in the shared presence store (see presence.py)
+    # so that several Socket.IO workers behind a message queue see the same state.
+
     @socketio.on('connect')
     def on_connect():
         if current_user.is_authenticated:
-            user_sids[current_user.id] = request.sid
+            presence.set_online(current_user.id, request.sid)
             current_user.last_seen = datetime.utcnow()
             db.session.commit()
             emit('user_online', {'user_id': current_user.id}, broadcast=True)
 
+    @socketio.on('heartbeat')
+    def on_heartbeat(data=None):
+        if current_user.is_authenticated:
+            presence.heartbeat(current_user.id, request.sid)
+
     @socketio.on('disconnect')
     def on_disconnect():
-        if current_user.is_authenticated and current_user.id in user_sids:
-            # Also remove user from any active calls they are in
-            for call_id, participants in list(active_calls.items()):
-                if current_user.id in participants:
-                    del participants[current_user.id]
-                    # If call is now empty, remove it
-                    if not participants:
-                        del active_calls[call_id]
-                    else:
-                        # Notify remaining participants that a user has left
-                        for user_id in participants:
-                            emit('participant_left', {'user_id': current_user.id}, to=user_sids.get(user_id))
-
-            del user_sids[current_user.id]
+        if not current_user.is_authenticated:
+            return
+
+        typing_tracker.stop_everywhere(current_user.id)
+
+        # Remove this connection from any active calls it joined, even if the user
+        # is still online from another tab
+        for call_id, participants in presence.leave_all_calls(current_user.id, request.sid).items():
+            # Notify remaining participants that a user has left
+            for user_id, sid in participants.items():
+                emit('participant_left', {'user_id': current_user.id}, to=sid)
+
+        if presence.set_offline(current_user.id, request.sid):
             current_user.last_seen = datetime.utcnow()
             db.session.commit()
             emit('user_offline', {'user_id': current_user.id, 'last_seen': current_user.last_seen.isoformat() + "Z"}, broadcast=True)
 
 
     def is_user_authorized_for_room(user, room):
-        if user.role == 'admin':
-            return True
-
-        # Specific student restrictions
-        if user.role == 'student':
-            is_member = ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
-            if room.room_type == 'course' and room.course_room:
-                 return is_member or user.is_enrolled(room.course_room)
-            # Students can only access rooms they are members of (no public access by default)
-            return is_member
-
-        if room.room_type == 'private':
-            # Check if either user has blocked the other
-            members = room.members.all()
-            if len(members) == 2:
-                other_user_id = members[0].user_id if members[0].user_id != user.id else members[1].user_id
-
-                # Check if current user blocked the other user
-                if BlockedUser.query.filter_by(blocker_id=user.id, blocked_id=other_user_id).first():
-                    return False
-                # Check if the other user blocked the current user
-                if BlockedUser.query.filter_by(blocker_id=other_user_id, blocked_id=user.id).first():
-                    return False
-
-        if room.room_type == 'public' or room.room_type == 'community_channel':
-            return True
-
-        # Check for course-based access for course rooms
-        if room.room_type == 'course' and room.course_room:
-            if user.id == room.course_room.instructor_id or user.is_enrolled(room.course_room):
-                return True
-
-        # Check for explicit membership
-        return ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
+        return room_access.is_authorized(user, room)
+
+    def emit_messages_read(room_id, user_id, watermark):
+        """One event per read action: clients mark every message up to the watermark as read by the user."""
+        emit('messages_read', {
+            'room_id': room_id,
+            'read_by_user_id': user_id,
+            'last_read_message_id': watermark
+        }, to=room_id)
 
 
     @socketio.on('join')
@@ -90,15 +81,15 @@ def register_chat_events(socketio):
             return
 
         join_room(room_id)
+        typers = typing_tracker.typing(room_id)
+        if typers:
+            emit('typing_update', {'room_id': room_id, 'users': typers})
 
-        # Update last read timestamp
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room_id).first()
-        if last_read:
-            last_read.last_read_timestamp = datetime.utcnow()
-        else:
-            last_read = UserLastRead(user_id=current_user.id, room_id=room_id, last_read_timestamp=datetime.utcnow())
-            db.session.add(last_read)
+        # Everything in the room is read now; the counter starts again from zero
+        watermark = reset_unread_count(current_user.id, room.id)
         db.session.commit()
+        if watermark is not None:
+            emit_messages_read(room.id, current_user.id, watermark)
 
     @socketio.on('leave')
     def on_leave(data):
@@ -132,8 +123,7 @@ def register_chat_events(socketio):
                 return
 
             # Mute check
-            is_muted = MutedUser.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-            if is_muted:
+            if room_access.is_muted(current_user.id, room.id):
                 emit('error', {'msg': 'You are muted in this room.'})
                 return
 
@@ -160,122 +150,88 @@ def register_chat_events(socketio):
                 replied_to_id=replied_to_id
             )
             db.session.add(new_message)
+            link_previewer.attach(new_message, filtered_content)
 
             # Update the room's last message timestamp
             room.last_message_timestamp = new_message.timestamp
+            increment_unread_counts(room.id, current_user.id)
 
             db.session.commit()
 
-            replied_to_data = None
-            if new_message.replied_to:
-                replied_to_data = {
-                    'user_name': new_message.replied_to.author.name,
-                    'content': new_message.replied_to.content
-                }
-
-            forwarded_from_data = None
-            if new_message.is_forwarded and new_message.forwarded_from:
-                forwarded_from_data = {
-                    'name': new_message.forwarded_from.name
-                }
-
-            msg_data = {
-                'user_name': new_message.author.name,
-                'user_id': new_message.user_id,
-                'user_profile_pic': new_message.author.profile_pic or 'default.jpg',
-                'content': new_message.content,
-                'file_path': new_message.file_path,
-                'file_name': new_message.file_name,
-                'timestamp': new_message.timestamp.isoformat() + "Z",
-                'room_id': room.id,
-                'message_id': new_message.id,
-                'is_pinned': new_message.is_pinned,
-                'reactions': [], # New messages have no reactions
-                'replied_to': replied_to_data,
-                'is_forwarded': new_message.is_forwarded,
-                'forwarded_from': forwarded_from_data
-            }
+            # New messages have no reactions
+            msg_data = serialize_message(new_message)
 
             emit('message', msg_data, to=room_id)
+            typing_tracker.stop(room_id, current_user.id)
 
-            # Send push notifications to other members of the room
+            # Send push notifications to other members of the room in the background
             notification_title = f"New message from {current_user.name}"
             notification_body = new_message.content or "Sent a file"
             notification_data = {
                 "click_action": url_for('main.chat_room', room_id=room.id, _external=True)
             }
 
-            for member in room.members:
-                if member.user_id != current_user.id:
-                    # Add check for user's notification preferences here in the future
-                    send_push_notification(
-                        user_id=member.user_id,
-                        title=notification_title,
-                        body=notification_body,
-                        data=notification_data
-                    )
+            notification_dispatcher.notify_room(
+                room_id=room.id,
+                sender_id=current_user.id,
+                title=notification_title,
+                body=notification_body,
+                data=notification_data
+            )
 
         except Exception as e:
             print(f"Error handling message: {e}")
             emit('error', {'msg': 'An unexpected error occurred. Please try again.'})
 
+    # Typing reports only update the tracker; rooms get its coalesced 'typing_update' events.
+    # A connection can only report for rooms it has joined.
+
     @socketio.on('typing_start')
     def handle_typing_start(data):
         if not current_user.is_authenticated:
             return
         room_id = data.get('room_id')
-        if not room_id:
+        if not room_id or room_id not in rooms():
             return
-
-        emit('user_typing_start', {
-            'user_id': current_user.id,
-            'user_name': current_user.name
-        }, to=room_id, include_self=False)
+        typing_tracker.start(room_id, current_user.id, current_user.name)
 
     @socketio.on('typing_stop')
     def handle_typing_stop(data):
         if not current_user.is_authenticated:
             return
         room_id = data.get('room_id')
-        if not room_id:
+        if not room_id or room_id not in rooms():
             return
-
-        emit('user_typing_stop', {
-            'user_id': current_user.id
-        }, to=room_id, include_self=False)
+        typing_tracker.stop(room_id, current_user.id)
 
     @socketio.on('mark_as_read')
     def handle_mark_as_read(data):
         if not current_user.is_authenticated:
             return
 
-        message_ids = data.get('message_ids', [])
         room_id = data.get('room_id')
-
-        if not message_ids or not room_id:
+        room = ChatRoom.query.get(room_id) if room_id else None
+        if not room or not is_user_authorized_for_room(current_user, room):
             return
 
-        messages = ChatMessage.query.filter(
-            ChatMessage.id.in_(message_ids),
-            ChatMessage.read_at.is_(None),
-            ChatMessage.user_id != current_user.id # Can't mark your own messages as read
-        ).all()
-
-        updated_message_ids = []
-        for msg in messages:
-            msg.read_at = datetime.utcnow()
-            updated_message_ids.append(msg.id)
-
-        if updated_message_ids:
-            db.session.commit()
+        # Clients send the newest message they have seen; older ones send every id they saw
+        try:
+            message_id = int(data.get('message_id') or max(map(int, data.get('message_ids') or []), default=0))
+        except (TypeError, ValueError):
+            return
+        # Only this room's messages can move the watermark
+        message_id = db.session.query(func.max(ChatMessage.id)).filter(
+            ChatMessage.room_id == room.id,
+            ChatMessage.id <= message_id
+        ).scalar()
+        if message_id is None:
+            return
 
-            # Notify the entire room that messages have been read
-            # The client side will handle filtering for the relevant user
-            emit('messages_read', {
-                'room_id': room_id,
-                'message_ids': updated_message_ids,
-                'read_by_user_id': current_user.id
-            }, to=room_id)
+        watermark = mark_read(current_user.id, room.id, message_id)
+        if watermark is None:
+            return
+        db.session.commit()
+        emit_messages_read(room.id, current_user.id, watermark)
 
     @socketio.on('get_user_status')
     def get_user_status(data):
@@ -290,7 +246,7 @@ def register_chat_events(socketio):
         if not user:
             return
 
-        is_online = user.id in user_sids
+        is_online = presence.is_online(user.id)
         last_seen_data = None
 
         # Privacy check for last_seen
@@ -339,10 +295,12 @@ def register_chat_events(socketio):
                     file_path=original_message.file_path,
                     file_name=original_message.file_name,
                     is_forwarded=True,
-                    forwarded_from_id=original_message.user_id
+                    forwarded_from_id=original_message.user_id,
+                    link_preview_id=original_message.link_preview_id
                 )
                 db.session.add(new_message)
                 room.last_message_timestamp = datetime.utcnow()
+                increment_unread_counts(room.id, current_user.id)
 
         db.session.commit()
         # The regular 'message' event will be triggered by the client-side logic
@@ -372,6 +330,7 @@ def register_chat_events(socketio):
         if not (is_admin or is_instructor_of_course or is_author):
             return
 
+        decrement_unread_counts(message)
         db.session.delete(message)
         db.session.commit()
 
@@ -485,6 +444,7 @@ def register_chat_events(socketio):
         if member_to_remove:
             db.session.delete(member_to_remove)
             db.session.commit()
+            room_access.invalidate(user_id=int(user_id), room_id=room.id)
             emit('member_removed', {'user_id': user_id, 'room_id': room_id}, to=room_id)
 
     @socketio.on('exit_group')
@@ -504,6 +464,7 @@ def register_chat_events(socketio):
         if membership:
             db.session.delete(membership)
             db.session.commit()
+            room_access.invalidate(user_id=current_user.id, room_id=int(room_id))
             emit('status', {'msg': f"You have left the group. You will be redirected."})
             # The client should handle redirecting the user
         else:
@@ -648,6 +609,7 @@ def register_chat_events(socketio):
             content=f"Poll: {question}" # Simple text representation
         )
         db.session.add(poll_message)
+        increment_unread_counts(room.id, current_user.id)
         db.session.commit() # Commit to get message ID
 
         new_poll = Poll(
@@ -684,48 +646,20 @@ def register_chat_events(socketio):
         if not current_user.is_authenticated:
             return
 
-        option_id = data.get('option_id')
-        option = PollOption.query.get(option_id)
+        option = PollOption.query.get(data.get('option_id'))
         if not option:
             return
 
         poll = option.poll
         room = poll.room
-
-        if not is_user_authorized_for_room(current_user, room):
+        if room is None or not is_user_authorized_for_room(current_user, room):
             return
 
-        # Check if user has already voted
-        existing_vote = PollVote.query.join(PollOption).filter(
-            PollOption.poll_id == poll.id,
-            PollVote.user_id == current_user.id
-        ).first()
-
-        if existing_vote:
-            # If they voted for the same option, do nothing (or retract vote - simple for now)
-            if existing_vote.option_id == option_id:
-                return
-            # If they voted for a different option, update their vote
-            else:
-                existing_vote.option_id = option_id
-        else:
-            # New vote
-            new_vote = PollVote(option_id=option_id, user_id=current_user.id)
-            db.session.add(new_vote)
-
+        changed = cast_vote(poll, option, current_user.id)
         db.session.commit()
 
-        # Recalculate vote counts
-        options_with_votes = []
-        for opt in poll.options:
-            vote_count = PollVote.query.filter_by(option_id=opt.id).count()
-            options_with_votes.append({'id': opt.id, 'text': opt.text, 'votes': vote_count})
-
-        emit('poll_update', {
-            'poll_id': poll.id,
-            'room_id': room.id,
-            'options': options_with_votes
-        }, to=room.id)
+        # Coalesced per poll, carrying only the options whose counts moved
+        poll_updates.changed(poll.id, room.id, changed)
 
     @socketio.on('leave_community')
     def leave_community(data):
@@ -746,6 +680,7 @@ def register_chat_events(socketio):
                 db.session.delete(membership)
 
         db.session.commit()
+        room_access.invalidate(user_id=current_user.id)
         emit('status', {'msg': f"You have left the community '{community.name}'. You will be redirected."})
 
     @socketio.on('mute_community')
@@ -896,40 +831,28 @@ def register_chat_events(socketio):
         if not current_user.is_authenticated: return
         call_id = data['call_id']
 
-        # Get existing participants
-        if call_id in active_calls:
-            existing_participants = active_calls[call_id]
-            emit('existing_participants', {'participants': list(existing_participants.keys())})
-
-            # Notify existing participants of the new user
-            for user_id, sid in existing_participants.items():
-                emit('new_participant', {'user_id': current_user.id}, to=sid)
-        else:
-            # This is the first person in the call
-            active_calls[call_id] = {}
-            emit('existing_participants', {'participants': []})
+        # Add new user to the call and get the existing participants
+        existing_participants = presence.join_call(call_id, current_user.id, request.sid)
+        emit('existing_participants', {'participants': list(existing_participants.keys())})
 
-        # Add new user to the call
-        active_calls[call_id][current_user.id] = request.sid
+        # Notify existing participants of the new user
+        for user_id, sid in existing_participants.items():
+            emit('new_participant', {'user_id': current_user.id}, to=sid)
 
     @socketio.on('leave_group_call')
     def on_leave_group_call(data):
         if not current_user.is_authenticated: return
         call_id = data['call_id']
-        if call_id in active_calls and current_user.id in active_calls[call_id]:
-            del active_calls[call_id][current_user.id]
-            # If call is now empty, remove it
-            if not active_calls[call_id]:
-                del active_calls[call_id]
-            else:
-                # Notify remaining participants
-                for user_id, sid in active_calls[call_id].items():
-                    emit('participant_left', {'user_id': current_user.id}, to=sid)
+        remaining_participants = presence.leave_call(call_id, current_user.id)
+        if remaining_participants:
+            # Notify remaining participants
+            for user_id, sid in remaining_participants.items():
+                emit('participant_left', {'user_id': current_user.id}, to=sid)
 
     @socketio.on('webrtc_offer')
     def handle_webrtc_offer(data):
         if not current_user.is_authenticated: return
-        to_sid = user_sids.get(data['to_user_id'])
+        to_sid = presence.get_sid(data['to_user_id'])
         if to_sid:
             emit('webrtc_offer_received', {
                 'from_user_id': current_user.id,
@@ -939,7 +862,7 @@ def register_chat_events(socketio):
     @socketio.on('webrtc_answer')
     def handle_webrtc_answer(data):
         if not current_user.is_authenticated: return
-        to_sid = user_sids.get(data['to_user_id'])
+        to_sid = presence.get_sid(data['to_user_id'])
         if to_sid:
             emit('webrtc_answer_received', {
                 'from_user_id': current_user.id,
@@ -949,7 +872,7 @@ def register_chat_events(socketio):
     @socketio.on('webrtc_ice_candidate')
     def handle_webrtc_ice_candidate(data):
         if not current_user.is_authenticated: return
-        to_sid = user_sids.get(data['to_user_id'])
+        to_sid = presence.get_sid(data['to_user_id'])
         if to_sid:
             emit('webrtc_ice_candidate_received', {
                 'from_user_id': current_user.id,
@@ -983,6 +906,7 @@ def register_chat_events(socketio):
         )
         db.session.add(new_message)
         room.last_message_timestamp = new_message.timestamp
+        increment_unread_counts(room.id, current_user.id)
         db.session.commit()
 
         msg_data = {
@@ -1011,11 +935,19 @@ def register_chat_events(socketio):
         if existing_block:
             db.session.delete(existing_block)
             db.session.commit()
+            room_access.invalidate(user_id=current_user.id)
+            room_access.invalidate(user_id=int(blocked_user_id))
+            status_tray.invalidate(current_user.id)
+            status_tray.invalidate(int(blocked_user_id))
             emit('user_block_status', {'blocked_user_id': blocked_user_id, 'is_blocked': False})
         else:
             new_block = BlockedUser(blocker_id=current_user.id, blocked_id=blocked_user_id)
             db.session.add(new_block)
             db.session.commit()
+            room_access.invalidate(user_id=current_user.id)
+            room_access.invalidate(user_id=int(blocked_user_id))
+            status_tray.invalidate(current_user.id)
+            status_tray.invalidate(int(blocked_user_id))
             emit('user_block_status', {'blocked_user_id': blocked_user_id, 'is_blocked': True})
 
     @socketio.on('clear_chat')
@@ -1046,6 +978,8 @@ def register_chat_events(socketio):
             )
             db.session.add(clear_record)
 
+        # Cleared messages are no longer shown, so they no longer count as unread
+        clear_unread_count(current_user.id, room_id)
         db.session.commit()
 
         emit('chat_cleared', {'room_id': room_id})
@@ -1076,6 +1010,7 @@ def register_chat_events(socketio):
         )
         db.session.add(new_message)
         room.last_message_timestamp = datetime.utcnow()
+        increment_unread_counts(room.id, current_user.id)
         db.session.commit()
 
         # Emit the message to the private room
@@ -1122,6 +1057,7 @@ def register_chat_events(socketio):
         )
         db.session.add(new_message)
         room.last_message_timestamp = new_message.timestamp
+        increment_unread_counts(room.id, current_user.id)
         db.session.commit()
 
         msg_data = {
@@ -0,0 +1,121 @@
+import csv
+import heapq
+import io
+import json
+import zlib
+from datetime import datetime
+from extensions import db
+from models import ChatMessage, User
+from chat_archive import iter_archived_records
+
+EXPORT_CHUNK_SIZE = 500
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'txt': ('text/plain', 'txt'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'csv': ('text/csv', 'csv'),
+}
+
+def iter_hot_rows(room_id, chunk_size=None):
+    """
+    Yields (id, timestamp, author name, content, file_name) for every message still in the
+    chat_message table, in id order. Reads `chunk_size` rows at a time by id so memory stays
+    flat however big the room is, and returns plain rows so nothing piles up in the session.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            ChatMessage.id, ChatMessage.timestamp, User.name, ChatMessage.content, ChatMessage.file_name
+        ).join(User, User.id == ChatMessage.user_id).filter(
+            ChatMessage.room_id == room_id,
+            ChatMessage.id > last_id
+        ).order_by(ChatMessage.id).limit(chunk_size).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+def iter_archived_rows(room_id):
+    """The same rows for a room's archived messages, from its archive segments."""
+    for record in iter_archived_records(room_id):
+        yield (record['message_id'], datetime.fromisoformat(record['timestamp'].rstrip('Z')),
+               record['user_name'], record['content'], record['file_name'])
+
+def iter_message_rows(room_id, chunk_size=None):
+    """
+    Yields (id, timestamp, author name, content, file_name) for every message in a room,
+    archived or not, in id order. Pinned and reported messages stay in the table while their
+    neighbours are archived, so the two sources are merged rather than chained.
+    """
+    return heapq.merge(iter_archived_rows(room_id), iter_hot_rows(room_id, chunk_size), key=lambda row: row[0])
+
+def _message_text(content, file_name):
+    if content:
+        return content
+    return f"File: {file_name}" if file_name else ''
+
+def _txt_lines(room, rows):
+    yield f"Chat export for: {room.name}\n\n"
+    for message_id, timestamp, author, content, file_name in rows:
+        yield f"[{timestamp.strftime('%Y-%m-%d %H:%M:%S')}] {author}: {_message_text(content, file_name)}\n"
+
+def _jsonl_lines(room, rows):
+    for message_id, timestamp, author, content, file_name in rows:
+        yield json.dumps({
+            'message_id': message_id,
+            'timestamp': timestamp.isoformat() + "Z",
+            'user_name': author,
+            'content': content,
+            'file_name': file_name
+        }, ensure_ascii=False) + "\n"
+
+def _csv_lines(room, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush(values):
+        writer.writerow(values)
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    yield flush(['message_id', 'timestamp', 'user_name', 'content', 'file_name'])
+    for message_id, timestamp, author, content, file_name in rows:
+        yield flush([message_id, timestamp.isoformat() + "Z", author, content or '', file_name or ''])
+
+_WRITERS = {'txt': _txt_lines, 'jsonl': _jsonl_lines, 'csv': _csv_lines}
+
+def _gzip(chunks):
+    # wbits=31 produces a gzip container rather than a raw zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _batched(lines, size=64 * 1024):
+    """Joins small lines into ~64KB chunks so the response isn't written a line at a time."""
+    batch, length = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        batch.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(batch)
+            batch, length = [], 0
+    if batch:
+        yield b''.join(batch)
+
+def generate_export(room, export_format='txt', compress=False):
+    """
+    Returns a generator of bytes for a room's export in the given format
+    ('txt', 'jsonl' or 'csv'), optionally gzip-compressed.
+    """
+    if export_format not in _WRITERS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    chunks = _batched(_WRITERS[export_format](room, iter_message_rows(room.id)))
+    return _gzip(chunks) if compress else chunks
@@ -0,0 +1,95 @@
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, selectinload
+from models import ChatMessage, MessageReaction
+from utils import encode_cursor, decode_cursor
+from link_previews import serialize_preview
+
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+def get_history_page(room_id, before=None, after=None, since=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns one page of a room's messages in chronological order, walking the
+    (room_id, timestamp, id) index instead of counting rows with OFFSET.
+
+    `before`/`after` are cursor tokens; without either the latest page is returned.
+    `since` hides anything older (e.g. the user's ChatClearTimestamp).
+    Authors, reply targets and forward sources are loaded with the page, so serializing
+    it takes a fixed number of queries; pass the result to `load_reactions` for reactions.
+    Returns (messages, has_more).
+    """
+    query = ChatMessage.query.options(
+        joinedload(ChatMessage.author),
+        joinedload(ChatMessage.forwarded_from),
+        joinedload(ChatMessage.replied_to_status),
+        joinedload(ChatMessage.link_preview),
+        selectinload(ChatMessage.replied_to).joinedload(ChatMessage.author),
+    ).filter(ChatMessage.room_id == room_id)
+    if since is not None:
+        query = query.filter(ChatMessage.timestamp >= since)
+
+    if after is not None:
+        timestamp, message_id = decode_cursor(after)
+        query = query.filter(or_(
+            ChatMessage.timestamp > timestamp,
+            and_(ChatMessage.timestamp == timestamp, ChatMessage.id > message_id)
+        )).order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc())
+    else:
+        if before is not None:
+            timestamp, message_id = decode_cursor(before)
+            query = query.filter(or_(
+                ChatMessage.timestamp < timestamp,
+                and_(ChatMessage.timestamp == timestamp, ChatMessage.id < message_id)
+            ))
+        query = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+
+    # Fetch one extra row to know whether another page exists
+    messages = query.limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+    return messages, has_more
+
+def load_reactions(messages):
+    """Loads the reactions of several messages in one query: {message_id: [MessageReaction]}."""
+    reactions = {msg.id: [] for msg in messages}
+    if reactions:
+        for reaction in MessageReaction.query.options(joinedload(MessageReaction.user)).filter(
+            MessageReaction.message_id.in_(list(reactions))
+        ).order_by(MessageReaction.id):
+            reactions[reaction.message_id].append(reaction)
+    return reactions
+
+def serialize_message(msg, reactions=()):
+    """The message payload shared by the 'message' socket event and the history endpoints."""
+    replied_to_data = msg.replied_to_quote
+    if msg.replied_to:
+        replied_to_data = {
+            'user_name': msg.replied_to.author.name,
+            'content': msg.replied_to.content
+        }
+
+    forwarded_from_data = None
+    if msg.is_forwarded and msg.forwarded_from:
+        forwarded_from_data = {
+            'name': msg.forwarded_from.name
+        }
+
+    return {
+        'user_name': msg.author.name,
+        'user_id': msg.user_id,
+        'user_profile_pic': msg.author.profile_pic or 'default.jpg',
+        'content': msg.content,
+        'file_path': msg.file_path,
+        'file_name': msg.file_name,
+        'timestamp': msg.timestamp.isoformat() + "Z",
+        'room_id': msg.room_id,
+        'message_id': msg.id,
+        'is_pinned': msg.is_pinned,
+        'reactions': [{'user_name': r.user.name, 'reaction': r.reaction} for r in reactions],
+        'replied_to': replied_to_data,
+        'is_forwarded': msg.is_forwarded,
+        'forwarded_from': forwarded_from_data,
+        'link_preview': serialize_preview(msg.link_preview)
+    }
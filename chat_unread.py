@@ -0,0 +1,239 @@
+from datetime import datetime
+from sqlalchemy import func, and_, case, exists, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import ChatMessage, MutedRoom, UserLastRead, RoomUnreadCounter, ChatClearTimestamp
+
+def get_room_summaries(user_id, room_ids):
+    """
+    Returns the last message, unread count and mute state for each of a user's rooms.
+    Runs a fixed number of queries no matter how many rooms are passed in:
+    {room_id: {'last_message': ChatMessage or None, 'unread_count': int, 'is_muted': bool}}
+    """
+    room_ids = list(room_ids)
+    if not room_ids:
+        return {}
+
+    # Last message per room, using the highest message id as "latest"
+    last_ids = db.session.query(func.max(ChatMessage.id).label('id')).filter(
+        ChatMessage.room_id.in_(room_ids)
+    ).group_by(ChatMessage.room_id).subquery()
+    last_messages = {
+        msg.room_id: msg for msg in ChatMessage.query.join(last_ids, ChatMessage.id == last_ids.c.id).all()
+    }
+
+    muted_room_ids = {
+        room_id for (room_id,) in db.session.query(MutedRoom.room_id).filter(
+            MutedRoom.user_id == user_id,
+            MutedRoom.room_id.in_(room_ids)
+        )
+    }
+
+    unread_counts = dict(db.session.query(RoomUnreadCounter.room_id, RoomUnreadCounter.unread_count).filter(
+        RoomUnreadCounter.user_id == user_id,
+        RoomUnreadCounter.room_id.in_(room_ids)
+    ).all())
+
+    # Rooms without a counter yet are counted once from UserLastRead and then seeded,
+    # after which the counter is kept up to date incrementally by the chat events.
+    # Seeding happens in the caller's transaction; commit it to keep the counters.
+    missing_room_ids = [room_id for room_id in room_ids if room_id not in unread_counts]
+    if missing_room_ids:
+        counted = _count_unread_since_last_read(user_id, missing_room_ids)
+        unread_counts.update(counted)
+        _seed_counters(user_id, counted)
+
+    return {
+        room_id: {
+            'last_message': last_messages.get(room_id),
+            'unread_count': unread_counts.get(room_id, 0),
+            'is_muted': room_id in muted_room_ids
+        } for room_id in room_ids
+    }
+
+def get_total_unread_count(user_id, room_ids):
+    """Returns the total number of unread messages across the given rooms."""
+    summaries = get_room_summaries(user_id, room_ids)
+    return sum(summary['unread_count'] for summary in summaries.values())
+
+def increment_unread_counts(room_id, sender_id):
+    """
+    Bumps the unread counter of every other user who has one for this room.
+    Does not commit; call it in the same transaction that adds the message.
+    """
+    RoomUnreadCounter.query.filter(
+        RoomUnreadCounter.room_id == room_id,
+        RoomUnreadCounter.user_id != sender_id
+    ).update({RoomUnreadCounter.unread_count: RoomUnreadCounter.unread_count + 1}, synchronize_session=False)
+
+def _advance_watermark(user_id, room_id, message_id):
+    """
+    Moves a user's read watermark in a room up to message_id, never back, with a single upsert.
+    A message_id of None leaves the watermark where it is but still records the read time.
+    """
+    now = datetime.utcnow()
+    table = UserLastRead.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table).values(user_id=user_id, room_id=room_id, last_read_message_id=message_id,
+                                         last_read_timestamp=now)
+        newer = statement.excluded.last_read_message_id > func.coalesce(table.c.last_read_message_id, 0)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'room_id'],
+            set_={
+                'last_read_message_id': case((newer, statement.excluded.last_read_message_id), else_=table.c.last_read_message_id),
+                'last_read_timestamp': now,
+            }
+        ))
+        return
+
+    values = {'last_read_timestamp': now}
+    if message_id is not None:
+        values['last_read_message_id'] = case(
+            (func.coalesce(table.c.last_read_message_id, 0) < message_id, message_id), else_=table.c.last_read_message_id
+        )
+    result = db.session.execute(update(table).where(table.c.user_id == user_id, table.c.room_id == room_id).values(**values))
+    if result.rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(user_id=user_id, room_id=room_id,
+                                                         last_read_message_id=message_id, last_read_timestamp=now))
+        except IntegrityError:
+            # Created by a concurrent read; move that one instead
+            db.session.execute(update(table).where(table.c.user_id == user_id, table.c.room_id == room_id).values(**values))
+
+def mark_read(user_id, room_id, message_id):
+    """
+    Advances a user's read watermark in a room to message_id and recounts their unread counter
+    from it. Returns the new watermark, or None if the user had already read that far (nothing
+    is written then). Does not commit.
+    """
+    previous = db.session.query(UserLastRead.last_read_message_id).filter_by(user_id=user_id, room_id=room_id).scalar()
+    if previous is not None and message_id <= previous:
+        return None
+    _advance_watermark(user_id, room_id, message_id)
+
+    unread = select(func.count(ChatMessage.id)).where(
+        ChatMessage.room_id == room_id,
+        ChatMessage.user_id != user_id,
+        ChatMessage.id > message_id,
+        ~_cleared_by(user_id)
+    ).scalar_subquery()
+    RoomUnreadCounter.query.filter_by(user_id=user_id, room_id=room_id).update(
+        {RoomUnreadCounter.unread_count: unread}, synchronize_session=False
+    )
+    return message_id
+
+def reset_unread_count(user_id, room_id):
+    """
+    Marks a room as read for a user up to its latest message, resetting the counter.
+    Returns the new watermark, or None if it didn't move. Does not commit.
+    """
+    previous = db.session.query(UserLastRead.last_read_message_id).filter_by(user_id=user_id, room_id=room_id).scalar()
+    latest = db.session.query(func.max(ChatMessage.id)).filter(ChatMessage.room_id == room_id).scalar()
+    _advance_watermark(user_id, room_id, latest)
+
+    counter = RoomUnreadCounter.query.filter_by(user_id=user_id, room_id=room_id).first()
+    if counter:
+        counter.unread_count = 0
+    else:
+        db.session.add(RoomUnreadCounter(user_id=user_id, room_id=room_id, unread_count=0))
+    return latest if latest is not None and latest > (previous or 0) else None
+
+def clear_unread_count(user_id, room_id):
+    """
+    Zeroes a user's counter for a room they cleared, leaving the read watermark alone: clearing
+    hides messages from the user without reading them, so it sends no receipts. Recounts skip
+    what the ChatClearTimestamp hides. Does not commit.
+    """
+    counter = RoomUnreadCounter.query.filter_by(user_id=user_id, room_id=room_id).first()
+    if counter:
+        counter.unread_count = 0
+    else:
+        db.session.add(RoomUnreadCounter(user_id=user_id, room_id=room_id, unread_count=0))
+
+def _cleared_by(user_id):
+    """Whether the user cleared the ChatMessage's room after it was sent."""
+    return exists().where(
+        ChatClearTimestamp.user_id == user_id,
+        ChatClearTimestamp.room_id == ChatMessage.room_id,
+        ChatClearTimestamp.cleared_at >= ChatMessage.timestamp
+    )
+
+def read_upto(room_id, exclude_user_id):
+    """The furthest read watermark in a room among users other than `exclude_user_id`, for read receipts."""
+    return db.session.query(func.max(UserLastRead.last_read_message_id)).filter(
+        UserLastRead.room_id == room_id,
+        UserLastRead.user_id != exclude_user_id
+    ).scalar() or 0
+
+def decrement_unread_counts(message):
+    """
+    Takes a deleted message back out of the counters of users who had neither read nor cleared it yet.
+    Call it before deleting the message; does not commit.
+    """
+    read_it = db.session.query(UserLastRead.user_id).filter(
+        UserLastRead.room_id == message.room_id,
+        UserLastRead.last_read_message_id >= message.id
+    )
+    cleared_it = db.session.query(ChatClearTimestamp.user_id).filter(
+        ChatClearTimestamp.room_id == message.room_id,
+        ChatClearTimestamp.cleared_at >= message.timestamp
+    )
+    RoomUnreadCounter.query.filter(
+        RoomUnreadCounter.room_id == message.room_id,
+        RoomUnreadCounter.user_id != message.user_id,
+        RoomUnreadCounter.unread_count > 0,
+        RoomUnreadCounter.user_id.notin_(read_it),
+        RoomUnreadCounter.user_id.notin_(cleared_it)
+    ).update({RoomUnreadCounter.unread_count: RoomUnreadCounter.unread_count - 1}, synchronize_session=False)
+
+def invalidate_unread_counts(room_ids):
+    """
+    Drops the counters of the given rooms after a bulk delete, so they are recounted
+    from UserLastRead the next time they are read. Does not commit.
+    """
+    room_ids = list(room_ids)
+    if room_ids:
+        RoomUnreadCounter.query.filter(RoomUnreadCounter.room_id.in_(room_ids)).delete(synchronize_session=False)
+
+def _count_unread_since_last_read(user_id, room_ids):
+    """Counts messages past each read watermark with a single grouped query joined against UserLastRead."""
+    rows = db.session.query(ChatMessage.room_id, func.count(ChatMessage.id)).outerjoin(
+        UserLastRead,
+        and_(UserLastRead.room_id == ChatMessage.room_id, UserLastRead.user_id == user_id)
+    ).filter(
+        ChatMessage.room_id.in_(room_ids),
+        ChatMessage.user_id != user_id,
+        (UserLastRead.id.is_(None)) | (ChatMessage.id > func.coalesce(UserLastRead.last_read_message_id, 0)),
+        ~_cleared_by(user_id)
+    ).group_by(ChatMessage.room_id).all()
+
+    counts = {room_id: 0 for room_id in room_ids}
+    counts.update(dict(rows))
+    return counts
+
+def _seed_counters(user_id, counts):
+    """
+    Inserts counters for rooms that don't have one yet, leaving alone any row another
+    request seeded first. Runs in a SAVEPOINT so a conflict never rolls back the caller's work.
+    """
+    rows = [{'user_id': user_id, 'room_id': room_id, 'unread_count': count} for room_id, count in counts.items()]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        with db.session.begin_nested():
+            db.session.execute(
+                insert(RoomUnreadCounter).values(rows).on_conflict_do_nothing(index_elements=['user_id', 'room_id'])
+            )
+        return
+
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(RoomUnreadCounter.__table__.insert().values(**row))
+        except IntegrityError:
+            # Already seeded by a concurrent request; theirs is just as valid.
+            pass
@@ -0,0 +1,152 @@
+import hashlib
+import mimetypes
+import os
+import secrets
+from datetime import datetime, timedelta
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from extensions import db
+from models import UploadSession
+
+COPY_BUFFER = 64 * 1024
+
+# Clients send chunks of at most this many bytes, so each request stays under MAX_CONTENT_LENGTH
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+PURPOSES = ('post_media', 'library', 'assignment')
+
+def allowed_extensions(purpose):
+    """File extensions the save helper behind `purpose` accepts, or None if it takes anything."""
+    if purpose == 'post_media':
+        from utils import UPLOAD_FILE_EXTENSIONS
+        return UPLOAD_FILE_EXTENSIONS
+    if purpose == 'library':
+        from instructor_routes import LIBRARY_FILE_EXTENSIONS
+        return LIBRARY_FILE_EXTENSIONS
+    return None
+
+def chunk_size():
+    return current_app.config.get('CHUNKED_UPLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+def max_size():
+    return current_app.config.get('CHUNKED_UPLOAD_MAX_SIZE', DEFAULT_MAX_SIZE)
+
+def part_path(upload_id):
+    """Where the bytes received so far are kept: the instance folder, never anywhere served."""
+    folder = current_app.config.get('CHUNKED_UPLOAD_FOLDER') or os.path.join(current_app.instance_path, 'chunked_uploads')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f'{upload_id}.part')
+
+def start_upload(user_id, purpose, filename, total_size, checksum):
+    """Creates an upload session and its empty partial file. Does not commit."""
+    upload = UploadSession(
+        id=secrets.token_hex(16),
+        user_id=user_id,
+        purpose=purpose,
+        filename=filename,
+        total_size=total_size,
+        checksum=checksum.lower(),
+        received=0
+    )
+    open(part_path(upload.id), 'wb').close()
+    db.session.add(upload)
+    return upload
+
+def write_chunk(upload, offset, stream):
+    """
+    Streams a chunk into the partial file at `offset`, COPY_BUFFER bytes at a time. Chunks are
+    written in place rather than appended, so a retried or duplicated chunk rewrites the same
+    bytes. Returns the number of bytes written, or None if the chunk runs past the declared size.
+    """
+    written = 0
+    with open(part_path(upload.id), 'r+b') as f:
+        f.seek(offset)
+        for chunk in iter(lambda: stream.read(COPY_BUFFER), b''):
+            if offset + written + len(chunk) > upload.total_size:
+                return None
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+def advance(upload, offset, written):
+    """
+    Moves the session's offset past a written chunk, unless another request already moved it.
+    Commits. Returns True if this request's chunk was recorded.
+    """
+    recorded = UploadSession.query.filter_by(id=upload.id, received=offset).update(
+        {'received': offset + written, 'updated_at': datetime.utcnow()}, synchronize_session=False
+    )
+    db.session.commit()
+    db.session.refresh(upload)
+    return recorded == 1
+
+def _checksum(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _save(upload, file):
+    if upload.purpose == 'post_media':
+        from utils import save_upload_file
+        return save_upload_file(file, 'media', max_size=max_size())
+    if upload.purpose == 'library':
+        from instructor_routes import save_library_file
+        return save_library_file(file)
+    from routes import save_assignment_file
+    return save_assignment_file(file)
+
+def finish_upload(upload):
+    """
+    Verifies the assembled file against the client's SHA-256 and hands it to the save helper
+    for its purpose, exactly as if it had arrived in one request. Does not commit.
+    Returns (saved path, None) or (None, error message).
+    """
+    file_path = part_path(upload.id)
+    if upload.received != upload.total_size:
+        return None, f'Upload is incomplete: {upload.received} of {upload.total_size} bytes received.'
+    if _checksum(file_path) != upload.checksum:
+        # Start over; a chunk was corrupted somewhere along the way
+        upload.received = 0
+        open(file_path, 'wb').close()
+        return None, 'Checksum mismatch; the upload has to be restarted.'
+
+    content_type = mimetypes.guess_type(upload.filename)[0] or 'application/octet-stream'
+    with open(file_path, 'rb') as f:
+        saved_path = _save(upload, FileStorage(stream=f, filename=upload.filename, content_type=content_type))
+    if not saved_path:
+        return None, 'The file was rejected.'
+
+    os.remove(file_path)
+    upload.status = 'complete'
+    upload.result_path = saved_path
+    return saved_path, None
+
+def claim_upload(upload_id, user_id, purpose):
+    """
+    A finished upload of the user's, for a form that names it instead of attaching a file; its
+    result_path is what the save helper returned. Each upload can be claimed once.
+    Does not commit. Returns None if there's nothing to claim.
+    """
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=user_id, purpose=purpose, status='complete').first()
+    if upload is None:
+        return None
+    upload.status = 'claimed'
+    return upload
+
+def clean_stale_uploads(max_age=timedelta(hours=24)):
+    """Deletes sessions left unfinished or unclaimed for `max_age`, with their partial files. Commits."""
+    cutoff = datetime.utcnow() - max_age
+    stale = UploadSession.query.filter(UploadSession.status != 'claimed', UploadSession.updated_at < cutoff).all()
+    for upload in stale:
+        file_path = part_path(upload.id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        db.session.delete(upload)
+    UploadSession.query.filter(UploadSession.status == 'claimed', UploadSession.updated_at < cutoff).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return len(stale)
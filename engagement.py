@@ -0,0 +1,76 @@
+from sqlalchemy import event, func, select, update
+from extensions import db
+from models import Like, GenericComment, Share, Post, Reel, Project, CreativeWork
+
+# target_type -> model carrying the stored counters
+COUNTED = {
+    'post': Post,
+    'reel': Reel,
+    'project': Project,
+    'creative_work': CreativeWork,
+}
+
+def _adjust(connection, target_type, target_id, column, delta):
+    model = COUNTED.get(target_type)
+    if model is None:
+        return
+    table = model.__table__
+    connection.execute(
+        update(table).where(table.c.id == target_id).values({column: table.c[column] + delta})
+    )
+
+# The counters are updated with SQL on the flush's own connection, so they commit or roll
+# back together with the row that changed them. Bulk `query.delete()`s skip these events;
+# run `flask reconcile-engagement-counters` after those.
+
+@event.listens_for(Like, 'after_insert')
+def _like_added(mapper, connection, like):
+    _adjust(connection, like.target_type, like.target_id, 'like_count', 1)
+
+@event.listens_for(Like, 'after_delete')
+def _like_removed(mapper, connection, like):
+    _adjust(connection, like.target_type, like.target_id, 'like_count', -1)
+
+@event.listens_for(GenericComment, 'after_insert')
+def _comment_added(mapper, connection, comment):
+    _adjust(connection, comment.target_type, comment.target_id, 'comment_count', 1)
+
+@event.listens_for(GenericComment, 'after_delete')
+def _comment_removed(mapper, connection, comment):
+    _adjust(connection, comment.target_type, comment.target_id, 'comment_count', -1)
+
+@event.listens_for(Share, 'after_insert')
+def _share_added(mapper, connection, share):
+    _adjust(connection, 'post', share.post_id, 'share_count', 1)
+
+@event.listens_for(Share, 'after_delete')
+def _share_removed(mapper, connection, share):
+    _adjust(connection, 'post', share.post_id, 'share_count', -1)
+
+def _actual_counts(target_type, table):
+    """(column, correlated COUNT(*) subquery) for every counter stored on `table`."""
+    counts = [
+        ('like_count', select(func.count()).where(
+            Like.target_type == target_type, Like.target_id == table.c.id).scalar_subquery()),
+        ('comment_count', select(func.count()).where(
+            GenericComment.target_type == target_type, GenericComment.target_id == table.c.id).scalar_subquery()),
+    ]
+    if 'share_count' in table.c:
+        counts.append(('share_count', select(func.count()).where(Share.post_id == table.c.id).scalar_subquery()))
+    return counts
+
+def reconcile_counters(kinds=None):
+    """
+    Recomputes stored counters from the Like, GenericComment and Share tables and fixes any
+    that drifted. Does not commit. Returns {target_type: number of counters corrected}.
+    """
+    corrected = {}
+    for target_type in kinds or COUNTED:
+        table = COUNTED[target_type].__table__
+        corrected[target_type] = 0
+        for column, actual in _actual_counts(target_type, table):
+            result = db.session.execute(
+                update(table).where(table.c[column] != actual).values({column: actual})
+            )
+            corrected[target_type] += result.rowcount
+    return corrected
@@ -0,0 +1,135 @@
+import os
+from collections import Counter
+from datetime import datetime
+import humanize
+from flask import current_app
+from sqlalchemy import delete, select, update
+from extensions import db
+from models import (Status, StatusView, Story, StoryView, Poll, PollOption, PollVote, LinkPreview, ChatMessage,
+                    Post)
+from blob_store import is_blob_path, release_references, remove_unreferenced
+from status_tray import status_tray
+
+DEFAULT_BATCH_SIZE = 500
+
+def _expired_ids(model, now, batch_size):
+    """The next batch of expired rows, oldest first, read from the expires_at index."""
+    return db.session.execute(
+        select(model.id).where(model.expires_at <= now).order_by(model.expires_at).limit(batch_size)
+    ).scalars().all()
+
+def _delete(model, *criteria):
+    return db.session.execute(delete(model).where(*criteria).execution_options(synchronize_session=False)).rowcount
+
+def _remove_legacy_files(paths):
+    """
+    Deletes files from the old flat upload folders once no status or story refers to them.
+    Returns (files deleted, bytes freed).
+    """
+    static_folder = os.path.normpath(current_app.static_folder)
+    deleted = freed = 0
+    for path in set(paths):
+        if db.session.query(Status.id).filter(Status.content == path).first() or \
+                db.session.query(Story.id).filter(Story.media_url == path).first():
+            continue
+        file_path = os.path.normpath(os.path.join(static_folder, path))
+        if not file_path.startswith(static_folder + os.sep) or not os.path.isfile(file_path):
+            continue
+        freed += os.path.getsize(file_path)
+        os.remove(file_path)
+        deleted += 1
+    return deleted, freed
+
+def _media_paths(values):
+    blobs, legacy = [], []
+    for value in values:
+        if is_blob_path(value):
+            blobs.append(value)
+        elif value and not value.startswith(('http://', 'https://')):
+            legacy.append(value)
+    return blobs, legacy
+
+def _reap_statuses(now, batch_size, report):
+    status_ids = _expired_ids(Status, now, batch_size)
+    if not status_ids:
+        return 0
+    rows = db.session.execute(
+        select(Status.content_type, Status.content, Status.link_preview_id).where(Status.id.in_(status_ids))
+    ).all()
+    poll_ids = select(Poll.id).where(Poll.status_id.in_(status_ids)).scalar_subquery()
+
+    report['status_views'] += _delete(StatusView, StatusView.status_id.in_(status_ids))
+    _delete(PollVote, PollVote.poll_id.in_(poll_ids))
+    _delete(PollOption, PollOption.poll_id.in_(poll_ids))
+    report['polls'] += _delete(Poll, Poll.status_id.in_(status_ids))
+    # Replies stay in the chat, without the status they quoted
+    db.session.execute(update(ChatMessage).where(ChatMessage.replied_to_status_id.in_(status_ids))
+                       .values(replied_to_status_id=None).execution_options(synchronize_session=False))
+
+    blobs, legacy = _media_paths(content for content_type, content, _ in rows
+                                 if content_type in ('image', 'video', 'voice'))
+    release_references(blobs)
+    report['statuses'] += _delete(Status, Status.id.in_(status_ids))
+    report['link_previews'] += _remove_orphaned_previews({preview_id for _, _, preview_id in rows if preview_id})
+    _remove_media(blobs, legacy, report)
+    return len(status_ids)
+
+def _reap_stories(now, batch_size, report):
+    story_ids = _expired_ids(Story, now, batch_size)
+    if not story_ids:
+        return 0
+    media_urls = db.session.execute(select(Story.media_url).where(Story.id.in_(story_ids))).scalars().all()
+
+    report['story_views'] += _delete(StoryView, StoryView.story_id.in_(story_ids))
+    blobs, legacy = _media_paths(media_urls)
+    release_references(blobs)
+    report['stories'] += _delete(Story, Story.id.in_(story_ids))
+    _remove_media(blobs, legacy, report)
+    return len(story_ids)
+
+def _remove_orphaned_previews(preview_ids):
+    """Deletes the given link previews if nothing links to them any more."""
+    if not preview_ids:
+        return 0
+    return _delete(
+        LinkPreview, LinkPreview.id.in_(preview_ids),
+        ~LinkPreview.id.in_(select(Status.link_preview_id).where(Status.link_preview_id.in_(preview_ids))),
+        ~LinkPreview.id.in_(select(ChatMessage.link_preview_id).where(ChatMessage.link_preview_id.in_(preview_ids))),
+        ~LinkPreview.id.in_(select(Post.link_preview_id).where(Post.link_preview_id.in_(preview_ids))),
+    )
+
+def _remove_media(blobs, legacy, report):
+    for files, freed in (remove_unreferenced(blobs), _remove_legacy_files(legacy)):
+        report['files'] += files
+        report['bytes'] += freed
+
+def reap_expired(batch_size=DEFAULT_BATCH_SIZE, max_batches=None, now=None):
+    """
+    Deletes statuses and stories whose expires_at has passed, batch_size rows at a time (oldest
+    first, walking the expires_at index), together with their views, status polls and link
+    previews nothing else uses. Media files go too once no other row references them: blobs
+    through their reference counts, files in the old upload folders by looking for other
+    statuses and stories that use the same path. Commits after each batch, so a run can be
+    stopped at any point. Returns a Counter of rows deleted per kind, plus 'files' and 'bytes'
+    for the media reclaimed.
+    """
+    now = now or datetime.utcnow()
+    report = Counter({key: 0 for key in ('statuses', 'status_views', 'polls', 'link_previews',
+                                        'stories', 'story_views', 'files', 'bytes')})
+    for reap in (_reap_statuses, _reap_stories):
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            reaped = reap(now, batch_size, report)
+            db.session.commit()
+            batches += 1
+            if reaped < batch_size:
+                break
+    if report['statuses']:
+        status_tray.invalidate()
+    return report
+
+def summarize(report):
+    """One line describing a reap_expired report."""
+    return (f"Deleted {report['statuses']} statuses ({report['status_views']} views, {report['polls']} polls), "
+            f"{report['stories']} stories ({report['story_views']} views) and {report['link_previews']} link previews; "
+            f"removed {report['files']} files, {humanize.naturalsize(report['bytes'])} reclaimed.")
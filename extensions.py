@@ -1,7 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_socketio import SocketIO
+from presence import Presence
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 socketio = SocketIO()
+presence = Presence()
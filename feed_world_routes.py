@@ -1,10 +1,16 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort
 from flask_login import login_required, current_user
 from models import db, Post, User, Like, GenericComment, Community, ReportedPost, follow as follow_table, Story, StoryView, CloseFriend, MutedStory, BlockedUser
 from werkzeug.utils import secure_filename
 import os
-from utils import save_upload_file
-from sqlalchemy.orm import aliased
+from utils import save_upload_file, encode_cursor
+from timeline import get_timeline_page, fan_out_post, backfill_author, remove_author
+from sqlalchemy.orm import aliased, joinedload
+from search_index import search_index
+from storage import within_quota, upload_size
+from chunked_uploads import claim_upload
+from image_pipeline import is_image_path
+from link_previews import link_previewer
 from datetime import datetime
 
 feed = Blueprint('feed', __name__)
@@ -15,8 +21,11 @@ def home_feed():
     user_agent = request.headers.get('User-Agent', '').lower()
     is_mobile = 'iphone' in user_agent or 'android' in user_agent or 'mobi' in user_agent
 
-    followed_users_ids = [user.id for user in current_user.followed]
-    posts = Post.query.filter(Post.user_id.in_(followed_users_ids)).order_by(Post.timestamp.desc()).all()
+    try:
+        posts, has_more = get_timeline_page(current_user.id, before=request.args.get('before'))
+    except ValueError:
+        abort(400)
+    next_cursor = encode_cursor(posts[-1]) if has_more else None
 
     # Story fetching logic
     muted_story_user_ids = [m.muted_id for m in current_user.muted_stories_users]
@@ -51,9 +60,9 @@ def home_feed():
         stories_by_user[story.author].append(story)
 
     if is_mobile:
-        return render_template('feed/home_mobile.html', posts=posts, stories_by_user=stories_by_user)
+        return render_template('feed/home_mobile.html', posts=posts, stories_by_user=stories_by_user, next_cursor=next_cursor)
     else:
-        return render_template('feed/home.html', posts=posts, stories_by_user=stories_by_user)
+        return render_template('feed/home.html', posts=posts, stories_by_user=stories_by_user, next_cursor=next_cursor)
 
 @feed.route('/feed/search_mobile')
 @login_required
@@ -70,25 +79,36 @@ def create_post_page():
 @login_required
 def create_post():
     content = request.form.get('content')
-    media_files = request.files.getlist('media')
-    if not content and not media_files:
+    media_files = [file for file in request.files.getlist('media') if file.filename != '']
+    # Large files sent ahead through the resumable upload API, already saved
+    uploads = [claim_upload(upload_id, current_user.id, 'post_media') for upload_id in request.form.getlist('upload_id')]
+    uploads = [upload for upload in uploads if upload is not None]
+    if not content and not media_files and not uploads:
         flash('Post cannot be empty.', 'danger')
         return redirect(url_for('feed.home_feed'))
 
     media_urls = []
     media_type = None
-    if media_files and media_files[0].filename != '':
+    if media_files or uploads:
+        incoming = sum(upload_size(file) for file in media_files) + sum(upload.total_size for upload in uploads)
+        if not within_quota(current_user, incoming):
+            flash('These files would take you over your storage quota.', 'danger')
+            return redirect(url_for('feed.home_feed'))
         for file in media_files:
             folder = 'images' if file.mimetype.startswith('image') else 'videos'
             saved_path = save_upload_file(file, folder)
             media_urls.append(saved_path)
+        media_urls += [upload.result_path for upload in uploads]
         if len(media_urls) > 1:
             media_type = 'images'
         elif len(media_urls) == 1:
-            media_type = 'image' if media_files[0].mimetype.startswith('image') else 'video'
+            media_type = 'image' if is_image_path(media_urls[0]) else 'video'
 
     new_post = Post(user_id=current_user.id, content=content, media_type=media_type, media_url=media_urls)
     db.session.add(new_post)
+    if not media_urls:
+        link_previewer.attach(new_post, content)
+    fan_out_post(new_post)
     db.session.commit()
     flash('Your post has been created!', 'success')
     return redirect(url_for('feed.home_feed'))
@@ -191,6 +211,7 @@ def follow(user_id):
         flash('You cannot follow yourself.', 'warning')
         return redirect(request.referrer or url_for('feed.home_feed'))
     current_user.follow(user_to_follow)
+    backfill_author(current_user.id, user_to_follow.id)
     db.session.commit()
     flash(f'You are now following {user_to_follow.name}.', 'success')
     return redirect(request.referrer or url_for('feed.home_feed'))
@@ -203,6 +224,7 @@ def unfollow(user_id):
         flash('You cannot unfollow yourself.', 'warning')
         return redirect(request.referrer or url_for('feed.home_feed'))
     current_user.unfollow(user_to_unfollow)
+    remove_author(current_user.id, user_to_unfollow.id)
     db.session.commit()
     flash(f'You have unfollowed {user_to_unfollow.name}.', 'success')
     return redirect(request.referrer or url_for('feed.home_feed'))
@@ -240,11 +262,15 @@ def search():
     if not query:
         return redirect(url_for('feed.home_feed'))
 
-    # Simple search for users and posts
-    users = User.query.filter(User.name.ilike(f'%{query}%')).all()
-    posts = Post.query.filter(Post.content.ilike(f'%{query}%')).all()
+    page = request.args.get('page', 1, type=int)
 
-    return render_template('feed/search_results.html', query=query, users=users, posts=posts)
+    # Simple search for users, ranked full-text search for posts
+    users = User.query.filter(User.name.ilike(f'%{query}%')).limit(20).all()
+    posts = search_index.filter(
+        Post.query.options(joinedload(Post.author)), 'post', query
+    ).order_by(Post.timestamp.desc()).paginate(page=page, per_page=20, error_out=False)
+
+    return render_template('feed/search_results.html', query=query, users=users, posts=posts.items, posts_pagination=posts)
 
 @feed.route('/feed/suggestions', methods=['GET', 'POST'])
 @login_required
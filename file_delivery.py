@@ -0,0 +1,183 @@
+import atexit
+import mimetypes
+import os
+import threading
+from collections import Counter
+from flask import current_app, request, send_file, abort, url_for
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from sqlalchemy import update
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file as send_file_offloaded
+from extensions import db
+from models import LibraryMaterial
+
+# 'direct' streams from the worker; 'x-accel' (nginx) and 'x-sendfile' (Apache, lighttpd) only
+# send headers and let the front-end server transfer the file, including Range requests
+DELIVERY_MODES = ('direct', 'x-accel', 'x-sendfile')
+
+# nginx location marked `internal` whose alias is the static folder
+DEFAULT_ACCEL_PREFIX = '/protected/'
+DEFAULT_URL_TTL = 300
+
+def _resolve(relative_path):
+    """Absolute path of a file under the static folder, or 404 if it's missing or outside it."""
+    file_path = safe_join(current_app.static_folder, relative_path) if relative_path else None
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    return file_path
+
+def send_protected(relative_path, download_name=None, as_attachment=True):
+    """
+    Sends a file from the static folder once the caller has checked access to it. Direct
+    delivery answers Range and If-Range itself, so interrupted downloads resume; with FILE_DELIVERY
+    set to 'x-accel' or 'x-sendfile' the worker returns immediately and the front-end server
+    sends the bytes.
+    """
+    file_path = _resolve(relative_path)
+    mode = current_app.config.get('FILE_DELIVERY', 'direct')
+    if mode == 'direct':
+        return send_file(file_path, download_name=download_name, as_attachment=as_attachment, conditional=True)
+
+    response = send_file_offloaded(
+        file_path, request.environ, mimetype=mimetypes.guess_type(download_name or file_path)[0],
+        download_name=download_name, as_attachment=as_attachment, use_x_sendfile=True, conditional=False,
+        response_class=current_app.response_class
+    )
+    if mode == 'x-accel':
+        del response.headers['X-Sendfile']
+        del response.headers['Content-Length']
+        prefix = current_app.config.get('FILE_DELIVERY_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX)
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + relative_path.lstrip('/')
+    return response
+
+def starts_download():
+    """
+    Whether a request fetches a file from its first byte. Resumes (a Range, or an If-Range
+    retry, from a later offset) continue a download that was already counted.
+    """
+    return request.range is None or request.range.ranges[0][0] == 0
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='file-delivery')
+
+def url_ttl():
+    return current_app.config.get('FILE_URL_TTL', DEFAULT_URL_TTL)
+
+def signed_url(relative_path, download_name=None):
+    """
+    A link to a file that works without a session for FILE_URL_TTL seconds, for download
+    managers and players that resume with Range requests but don't send the user's cookies.
+    """
+    token = _serializer().dumps({'path': relative_path, 'name': download_name})
+    return url_for('main.signed_file', token=token, _external=True)
+
+def load_signed_url(token):
+    """(relative path, download name) from a signed_url token, or None if it's forged or expired."""
+    try:
+        data = _serializer().loads(token, max_age=url_ttl())
+    except (BadSignature, SignatureExpired):
+        return None
+    return data['path'], data.get('name')
+
+class DownloadCounter:
+    """
+    Write-behind library download counts.
+
+    `add` only bumps an in-memory counter, so a download never waits on a database write. A
+    background thread flushes the totals every DOWNLOAD_COUNT_FLUSH_INTERVAL seconds (sooner once
+    DOWNLOAD_COUNT_BATCH_SIZE downloads are pending) with one UPDATE per distinct increment, and
+    whatever is left is flushed at exit. DOWNLOAD_COUNT_FLUSH_INTERVAL = 0 writes through on each
+    download. Counts shown on the library pages may lag by up to one interval.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0
+        self.batch_size = 100
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._flusher = None
+        self._exit_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        with self._lock:
+            self.app = app
+            self.interval = app.config.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', 10)
+            self.batch_size = app.config.get('DOWNLOAD_COUNT_BATCH_SIZE', 100)
+            self._stopping = False
+            if not self._exit_registered:
+                atexit.register(self.shutdown)
+                self._exit_registered = True
+
+    def add(self, material_id, count=1):
+        with self._lock:
+            self._pending[material_id] += count
+            pending = sum(self._pending.values())
+        if self.interval <= 0:
+            self.flush()
+            return
+        self._start_flusher()
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def pending(self, material_id):
+        """Downloads of a material counted but not yet written."""
+        with self._lock:
+            return self._pending.get(material_id, 0)
+
+    def flush(self):
+        """Writes the pending counts. Returns the number of downloads written."""
+        if self.app is None:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+        by_increment = {}
+        for material_id, count in pending.items():
+            by_increment.setdefault(count, []).append(material_id)
+        table = LibraryMaterial.__table__
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                for count, material_ids in by_increment.items():
+                    connection.execute(
+                        update(table).where(table.c.id.in_(material_ids))
+                        .values(download_count=table.c.download_count + count)
+                    )
+        except Exception as e:
+            # Keep them for the next flush rather than lose them
+            with self._lock:
+                self._pending.update(pending)
+            print(f"Error flushing download counts: {e}")
+            return 0
+        return sum(pending.values())
+
+    def shutdown(self):
+        with self._lock:
+            flusher, self._flusher = self._flusher, None
+            self._stopping = True
+        self._wake.set()
+        if flusher is not None:
+            flusher.join()
+        self._wake.clear()
+        self.flush()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None or self._stopping:
+                return
+            self._flusher = threading.Thread(target=self._run, name='download-counter', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+download_counter = DownloadCounter()
@@ -0,0 +1,212 @@
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import insert
+from extensions import db
+from models import Question, Choice, Answer, ExamSubmission, QuizSubmission
+
+AUTO_GRADED_TYPES = ('multiple_choice_single', 'multiple_choice_multiple', 'true_false')
+
+# Everything needed to mark one question, detached from the session
+QuestionKey = namedtuple('QuestionKey', 'question_id question_type marks negative_marking correct_choices true_false_answer')
+
+class AnswerKey(namedtuple('AnswerKey', 'questions total_marks')):
+    """An immutable answer key for one exam or quiz: a tuple of QuestionKeys in question order."""
+
+    def mark(self, question, answer_data):
+        """
+        Marks awarded for one answer: full marks if correct, minus `negative_marking` if wrong,
+        nothing if left blank. Returns None for questions that are graded by hand.
+        """
+        if question.question_type not in AUTO_GRADED_TYPES:
+            return None
+        if question.question_type == 'multiple_choice_single':
+            selected = answer_data.get('selected_choice_id')
+            if selected is None:
+                return 0.0
+            correct = selected in question.correct_choices
+        elif question.question_type == 'multiple_choice_multiple':
+            selected = answer_data.get('selected_choices')
+            if not selected:
+                return 0.0
+            correct = set(selected) == question.correct_choices
+        else:
+            selected = answer_data.get('true_false_answer')
+            if selected is None:
+                return 0.0
+            correct = selected == question.true_false_answer
+        if correct:
+            return question.marks
+        return -(question.negative_marking or 0.0)
+
+    def percentage(self, marks_awarded):
+        """Turns a total of awarded marks into a 0-100 score; negative marking never takes it below 0."""
+        if self.total_marks <= 0:
+            return 0
+        return max(sum(marks_awarded), 0) / self.total_marks * 100
+
+def compile_answer_key(questions_query):
+    """Builds an AnswerKey from a query of Questions with two queries, whatever the number of questions."""
+    questions = questions_query.order_by(Question.id).all()
+    correct_choices = {question.id: set() for question in questions}
+    if questions:
+        for choice_id, question_id in db.session.query(Choice.id, Choice.question_id).filter(
+            Choice.question_id.in_(list(correct_choices)),
+            Choice.is_correct.is_(True)
+        ):
+            correct_choices[question_id].add(choice_id)
+
+    return AnswerKey(
+        questions=tuple(
+            QuestionKey(
+                question_id=question.id,
+                question_type=question.question_type,
+                marks=question.marks,
+                negative_marking=question.negative_marking,
+                correct_choices=frozenset(correct_choices[question.id]),
+                true_false_answer=question.true_false_answer
+            ) for question in questions
+        ),
+        total_marks=sum(question.marks for question in questions)
+    )
+
+class AnswerKeyCache:
+    """
+    Per-process cache of compiled answer keys for final exams and quizzes.
+
+    Code that adds, edits or removes questions or choices must call `invalidate` after
+    committing. Keys also expire after ANSWER_KEY_TTL seconds, which bounds how long another
+    worker can keep grading with an old key; `flask regrade` re-scores anything graded meanwhile.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._keys = {} # {('exam' | 'quiz', id): (AnswerKey, expires_at)}
+        self._generation = 0 # bumped on every eviction
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('ANSWER_KEY_TTL', 300)
+        self.clear()
+
+    def for_exam(self, exam):
+        return self._lookup(('exam', exam.id), lambda: compile_answer_key(Question.query.filter_by(exam_id=exam.id)))
+
+    def for_quiz(self, quiz):
+        return self._lookup(('quiz', quiz.id), lambda: compile_answer_key(Question.query.filter_by(quiz_id=quiz.id)))
+
+    def invalidate(self, exam_id=None, quiz_id=None):
+        with self._lock:
+            self._generation += 1
+            if exam_id is not None:
+                self._keys.pop(('exam', exam_id), None)
+            if quiz_id is not None:
+                self._keys.pop(('quiz', quiz_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._keys.clear()
+
+    def _lookup(self, cache_key, compile_key):
+        now = time.time()
+        with self._lock:
+            cached = self._keys.get(cache_key)
+            if cached and cached[1] > now:
+                return cached[0]
+            generation = self._generation
+
+        answer_key = compile_key()
+        with self._lock:
+            # Don't store a key that was compiled before an eviction landed
+            if generation == self._generation:
+                self._keys[cache_key] = (answer_key, now + self.ttl)
+        return answer_key
+
+answer_keys = AnswerKeyCache()
+
+def _exam_answer_data(question, form):
+    field = f'q_{question.question_id}'
+    if question.question_type == 'multiple_choice_single':
+        choice_id = form.get(field)
+        return {'selected_choice_id': int(choice_id)} if choice_id else {}
+    if question.question_type == 'multiple_choice_multiple':
+        choice_ids = form.getlist(field)
+        return {'selected_choices': [int(cid) for cid in choice_ids]} if choice_ids else {}
+    if question.question_type == 'true_false':
+        tf_answer = form.get(field)
+        return {'true_false_answer': tf_answer == 'True'} if tf_answer else {}
+    # short_answer, essay, file_upload are graded by hand, so just store the answer
+    return {'text_answer': form.get(field)}
+
+def grade_exam_submission(submission, answer_key, form):
+    """
+    Scores a submitted exam form against an answer key in memory and inserts all of its
+    Answer rows in one statement. Sets `submission.score`; does not commit.
+    """
+    rows = []
+    for question in answer_key.questions:
+        answer_data = _exam_answer_data(question, form)
+        rows.append(dict(
+            answer_data,
+            exam_submission_id=submission.id,
+            question_id=question.question_id,
+            marks_awarded=answer_key.mark(question, answer_data)
+        ))
+    if rows:
+        db.session.execute(insert(Answer), rows)
+    submission.score = answer_key.percentage(row['marks_awarded'] or 0 for row in rows)
+    return submission.score
+
+def grade_quiz_answers(answer_key, answers):
+    """Scores a quiz's {question id: choice id} answers. Returns the 0-100 score."""
+    marks = []
+    for question in answer_key.questions:
+        choice_id = answers.get(str(question.question_id))
+        answer_data = {'selected_choice_id': int(choice_id)} if choice_id else {}
+        marks.append(answer_key.mark(question, answer_data) or 0)
+    return answer_key.percentage(marks)
+
+def regrade_exam(exam):
+    """
+    Re-scores every submitted attempt at an exam against its current answer key. Hand-graded
+    answers keep the marks they were given. Does not commit. Returns the number of submissions.
+    """
+    answer_keys.invalidate(exam_id=exam.id)
+    answer_key = answer_keys.for_exam(exam)
+    questions = {question.question_id: question for question in answer_key.questions}
+    submissions = ExamSubmission.query.filter(
+        ExamSubmission.final_exam_id == exam.id,
+        ExamSubmission.status != 'in_progress'
+    ).all()
+    if not submissions:
+        return 0
+
+    answers_by_submission = {submission.id: [] for submission in submissions}
+    for answer in Answer.query.filter(Answer.exam_submission_id.in_(list(answers_by_submission))):
+        answers_by_submission[answer.exam_submission_id].append(answer)
+
+    for submission in submissions:
+        marks = []
+        for answer in answers_by_submission[submission.id]:
+            question = questions.get(answer.question_id)
+            if question is not None and question.question_type in AUTO_GRADED_TYPES:
+                answer.marks_awarded = answer_key.mark(question, {
+                    'selected_choice_id': answer.selected_choice_id,
+                    'selected_choices': answer.selected_choices,
+                    'true_false_answer': answer.true_false_answer,
+                })
+            marks.append(answer.marks_awarded or 0)
+        submission.score = answer_key.percentage(marks)
+    return len(submissions)
+
+def regrade_quiz(quiz):
+    """Re-scores every submission of a quiz against its current answer key. Does not commit."""
+    answer_keys.invalidate(quiz_id=quiz.id)
+    answer_key = answer_keys.for_quiz(quiz)
+    submissions = QuizSubmission.query.filter_by(quiz_id=quiz.id).all()
+    for submission in submissions:
+        submission.score = grade_quiz_answers(answer_key, submission.answers or {})
+    return len(submissions)
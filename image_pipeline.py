@@ -0,0 +1,237 @@
+import io
+import os
+import posixpath
+import time
+from datetime import datetime
+from flask import url_for
+from PIL import Image, ImageOps, UnidentifiedImageError
+from extensions import db
+from background import WorkerPool
+from models import ImageAsset
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+
+# Folders of the static directory that the upload helpers write to
+UPLOAD_IMAGE_FOLDERS = ('post_media', 'status_files', 'chat_files', 'community_covers', 'chat_room_covers',
+                        'profile_pics', 'profile_banners', 'uploads', 'blobs')
+
+# Width buckets, largest first so each variant is downscaled from the previous one
+VARIANT_WIDTHS = (('full', 1600), ('medium', 800), ('thumb', 320))
+
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+# How long a lookup that found no ready asset is remembered before the database is asked again
+MISS_TTL = 30
+LOOKUP_CACHE_SIZE = 10000
+
+def is_image_path(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+def variant_path(path, name, fmt):
+    """Where a variant of `path` (relative to the static folder) is stored, e.g. post_media/variants/ab12_thumb.webp."""
+    folder, filename = posixpath.split(path.replace(os.sep, '/'))
+    stem = os.path.splitext(filename)[0]
+    return posixpath.join(folder, 'variants', f'{stem}_{name}.{fmt}')
+
+def _flatten(image):
+    """An RGB copy of an image for JPEG, with any transparency composited onto white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+# Formats whose originals are re-encoded when they carry EXIF
+STRIPPED_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+def _save_stripped(image, source_format, target):
+    """Encodes an upright image without its EXIF (camera details, GPS) to a path or file object."""
+    options = {'format': source_format, 'icc_profile': image.info.get('icc_profile')}
+    if source_format == 'JPEG':
+        image = _flatten(image)
+        options['quality'] = 95
+    image.save(target, **options)
+
+def _strip_original(image, source_format, file_path):
+    tmp_path = file_path + '.tmp'
+    _save_stripped(image, source_format, tmp_path)
+    os.replace(tmp_path, file_path)
+
+def strip_metadata(stream, extension):
+    """
+    The stream to store for an upload: the upload itself, or for an image carrying EXIF an
+    upright copy without it. The blob store calls this before hashing, so stored originals
+    never need rewriting afterwards.
+    """
+    if extension.lower() not in IMAGE_EXTENSIONS:
+        return stream
+    start = stream.tell()
+    try:
+        with Image.open(stream) as source:
+            source_format = source.format
+            if source_format not in STRIPPED_FORMATS or getattr(source, 'is_animated', False) or not source.getexif():
+                return stream
+            image = ImageOps.exif_transpose(source)
+            image.load()
+    except (UnidentifiedImageError, OSError):
+        return stream
+    finally:
+        stream.seek(start)
+    stripped = io.BytesIO()
+    _save_stripped(image, source_format, stripped)
+    stripped.seek(0)
+    return stripped
+
+def build_variants(static_folder, path, strip_original=True):
+    """
+    Writes the WebP and JPEG variants of one uploaded image and returns (width, height, variants).
+    Originals are never upscaled: a bucket wider than the image reuses the largest variant.
+    Animated images keep only their original, as the variants would be stills. With
+    `strip_original`, an original that still carries EXIF is rewritten without it.
+    """
+    file_path = os.path.join(static_folder, path)
+    with Image.open(file_path) as source:
+        source_format = source.format
+        has_exif = bool(source.getexif())
+        animated = getattr(source, 'is_animated', False)
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    width, height = image.size
+    if animated:
+        return width, height, {}
+    if strip_original and has_exif and source_format in STRIPPED_FORMATS:
+        _strip_original(image, source_format, file_path)
+    if image.mode not in ('RGB', 'RGBA'):
+        # Palette and CMYK images would otherwise resize with nearest-neighbour or not encode to WebP
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    icc_profile = image.info.get('icc_profile')
+    variants = {}
+    produced = {} # target width -> variant, so small images write each size once
+    current = image
+    for name, max_width in VARIANT_WIDTHS:
+        target_width = min(max_width, width)
+        if target_width in produced:
+            variants[name] = produced[target_width]
+            continue
+        target_height = max(1, round(height * target_width / width))
+        if current.size != (target_width, target_height):
+            current = current.resize((target_width, target_height), Image.LANCZOS, reducing_gap=3.0)
+
+        variant = {'width': target_width, 'height': target_height}
+        for fmt in ('webp', 'jpeg'):
+            relative_path = variant_path(path, name, fmt)
+            output_path = os.path.join(static_folder, relative_path)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # Re-encoding without exif= drops all metadata except the colour profile
+            if fmt == 'webp':
+                current.save(output_path, format='WEBP', quality=WEBP_QUALITY, method=4, icc_profile=icc_profile)
+            else:
+                _flatten(current).save(output_path, format='JPEG', quality=JPEG_QUALITY, optimize=True,
+                                       progressive=True, icc_profile=icc_profile)
+            variant[fmt] = relative_path
+        variants[name] = produced[target_width] = variant
+    return width, height, variants
+
+class ImagePipeline(WorkerPool):
+    """
+    Produces resized WebP and JPEG variants of uploaded images off the request thread.
+
+    The upload helpers in utils save the original and call `enqueue` with its path relative to
+    the static folder. IMAGE_WORKERS threads take paths from a queue, write the thumb/medium/full
+    variants (Pillow releases the GIL while resizing and encoding), strip EXIF and record the
+    result as an ImageAsset. IMAGE_WORKERS = 0 processes inline and leaves the ImageAsset for the
+    caller to commit. Templates pick variants with `image_url` and `image_srcset`, which fall back
+    to the original until its variants are ready. `flask process-images` backfills older uploads.
+    """
+
+    name = 'image-worker'
+
+    def __init__(self, app=None):
+        self._assets = {} # {path: (asset info or None, expires_at)}
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get('IMAGE_WORKERS', 2))
+        with self._lock:
+            self._assets.clear()
+
+    def enqueue(self, path):
+        """Queues an uploaded file for processing; anything that is not an image is ignored."""
+        if not path or not is_image_path(path):
+            return
+        if self.num_workers <= 0:
+            self.process(path, commit=False)
+            return
+        self.submit(path)
+
+    def process(self, path, commit=True):
+        """Builds the variants of one image and records them (or the failure) as its ImageAsset."""
+        asset = ImageAsset.query.filter_by(path=path).first()
+        if asset is not None and asset.status == 'ready':
+            return asset # the same content was uploaded before
+        if asset is None:
+            asset = ImageAsset(path=path)
+            db.session.add(asset)
+
+        from blob_store import is_blob_path
+        try:
+            # Blobs are named after their content, so only their variants are written; uploads
+            # are stripped before they are stored (see strip_metadata)
+            asset.width, asset.height, asset.variants = build_variants(self.app.static_folder, path,
+                                                                       strip_original=not is_blob_path(path))
+        except Exception as e:
+            asset.status = 'failed'
+            asset.error = str(e)[:500]
+            print(f"Image {path} could not be processed: {e}")
+        else:
+            asset.status = 'ready'
+            asset.error = None
+        asset.processed_at = datetime.utcnow()
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+        with self._lock:
+            self._assets.pop(path, None)
+        return asset
+
+    def lookup(self, path):
+        """{'width', 'height', 'variants'} for a ready image, or None. Ready assets are cached for good."""
+        if not isinstance(path, str) or not is_image_path(path):
+            return None
+        now = time.time()
+        with self._lock:
+            cached = self._assets.get(path)
+            if cached and cached[1] > now:
+                return cached[0]
+
+        row = db.session.query(ImageAsset.width, ImageAsset.height, ImageAsset.variants).filter(
+            ImageAsset.path == path, ImageAsset.status == 'ready'
+        ).first()
+        info = {'width': row.width, 'height': row.height, 'variants': row.variants or {}} if row else None
+        with self._lock:
+            if len(self._assets) >= LOOKUP_CACHE_SIZE:
+                self._assets.clear()
+            self._assets[path] = (info, float('inf') if info else now + MISS_TTL)
+        return info
+
+image_pipeline = ImagePipeline()
+
+def image_url(path, size='medium', fmt='jpeg'):
+    """URL of the `size` variant of an uploaded image, or of the original if it has none (yet)."""
+    info = image_pipeline.lookup(path)
+    variant = info['variants'].get(size) if info else None
+    return url_for('static', filename=variant[fmt] if variant else path)
+
+def image_srcset(path, fmt='webp'):
+    """A srcset listing every width variant of an image, or '' if it has none (yet)."""
+    info = image_pipeline.lookup(path)
+    if not info or not info['variants']:
+        return ''
+    widths = {variant['width']: variant[fmt] for variant in info['variants'].values()}
+    return ', '.join(f"{url_for('static', filename=widths[width])} {width}w" for width in sorted(widths))
@@ -24,7 +24,12 @@ from models import Category, LibraryMaterial, Module, Lesson, Assignment, Assign
 from werkzeug.utils import secure_filename
 import os
 from utils import save_editor_image
+from blob_store import store_upload
+from chunked_uploads import claim_upload
 from achievements import check_and_award_badges
+from progress import progress_cache
+from grading import answer_keys
+from item_analysis import item_analysis
 from models import Module
 
 @instructor_bp.route('/dashboard')
@@ -125,6 +130,7 @@ def create_exam_step_1():
         )
         db.session.add(new_exam)
         db.session.commit()
+        progress_cache.invalidate(course_id=course.id)
 
         flash('Exam created successfully. Now add questions.', 'success')
         # Redirect to the next step, which will be adding questions
@@ -152,6 +158,7 @@ def edit_course(course_id):
     course.description = request.form.get('description', course.description)
     course.final_exam_enabled = request.form.get('final_exam_enabled') == 'on'
     db.session.commit()
+    progress_cache.invalidate(course_id=course.id)
     flash('Course details updated successfully.')
     return redirect(url_for('instructor.manage_course', course_id=course.id))
 
@@ -269,6 +276,7 @@ def grade_submission(submission_id):
     if grade:
         submission.grade = grade
         db.session.commit()
+        progress_cache.invalidate(student_id=submission.student_id, course_id=submission.assignment.module.course_id)
 
         # Check for achievements after grading
         module = Module.query.get(submission.assignment.module_id)
@@ -292,6 +300,7 @@ def create_quiz(module_id):
     new_quiz = Quiz(module_id=module.id)
     db.session.add(new_quiz)
     db.session.commit()
+    progress_cache.invalidate(course_id=module.course_id)
     flash('Quiz created successfully. You can now add questions and settings.', 'success')
     return redirect(url_for('instructor.manage_quiz', quiz_id=new_quiz.id))
 
@@ -316,6 +325,7 @@ def edit_quiz(quiz_id):
     quiz.randomized_questions = request.form.get('randomized_questions') == 'on'
     quiz.pass_mark = request.form.get('pass_mark', type=int)
     db.session.commit()
+    progress_cache.invalidate(course_id=quiz.module.course_id)
 
     flash('Quiz settings updated successfully.', 'success')
     return redirect(url_for('instructor.manage_quiz', quiz_id=quiz.id))
@@ -352,8 +362,9 @@ def add_question_to_quiz(quiz_id):
     db.session.add_all(new_choices)
     db.session.commit()
 
-    new_question.correct_choice_id = new_choices[correct_choice_index].id
+    new_choices[correct_choice_index].is_correct = True
     db.session.commit()
+    answer_keys.invalidate(quiz_id=quiz.id)
 
     flash('New question added successfully.', 'success')
     return redirect(url_for('instructor.manage_quiz', quiz_id=quiz.id))
@@ -380,6 +391,7 @@ def create_exam(course_id):
     )
     db.session.add(new_exam)
     db.session.commit()
+    progress_cache.invalidate(course_id=course.id)
 
     flash('Final exam created successfully. You can now add questions.', 'success')
     return redirect(url_for('instructor.manage_exam', exam_id=new_exam.id))
@@ -420,6 +432,7 @@ def edit_exam(exam_id):
     exam.retake_allowed = request.form.get('retake_allowed') == 'on'
 
     db.session.commit()
+    progress_cache.invalidate(course_id=exam.course_id)
 
     flash('Exam settings updated successfully.', 'success')
     return redirect(url_for('instructor.manage_exam', exam_id=exam.id))
@@ -523,6 +536,7 @@ def add_question_to_exam(exam_id):
 
     db.session.add(new_question)
     db.session.commit()
+    answer_keys.invalidate(exam_id=exam.id)
 
     flash('New question added successfully.', 'success')
     return redirect(url_for('instructor.manage_exam', exam_id=exam.id))
@@ -537,6 +551,28 @@ def review_exam_submissions(exam_id):
     submissions = exam.submissions.order_by(ExamSubmission.submitted_at.desc()).all()
     return render_template('instructor/review_submissions.html', exam=exam, submissions=submissions)
 
+@instructor_bp.route('/exam/<int:exam_id>/item-analysis')
+@login_required
+def exam_item_analysis(exam_id):
+    exam = FinalExam.query.get_or_404(exam_id)
+    if exam.course.instructor_id != current_user.id:
+        abort(403)
+
+    report = item_analysis.for_exam(exam)
+    return render_template('instructor/item_analysis.html', title=exam.title, report=report,
+                           back_url=url_for('instructor.review_exam_submissions', exam_id=exam.id))
+
+@instructor_bp.route('/quiz/<int:quiz_id>/item-analysis')
+@login_required
+def quiz_item_analysis(quiz_id):
+    quiz = Quiz.query.get_or_404(quiz_id)
+    if quiz.module.course.instructor_id != current_user.id:
+        abort(403)
+
+    report = item_analysis.for_quiz(quiz)
+    return render_template('instructor/item_analysis.html', title=f"Quiz: {quiz.module.title}", report=report,
+                           back_url=url_for('instructor.manage_quiz', quiz_id=quiz.id))
+
 @instructor_bp.route('/submission/<int:submission_id>/review', methods=['GET', 'POST'])
 @login_required
 def review_submission(submission_id):
@@ -562,6 +598,7 @@ def review_submission(submission_id):
         submission.score = (total_score / total_marks) * 100 if total_marks > 0 else 0
         submission.status = 'released'
         db.session.commit()
+        progress_cache.invalidate(student_id=submission.student_id, course_id=submission.final_exam.course_id)
         flash('Grades have been saved and released to the student.', 'success')
         return redirect(url_for('instructor.review_exam_submissions', exam_id=submission.final_exam_id))
 
@@ -612,21 +649,15 @@ def enrolled_students(course_id):
         abort(403)
     return render_template('instructor/enrolled_students.html', course=course)
 
+LIBRARY_FILE_EXTENSIONS = {'pdf', 'epub', 'txt', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'}
+
 def save_library_file(file):
-    allowed_extensions = {'pdf', 'epub', 'txt', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'}
     filename = secure_filename(file.filename)
-    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in LIBRARY_FILE_EXTENSIONS:
         return None
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    filepath = os.path.join(current_app.root_path, 'static/library', new_filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-
-    file.save(filepath)
-    return os.path.join('library', new_filename)
+    return store_upload(file, f_ext)
 
 @instructor_bp.route('/library/submit', methods=['POST'])
 def submit_library_material():
@@ -635,12 +666,14 @@ def submit_library_material():
     category_id = request.form.get('category_id')
     price_naira = request.form.get('price_naira')
     file = request.files.get('file')
+    # A file sent ahead through the resumable upload API
+    upload = claim_upload(request.form['upload_id'], current_user.id, 'library') if request.form.get('upload_id') else None
 
-    if not all([title, category_id, price_naira, file]):
+    if not all([title, category_id, price_naira, file or upload]):
         flash('Title, category, price, and file are required fields.')
         return redirect(url_for('instructor.dashboard'))
 
-    saved_path = save_library_file(file)
+    saved_path = upload.result_path if upload else save_library_file(file)
     if not saved_path:
         flash('Invalid file type. Allowed types: pdf, epub, txt, doc, docx, xls, xlsx, ppt, pptx.', 'danger')
         return redirect(url_for('instructor.dashboard'))
@@ -711,6 +744,7 @@ def add_assignment(module_id):
         )
         db.session.add(new_assignment)
         db.session.commit()
+        progress_cache.invalidate(course_id=module.course_id)
         flash('New assignment added.')
     else:
         flash('Title, description, and submission type are required.', 'danger')
@@ -739,5 +773,6 @@ def edit_assignment(assignment_id):
         assignment.due_date = None
 
     db.session.commit()
+    progress_cache.invalidate(course_id=assignment.module.course_id)
     flash('Assignment updated successfully.', 'success')
     return redirect(url_for('instructor.manage_course', course_id=assignment.module.course_id))
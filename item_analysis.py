@@ -0,0 +1,211 @@
+import threading
+import numpy as np
+from sqlalchemy import func
+from extensions import db
+from grading import answer_keys, AUTO_GRADED_TYPES
+from models import Question, Choice, Answer, ExamSubmission, QuizSubmission
+
+# Share of respondents in each of the upper and lower groups for the discrimination index
+DISCRIMINATION_GROUP = 0.27
+
+SCORE_BINS = np.linspace(0, 100, 11)
+
+def _first_attempts(rows):
+    """Keeps each student's earliest attempt from (submission_id, student_id, ...) rows ordered by id."""
+    seen = set()
+    first = []
+    for row in rows:
+        if row[1] not in seen:
+            seen.add(row[1])
+            first.append(row)
+    return first
+
+def _options(question, choices):
+    """The selectable options of a question as [(value, label, is_correct)]."""
+    if question.question_type == 'true_false':
+        return [(True, 'True', question.true_false_answer is True), (False, 'False', question.true_false_answer is False)]
+    return [(choice_id, text, choice_id in question.correct_choices) for choice_id, text in choices.get(question.question_id, [])]
+
+def _selected(question, answer_data):
+    if question.question_type == 'multiple_choice_single':
+        value = answer_data.get('selected_choice_id')
+        return [] if value is None else [value]
+    if question.question_type == 'multiple_choice_multiple':
+        return answer_data.get('selected_choices') or []
+    value = answer_data.get('true_false_answer')
+    return [] if value is None else [value]
+
+def analyze(answer_key, responses, scores, question_texts, choices):
+    """
+    Item statistics for one exam or quiz.
+
+    `responses` has one {question_id: answer data} dict per respondent, in the form
+    AnswerKey.mark expects; `scores` holds the respondents' recorded 0-100 scores.
+    Only auto-graded questions are analysed, as each needs a right or wrong answer.
+    """
+    questions = [q for q in answer_key.questions if q.question_type in AUTO_GRADED_TYPES]
+    n, k = len(responses), len(questions)
+    options = [_options(question, choices) for question in questions]
+    offsets = np.cumsum([0] + [len(opts) for opts in options])
+
+    # correct[i, j]: respondent i got item j fully right; selected[i, o]: respondent i picked option o
+    correct = np.zeros((n, k))
+    selected = np.zeros((n, int(offsets[-1])), dtype=bool)
+    answered = np.zeros((n, k), dtype=bool)
+    for i, response in enumerate(responses):
+        for j, question in enumerate(questions):
+            answer_data = response.get(question.question_id, {})
+            correct[i, j] = answer_key.mark(question, answer_data) == question.marks
+            picks = _selected(question, answer_data)
+            answered[i, j] = bool(picks)
+            for o, (value, _, _) in enumerate(options[j]):
+                if value in picks:
+                    selected[i, offsets[j] + o] = True
+
+    report = {
+        'respondents': n,
+        'items': [],
+        'kr20': None,
+        'mean': None,
+        'median': None,
+        'std': None,
+        'histogram': [],
+        'skipped_questions': len(answer_key.questions) - k,
+    }
+
+    if n:
+        score_array = np.asarray(scores, dtype=float)
+        counts, _ = np.histogram(score_array, bins=SCORE_BINS)
+        report['histogram'] = [
+            (f"{int(low)}-{int(high)}", int(count)) for low, high, count in zip(SCORE_BINS[:-1], SCORE_BINS[1:], counts)
+        ]
+        report['mean'] = float(score_array.mean())
+        report['median'] = float(np.median(score_array))
+        report['std'] = float(score_array.std())
+
+    if not n or not k:
+        return report
+
+    difficulty = correct.mean(axis=0)
+    totals = correct.sum(axis=1)
+
+    discrimination = np.full(k, np.nan)
+    if n >= 2:
+        group = max(1, int(round(n * DISCRIMINATION_GROUP)))
+        order = np.argsort(totals, kind='stable')
+        discrimination = correct[order[-group:]].mean(axis=0) - correct[order[:group]].mean(axis=0)
+
+    # Kuder-Richardson 20: internal consistency for right/wrong items
+    variance = totals.var()
+    if k > 1 and variance > 0:
+        report['kr20'] = float(k / (k - 1) * (1 - (difficulty * (1 - difficulty)).sum() / variance))
+
+    option_counts = selected.sum(axis=0)
+    blanks = n - answered.sum(axis=0)
+    for j, question in enumerate(questions):
+        report['items'].append({
+            'question_id': question.question_id,
+            'text': question_texts.get(question.question_id, ''),
+            'question_type': question.question_type,
+            'difficulty': float(difficulty[j]),
+            'discrimination': None if np.isnan(discrimination[j]) else float(discrimination[j]),
+            'options': [
+                {'label': label, 'is_correct': is_correct, 'count': int(option_counts[offsets[j] + o])}
+                for o, (_, label, is_correct) in enumerate(options[j])
+            ],
+            'blank': int(blanks[j]),
+        })
+    return report
+
+def _question_details(answer_key):
+    question_ids = [question.question_id for question in answer_key.questions]
+    if not question_ids:
+        return {}, {}
+    question_texts = dict(db.session.query(Question.id, Question.question_text).filter(Question.id.in_(question_ids)))
+    choices = {}
+    for choice_id, question_id, text in db.session.query(Choice.id, Choice.question_id, Choice.choice_text).filter(
+        Choice.question_id.in_(question_ids)
+    ).order_by(Choice.id):
+        choices.setdefault(question_id, []).append((choice_id, text))
+    return question_texts, choices
+
+def exam_report(exam, answer_key):
+    submissions = _first_attempts(db.session.query(
+        ExamSubmission.id, ExamSubmission.student_id, ExamSubmission.score
+    ).filter(
+        ExamSubmission.final_exam_id == exam.id,
+        ExamSubmission.submitted_at.isnot(None)
+    ).order_by(ExamSubmission.id).all())
+
+    responses = {submission_id: {} for submission_id, _, _ in submissions}
+    if responses:
+        for row in db.session.query(
+            Answer.exam_submission_id, Answer.question_id, Answer.selected_choice_id,
+            Answer.selected_choices, Answer.true_false_answer
+        ).filter(Answer.exam_submission_id.in_(list(responses))):
+            responses[row.exam_submission_id][row.question_id] = {
+                'selected_choice_id': row.selected_choice_id,
+                'selected_choices': row.selected_choices,
+                'true_false_answer': row.true_false_answer,
+            }
+
+    question_texts, choices = _question_details(answer_key)
+    return analyze(answer_key, list(responses.values()), [score or 0 for _, _, score in submissions],
+                   question_texts, choices)
+
+def quiz_report(quiz, answer_key):
+    submissions = _first_attempts(db.session.query(
+        QuizSubmission.id, QuizSubmission.student_id, QuizSubmission.score, QuizSubmission.answers
+    ).filter(QuizSubmission.quiz_id == quiz.id).order_by(QuizSubmission.id).all())
+
+    responses = []
+    for _, _, _, answers in submissions:
+        answers = answers or {}
+        responses.append({
+            question.question_id: {'selected_choice_id': int(answers[str(question.question_id)])}
+            for question in answer_key.questions if answers.get(str(question.question_id))
+        })
+
+    question_texts, choices = _question_details(answer_key)
+    return analyze(answer_key, responses, [score or 0 for _, _, score, _ in submissions], question_texts, choices)
+
+class ItemAnalysisCache:
+    """
+    Per-process cache of item-analysis reports. Each report is stored with a fingerprint of the
+    submissions it was computed from (their count, newest id and score total) and the answer
+    key, so a new submission, a regrade or a changed key recomputes it on the next request.
+    """
+
+    def __init__(self):
+        self._reports = {} # {('exam' | 'quiz', id): (fingerprint, report)}
+        self._lock = threading.Lock()
+
+    def for_exam(self, exam):
+        answer_key = answer_keys.for_exam(exam)
+        fingerprint = db.session.query(
+            func.count(ExamSubmission.id), func.max(ExamSubmission.id), func.sum(ExamSubmission.score)
+        ).filter(ExamSubmission.final_exam_id == exam.id, ExamSubmission.submitted_at.isnot(None)).one()
+        return self._lookup(('exam', exam.id), (tuple(fingerprint), answer_key), lambda: exam_report(exam, answer_key))
+
+    def for_quiz(self, quiz):
+        answer_key = answer_keys.for_quiz(quiz)
+        fingerprint = db.session.query(
+            func.count(QuizSubmission.id), func.max(QuizSubmission.id), func.sum(QuizSubmission.score)
+        ).filter(QuizSubmission.quiz_id == quiz.id).one()
+        return self._lookup(('quiz', quiz.id), (tuple(fingerprint), answer_key), lambda: quiz_report(quiz, answer_key))
+
+    def clear(self):
+        with self._lock:
+            self._reports.clear()
+
+    def _lookup(self, cache_key, fingerprint, compute):
+        with self._lock:
+            cached = self._reports.get(cache_key)
+            if cached and cached[0] == fingerprint:
+                return cached[1]
+        report = compute()
+        with self._lock:
+            self._reports[cache_key] = (fingerprint, report)
+        return report
+
+item_analysis = ItemAnalysisCache()
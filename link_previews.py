@@ -0,0 +1,228 @@
+import hashlib
+import ipaddress
+import re
+import socket
+from datetime import datetime, timedelta
+from urllib.parse import urljoin, urlsplit
+import requests
+from bs4 import BeautifulSoup
+from sqlalchemy.exc import IntegrityError
+from extensions import db, socketio
+from background import WorkerPool
+from models import LinkPreview, ChatMessage
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\']+')
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+USER_AGENT = 'Mozilla/5.0 (compatible; LinkPreviewBot/1.0)'
+
+# Pages are only read this far; the <head> with the Open Graph tags comes first
+DEFAULT_MAX_BYTES = 512 * 1024
+DEFAULT_TIMEOUT = 5
+# Redirects are followed by hand so that every hop's host is checked
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# How long a fetched preview is reused, and how long a URL that had none is left alone
+DEFAULT_TTL = timedelta(days=7)
+DEFAULT_FAILURE_TTL = timedelta(hours=1)
+
+def find_url(text):
+    """The first http(s) URL in a piece of text, without trailing punctuation, or None."""
+    match = URL_PATTERN.search(text or '')
+    return match.group(0).rstrip('.,;:!?)]}') if match else None
+
+def url_hash(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def _meta(soup, *names):
+    for name in names:
+        tag = soup.find('meta', property=name) or soup.find('meta', attrs={'name': name})
+        if tag and tag.get('content'):
+            return tag['content'].strip()
+    return None
+
+def parse_preview(html, base_url):
+    """{'title', 'description', 'image_url', 'site_name'} from a page's Open Graph tags, falling back to <title>."""
+    soup = BeautifulSoup(html, 'html.parser')
+    title = _meta(soup, 'og:title', 'twitter:title')
+    if not title and soup.title and soup.title.string:
+        title = soup.title.string.strip()
+    image_url = _meta(soup, 'og:image', 'twitter:image')
+    return {
+        'title': title[:255] if title else None,
+        'description': _meta(soup, 'og:description', 'twitter:description', 'description'),
+        'image_url': urljoin(base_url, image_url)[:2048] if image_url else None,
+        'site_name': (_meta(soup, 'og:site_name') or '')[:255] or None,
+    }
+
+def _is_public_host(host):
+    """Whether every address a host resolves to is public, so users can't make the server probe its own network."""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses)
+
+class LinkPreviewer(WorkerPool):
+    """
+    Unfurls links in statuses, chat messages and posts off the request thread.
+
+    Routes call `attach` with the new row and its text before committing. The first URL gets a
+    LinkPreview row shared by everything that links to it; if that row is missing or stale, the
+    URL is queued for LINK_PREVIEW_WORKERS threads, which is also the limit on concurrent fetches.
+    A fetch reads at most LINK_PREVIEW_MAX_BYTES of an HTML page (an image URL previews as itself)
+    and stores the result, or the failure, so pages without previews are not fetched again for
+    LINK_PREVIEW_FAILURE_TTL. Chat rooms get a 'link_preview' event when one is ready.
+    LINK_PREVIEW_WORKERS = 0 fetches inline and leaves the row for the caller to commit.
+    """
+
+    name = 'link-preview'
+
+    def __init__(self, app=None):
+        self._queued = set()
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get('LINK_PREVIEW_WORKERS', 4))
+        with self._lock:
+            self._queued.clear()
+
+    def _is_fresh(self, preview):
+        if preview.state == 'pending' or preview.fetched_at is None:
+            return False
+        if preview.state == 'ready':
+            ttl = self.app.config.get('LINK_PREVIEW_TTL', DEFAULT_TTL)
+        else:
+            ttl = self.app.config.get('LINK_PREVIEW_FAILURE_TTL', DEFAULT_FAILURE_TTL)
+        return preview.fetched_at > datetime.utcnow() - ttl
+
+    def _get_or_create(self, url):
+        digest = url_hash(url)
+        preview = LinkPreview.query.filter_by(url_hash=digest).first()
+        if preview is not None:
+            return preview
+        try:
+            # A savepoint, so a concurrent first link to the same URL doesn't undo the caller's work
+            with db.session.begin_nested():
+                preview = LinkPreview(url_hash=digest, url=url, state='pending')
+                db.session.add(preview)
+        except IntegrityError:
+            preview = LinkPreview.query.filter_by(url_hash=digest).first()
+        return preview
+
+    def attach(self, target, text):
+        """Links `target` (a Status, ChatMessage or Post) to the preview of the first URL in `text`. Does not commit."""
+        url = find_url(text)
+        if not url or len(url) > 2048:
+            return None
+        preview = self._get_or_create(url)
+        target.link_preview = preview
+        if not self._is_fresh(preview):
+            self.enqueue(url)
+        return preview
+
+    def enqueue(self, url):
+        if self.num_workers <= 0:
+            self.process(url, commit=False)
+            return
+        with self._lock:
+            if url in self._queued:
+                return
+            self._queued.add(url)
+        self.submit(url)
+
+    def job_done(self, url):
+        with self._lock:
+            self._queued.discard(url)
+
+    def _open(self, url):
+        """
+        GETs a URL as a stream, following up to MAX_REDIRECTS redirects. Every hop must be an
+        http(s) URL on a public host, so a public page can't redirect the fetch into the
+        server's own network.
+        """
+        config = self.app.config
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname or \
+                    (not config.get('LINK_PREVIEW_ALLOW_PRIVATE') and not _is_public_host(parts.hostname)):
+                raise ValueError('Host is not public')
+            response = requests.get(url, timeout=config.get('LINK_PREVIEW_TIMEOUT', DEFAULT_TIMEOUT), stream=True,
+                                    allow_redirects=False,
+                                    headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'})
+            location = response.headers.get('Location')
+            if response.status_code not in REDIRECT_CODES or not location:
+                return response
+            response.close()
+            url = urljoin(url, location)
+        raise ValueError('Too many redirects')
+
+    def fetch(self, url):
+        """Fetches and parses one URL. Returns the preview fields; raises ValueError if it has none."""
+        max_bytes = self.app.config.get('LINK_PREVIEW_MAX_BYTES', DEFAULT_MAX_BYTES)
+        with self._open(url) as response:
+            if response.status_code != 200:
+                raise ValueError(f'HTTP {response.status_code}')
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type.startswith('image/'):
+                return {'title': None, 'description': None, 'image_url': response.url, 'site_name': None}
+            if content_type not in HTML_TYPES:
+                raise ValueError(f'Not a web page: {content_type or "no content type"}')
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                body += chunk
+                if len(body) >= max_bytes:
+                    del body[max_bytes:]
+                    break
+            final_url = response.url
+            encoding = response.encoding
+        fields = parse_preview(bytes(body).decode(encoding or 'utf-8', errors='replace'), final_url)
+        if not fields['title']:
+            raise ValueError('Page has no title')
+        return fields
+
+    def process(self, url, commit=True):
+        """Fetches a URL and records the preview (or the failure) on its shared LinkPreview row."""
+        try:
+            fields = self.fetch(url)
+        except (requests.RequestException, ValueError) as e:
+            fields, error = None, str(e)[:255]
+
+        preview = self._get_or_create(url)
+        if fields:
+            for name, value in fields.items():
+                setattr(preview, name, value)
+            preview.state, preview.error = 'ready', None
+        elif preview.state != 'ready':
+            # A stale preview outlives a failed refresh
+            preview.state, preview.error = 'failed', error
+        preview.fetched_at = datetime.utcnow()
+        if not commit:
+            db.session.flush()
+            return preview
+        db.session.commit()
+        if preview.state == 'ready':
+            self._announce(preview)
+        return preview
+
+    def _announce(self, preview):
+        """Tells chat rooms whose recent messages link to the URL that its preview is ready."""
+        since = datetime.utcnow() - timedelta(hours=1)
+        for message_id, room_id in db.session.query(ChatMessage.id, ChatMessage.room_id).filter(
+            ChatMessage.link_preview_id == preview.id, ChatMessage.timestamp > since
+        ):
+            socketio.emit('link_preview', {'message_id': message_id, 'link_preview': serialize_preview(preview)}, to=room_id)
+
+link_previewer = LinkPreviewer()
+
+def serialize_preview(preview):
+    """The preview fields sent to clients, or None if there's nothing to show (yet)."""
+    if preview is None or preview.state != 'ready':
+        return None
+    return {
+        'url': preview.url,
+        'title': preview.title,
+        'description': preview.description,
+        'image_url': preview.image_url,
+        'site_name': preview.site_name,
+    }
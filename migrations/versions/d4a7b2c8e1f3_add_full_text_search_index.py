@@ -0,0 +1,57 @@
+"""Add FTS5 full-text search index
+
+Revision ID: d4a7b2c8e1f3
+Revises: c3f8a1d9e2b6
+Create Date: 2026-10-17 11:58:23.804417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7b2c8e1f3'
+down_revision = 'c3f8a1d9e2b6'
+branch_labels = None
+depends_on = None
+
+# table -> indexed columns; each gets an external-content <table>_fts index kept in sync by triggers
+SEARCHABLE = {
+    'chat_message': ['content'],
+    'post': ['content'],
+    'course': ['title', 'description'],
+    'library_material': ['title', 'description'],
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        # Other databases use the 'like' search backend, which needs no index tables
+        return
+
+    for table, columns in SEARCHABLE.items():
+        fts = f'{table}_fts'
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        op.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column_list}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                   f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END")
+        op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                   f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END")
+        op.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column_list} ON {table} BEGIN "
+                   f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); "
+                   f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END")
+        # Index the rows that already exist
+        op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for table in SEARCHABLE:
+        fts = f'{table}_fts'
+        for suffix in ('ai', 'ad', 'au'):
+            op.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+        op.execute(f"DROP TABLE IF EXISTS {fts}")
@@ -60,6 +60,12 @@ class User(UserMixin, db.Model):
     latitude = db.Column(db.Float, nullable=True)
     longitude = db.Column(db.Float, nullable=True)
 
+    # Set once a user has too many followers to copy their posts into every timeline;
+    # their posts are merged into followers' feeds at read time instead.
+    high_fanout = db.Column(db.Boolean, default=False, nullable=False, server_default='0')
+    # Upload quota in bytes; None falls back to the STORAGE_QUOTA config value (see storage.py)
+    storage_quota = db.Column(db.BigInteger, nullable=True)
+
     courses_taught = db.relationship('Course', backref='instructor', lazy='dynamic')
     enrollments = db.relationship('Enrollment', back_populates='student', lazy='dynamic')
     course_comments = db.relationship('CourseComment', backref='author', lazy='dynamic')
@@ -355,6 +361,8 @@ class Certificate(db.Model):
     certificate_uid = db.Column(db.String(100), unique=True, nullable=False)
     issued_at = db.Column(db.DateTime, default=datetime.utcnow)
     file_path = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready') # queued, rendering, ready, failed
+    render_error = db.Column(db.Text, nullable=True)
 
     user = db.relationship('User', backref=db.backref('certificates', lazy='dynamic'))
     course = db.relationship('Course', backref=db.backref('certificates', lazy='dynamic'))
@@ -405,6 +413,7 @@ class ChatRoom(db.Model):
     last_message_timestamp = db.Column(db.DateTime, nullable=True, index=True)
     cover_image = db.Column(db.String(150), nullable=True)
     join_token = db.Column(db.String(100), unique=True, nullable=True, index=True)
+    retention_days = db.Column(db.Integer, nullable=True) # messages older than this are archived; None uses CHAT_RETENTION_DAYS
 
     messages = db.relationship('ChatMessage', backref='room', lazy='dynamic', cascade="all, delete-orphan")
     members = db.relationship('ChatRoomMember', backref='room', lazy='dynamic', cascade="all, delete-orphan")
@@ -432,7 +441,7 @@ class ChatMessage(db.Model):
     is_pinned = db.Column(db.Boolean, default=False)
     is_edited = db.Column(db.Boolean, default=False)
     replied_to_id = db.Column(db.Integer, db.ForeignKey('chat_message.id'), nullable=True)
-    read_at = db.Column(db.DateTime, nullable=True)
+    replied_to_quote = db.Column(db.JSON, nullable=True) # {'user_name', 'content'} once the replied-to message is archived
     is_forwarded = db.Column(db.Boolean, default=False)
     forwarded_from_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
@@ -443,6 +452,11 @@ class ChatMessage(db.Model):
     poll = db.relationship('Poll', back_populates='message', uselist=False, cascade="all, delete-orphan")
     replied_to_status_id = db.Column(db.Integer, db.ForeignKey('status.id'), nullable=True)
     replied_to_status = db.relationship('Status', backref='replies')
+    link_preview_id = db.Column(db.Integer, db.ForeignKey('link_preview.id'), nullable=True)
+    link_preview = db.relationship('LinkPreview')
+
+    # Serves keyset pagination of a room's history in (timestamp, id) order
+    __table_args__ = (db.Index('ix_chat_message_room_timestamp_id', 'room_id', 'timestamp', 'id'),)
 
 class MutedUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -493,8 +507,17 @@ class UserLastRead(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False)
     last_read_timestamp = db.Column(db.DateTime, nullable=False)
+    # Read watermark: every message in the room up to this id counts as read (see chat_unread.py)
+    last_read_message_id = db.Column(db.Integer, nullable=True)
     __table_args__ = (db.UniqueConstraint('user_id', 'room_id', name='_user_room_read_uc'),)
 
+class RoomUnreadCounter(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False, index=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'room_id', name='_user_room_unread_uc'),)
+
 class AdminLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     admin_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -515,8 +538,10 @@ class Status(db.Model):
     background = db.Column(db.String(50), nullable=True) # For text statuses
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    link_preview_id = db.Column(db.Integer, db.ForeignKey('link_preview.id'), nullable=True)
     user = db.relationship('User', backref=db.backref('statuses', lazy='dynamic'))
     poll = db.relationship('Poll', back_populates='status', uselist=False, cascade="all, delete-orphan")
+    link_preview = db.relationship('LinkPreview')
 
     def __init__(self, **kwargs):
         super(Status, self).__init__(**kwargs)
@@ -524,9 +549,20 @@ class Status(db.Model):
             self.created_at = datetime.utcnow()
         self.expires_at = self.created_at + timedelta(hours=24)
 
+class StatusView(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    status_id = db.Column(db.Integer, db.ForeignKey('status.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    viewed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    status = db.relationship('Status', backref=db.backref('views', lazy='dynamic', cascade="all, delete-orphan"))
+    user = db.relationship('User')
+
+    __table_args__ = (db.UniqueConstraint('status_id', 'user_id', name='_status_user_view_uc'),)
+
 class Poll(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=True) # None for status polls
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     question = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -556,18 +592,24 @@ class PollOption(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'), nullable=False)
     text = db.Column(db.String(100), nullable=False)
+    # Maintained by polls.py so tallies don't load every vote
+    vote_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     poll = db.relationship('Poll', back_populates='options')
     votes = db.relationship('PollVote', back_populates='option', cascade="all, delete-orphan")
 
 class PollVote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'), nullable=False)
     option_id = db.Column(db.Integer, db.ForeignKey('poll_option.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     option = db.relationship('PollOption', back_populates='votes')
     user = db.relationship('User')
 
+    # One vote per user per poll; changing it moves the row to another option
+    __table_args__ = (db.UniqueConstraint('poll_id', 'user_id', name='_poll_user_vote_uc'),)
+
 class CallHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     caller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -629,14 +671,17 @@ class MutedStatusUser(db.Model):
     __table_args__ = (db.UniqueConstraint('muter_id', 'muted_id', name='_muter_muted_uc'),)
 
 class LinkPreview(db.Model):
+    # One row per URL, shared by every status, message and post that links to it (see link_previews.py)
     id = db.Column(db.Integer, primary_key=True)
-    status_id = db.Column(db.Integer, db.ForeignKey('status.id'), nullable=False, unique=True)
+    url_hash = db.Column(db.String(64), nullable=False, unique=True) # SHA-256 of the URL
     url = db.Column(db.String(2048), nullable=False)
     title = db.Column(db.String(255), nullable=True)
     description = db.Column(db.Text, nullable=True)
     image_url = db.Column(db.String(2048), nullable=True)
-
-    status = db.relationship('Status', backref=db.backref('link_preview', uselist=False, cascade="all, delete-orphan"))
+    site_name = db.Column(db.String(255), nullable=True)
+    state = db.Column(db.String(20), nullable=False, default='pending', server_default='pending') # pending, ready, failed
+    error = db.Column(db.String(255), nullable=True)
+    fetched_at = db.Column(db.DateTime, nullable=True)
 
 
 # --- Feed World Models ---
@@ -666,6 +711,12 @@ class Post(db.Model):
     scheduled_for = db.Column(db.DateTime, nullable=True)
     is_boosted = db.Column(db.Boolean, default=False, nullable=False)
 
+    # Maintained by engagement.py so lists don't COUNT(*) per post
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    share_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    link_preview_id = db.Column(db.Integer, db.ForeignKey('link_preview.id'), nullable=True)
+
     likes = db.relationship('Like',
                             primaryjoin="and_(Like.target_type=='post', foreign(Like.target_id)==Post.id)",
                             lazy='dynamic',
@@ -675,7 +726,24 @@ class Post(db.Model):
                                lazy='dynamic',
                                cascade="all, delete-orphan")
     shares = db.relationship('Share', backref='post', lazy='dynamic', cascade="all, delete-orphan")
+    link_preview = db.relationship('LinkPreview')
     original_post = db.relationship('Post', remote_side=[id], backref='reposts')
+    timeline_entries = db.relationship('TimelineEntry', backref='post', lazy='dynamic', cascade="all, delete-orphan")
+
+class TimelineEntry(db.Model):
+    """A post copied into a follower's home timeline when it is published."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # timeline owner
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False) # the post's timestamp, for ordering
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='_timeline_user_post_uc'),
+        # Serves keyset pagination of a timeline in (timestamp, post_id) order
+        db.Index('ix_timeline_entry_user_timestamp_post', 'user_id', 'timestamp', 'post_id'),
+        db.Index('ix_timeline_entry_user_author', 'user_id', 'author_id'),
+    )
 
 class Like(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -712,6 +780,9 @@ class Reel(db.Model):
     caption = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see engagement.py
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     likes = db.relationship('Like',
                             primaryjoin="and_(Like.target_type=='reel', foreign(Like.target_id)==Reel.id)",
                             lazy='dynamic',
@@ -740,6 +811,9 @@ class Project(db.Model):
     description = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see engagement.py
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     likes = db.relationship('Like',
                             primaryjoin="and_(Like.target_type=='project', foreign(Like.target_id)==Project.id)",
                             lazy='dynamic',
@@ -771,6 +845,9 @@ class CreativeWork(db.Model):
     cover_image_url = db.Column(db.String(255), nullable=True) # For audio
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see engagement.py
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     likes = db.relationship('Like',
                             primaryjoin="and_(Like.target_type=='creative_work', foreign(Like.target_id)==CreativeWork.id)",
                             lazy='dynamic',
@@ -1089,3 +1166,64 @@ class MutedStory(db.Model):
     muter = db.relationship('User', foreign_keys=[muter_id], backref='muted_stories_users')
     muted = db.relationship('User', foreign_keys=[muted_id], backref='story_muted_by_users')
     __table_args__ = (db.UniqueConstraint('muter_id', 'muted_id', name='_muter_muted_story_uc'),)
+
+class ImageAsset(db.Model):
+    """Resized, re-encoded variants of an uploaded image, produced by image_pipeline."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), unique=True, nullable=False) # original, relative to the static folder
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, ready, failed
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    variants = db.Column(db.JSON, nullable=True) # {'thumb': {'width': w, 'height': h, 'webp': path, 'jpeg': path}, ...}
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+class Blob(db.Model):
+    """An uploaded file stored once under its content hash by blob_store, however many rows use it."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), unique=True, nullable=False) # blobs/ab/cd/<sha256><ext>, relative to the static folder
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see blob_store.py
+    stored_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # last upload of this content
+
+class StorageUsage(db.Model):
+    """Bytes and number of uploaded files used by a chat room or a user, maintained by storage.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    owner_type = db.Column(db.String(20), nullable=False) # 'room' or 'user'
+    owner_id = db.Column(db.Integer, nullable=False)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    files = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('owner_type', 'owner_id', name='_storage_owner_uc'),)
+
+class UploadSession(db.Model):
+    """A resumable chunked upload in progress (see chunked_uploads.py)."""
+    id = db.Column(db.String(32), primary_key=True) # random token, also names the partial file
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    purpose = db.Column(db.String(20), nullable=False) # post_media, library, assignment
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    checksum = db.Column(db.String(64), nullable=False) # expected SHA-256, hex
+    received = db.Column(db.BigInteger, nullable=False, default=0) # bytes written from the start of the file
+    status = db.Column(db.String(20), nullable=False, default='uploading') # uploading, complete, claimed
+    result_path = db.Column(db.String(255), nullable=True) # what the save helper returned
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChatArchiveSegment(db.Model):
+    """One room's archived messages from one month, as a gzipped JSON-lines file (see chat_archive.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('chat_room.id'), nullable=False)
+    month = db.Column(db.String(7), nullable=False) # YYYY-MM of the messages' timestamps
+    path = db.Column(db.String(255), nullable=False) # relative to CHAT_ARCHIVE_FOLDER
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0) # committed length of the file
+    first_message_id = db.Column(db.Integer, nullable=True)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    first_timestamp = db.Column(db.DateTime, nullable=True)
+    last_timestamp = db.Column(db.DateTime, nullable=True)
+    file_paths = db.Column(db.JSON, nullable=True) # uploaded files the archived messages still reference
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    room = db.relationship('ChatRoom', backref=db.backref('archive_segments', lazy='dynamic', cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('room_id', 'month', name='_room_archive_month_uc'),)
@@ -8,6 +8,9 @@ from models import User, UserPage, Draft, Wallet, Subscription, BlockedUser, Com
 from extensions import db
 from forms import ReportProblemForm, ContactForm, FeedbackForm, PremiumUpgradeForm, ProfileAppearanceForm
 from utils import get_or_create_platform_setting
+from image_pipeline import image_pipeline
+from blob_store import store_upload
+from status_tray import status_tray
 
 more_bp = Blueprint('more', __name__, url_prefix='/more')
 
@@ -148,6 +151,8 @@ def unblock_user(user_id):
     if blocked_entry:
         db.session.delete(blocked_entry)
         db.session.commit()
+        status_tray.invalidate(current_user.id)
+        status_tray.invalidate(user_to_unblock.id)
         flash(f'You have unblocked {user_to_unblock.name}.', 'success')
     else:
         flash('You had not blocked this user.', 'info')
@@ -267,17 +272,10 @@ def upgrade_premium():
 
 def save_profile_banner(file):
     filename = secure_filename(file.filename)
-    random_hex = secrets.token_hex(16)
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-    banners_dir = os.path.join(current_app.root_path, 'static/profile_banners')
-    os.makedirs(banners_dir, exist_ok=True)
-    filepath = os.path.join(banners_dir, new_filename)
-
-    # Resize image here if needed using Pillow
-
-    file.save(filepath)
-    return os.path.join('profile_banners', new_filename)
+    relative_path = store_upload(file, f_ext)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
 
 @more_bp.route('/settings/appearance', methods=['GET', 'POST'])
@@ -5,25 +5,20 @@ from forms import PageCreationStep1Form, PageCreationStep2Form, PageCreationStep
 import os
 import secrets
 from werkzeug.utils import secure_filename
+from blob_store import store_upload
+from image_pipeline import image_pipeline
 
 page_bp = Blueprint('pages', __name__, url_prefix='/page')
 
 def save_page_asset(file, subfolder):
-    """Saves a file to a specified subfolder within static/uploads/pages/"""
+    """Saves a page's profile picture or banner to the blob store. `subfolder` is no longer used for placement."""
     filename = secure_filename(file.filename)
-    random_hex = secrets.token_hex(8)
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    # Base path for page assets
-    base_dir = os.path.join(current_app.root_path, 'static/uploads/pages', subfolder)
-    os.makedirs(base_dir, exist_ok=True)
-
-    filepath = os.path.join(base_dir, new_filename)
-    file.save(filepath)
 
     # Return the path relative to the static folder
-    return os.path.join('uploads/pages', subfolder, new_filename)
+    relative_path = store_upload(file, f_ext)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
 @page_bp.route('/create', methods=['GET'])
 @login_required
@@ -63,6 +58,7 @@ def create_page_step2():
             page_data['cover_banner_url'] = save_page_asset(form.cover_banner.data, 'banners')
 
         session['page_creation_data'] = page_data
+        db.session.commit() # record the uploaded blobs; the page that uses them is created in step 4
         return redirect(url_for('pages.create_page_step3'))
 
     return render_template('pages/create/step2_branding.html', form=form)
@@ -1,25 +1,51 @@
-from flask import render_template
-from weasyprint import HTML
+from flask import current_app
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
 import os
 
-def generate_certificate_pdf(certificate, user, course, app):
-    with app.app_context():
-        rendered_html = render_template(
-            'certificate/template.html',
-            student_name=user.name,
-            course_name=course.title,
-            completion_date=certificate.issued_at.strftime('%Y-%m-%d'),
-            certificate_id=certificate.certificate_uid
-        )
+CERTIFICATE_CSS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'certificate', 'certificate.css')
 
-    pdf_folder = os.path.join(app.static_folder, 'certificates')
-    os.makedirs(pdf_folder, exist_ok=True)
+# Parsed once per process by init_worker and reused for every certificate it renders
+_font_config = None
+_stylesheet = None
 
-    file_path = os.path.join(pdf_folder, f'{certificate.certificate_uid}.pdf')
+def init_worker(css_path=CERTIFICATE_CSS):
+    """Parses the certificate stylesheet and loads its web fonts. Runs once in each render process."""
+    global _font_config, _stylesheet
+    _font_config = FontConfiguration()
+    _stylesheet = CSS(filename=css_path, font_config=_font_config)
 
-    HTML(string=rendered_html).write_pdf(file_path)
+def render_certificate_html(certificate, user, course):
+    """
+    Fills in the certificate template. Needs an app context; skips the request context
+    processors so it also works in background threads.
+    """
+    return current_app.jinja_env.get_template('certificate/template.html').render(
+        student_name=user.name,
+        course_name=course.title,
+        completion_date=certificate.issued_at.strftime('%Y-%m-%d'),
+        certificate_id=certificate.certificate_uid
+    )
 
-    # The path should be relative to the static folder for url_for to work
+def write_certificate_pdf(html, file_path):
+    """Renders certificate HTML to a PDF file. Safe to run in a worker process."""
+    if _stylesheet is None:
+        init_worker()
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    HTML(string=html).write_pdf(file_path, stylesheets=[_stylesheet], font_config=_font_config)
+
+def certificate_pdf_paths(certificate, app):
+    """(absolute path to write, path relative to the static folder) for a certificate's PDF."""
+    # The stored path is relative to the static folder for url_for to work
     # and must use forward slashes for URL compatibility.
-    certificate.file_path = f"certificates/{certificate.certificate_uid}.pdf"
+    relative_path = f"certificates/{certificate.certificate_uid}.pdf"
+    return os.path.join(app.static_folder, 'certificates', f'{certificate.certificate_uid}.pdf'), relative_path
+
+def generate_certificate_pdf(certificate, user, course, app):
+    """Renders a certificate in the calling process and sets its file_path."""
+    with app.app_context():
+        rendered_html = render_certificate_html(certificate, user, course)
+
+    file_path, certificate.file_path = certificate_pdf_paths(certificate, app)
+    write_certificate_pdf(rendered_html, file_path)
     return certificate
@@ -0,0 +1,139 @@
+import threading
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+from extensions import db, socketio
+from models import PollOption, PollVote
+
+def _adjust(connection, option_id, delta):
+    table = PollOption.__table__
+    connection.execute(
+        update(table).where(table.c.id == option_id).values(vote_count=table.c.vote_count + delta)
+    )
+
+# PollOption.vote_count is updated with SQL on the flush's own connection, so it commits or rolls
+# back with the vote that changed it. Bulk deletes skip these events; run
+# `flask reconcile-poll-counts` after those.
+
+@event.listens_for(PollVote, 'after_insert')
+def _vote_added(mapper, connection, vote):
+    _adjust(connection, vote.option_id, 1)
+
+@event.listens_for(PollVote, 'after_delete')
+def _vote_removed(mapper, connection, vote):
+    _adjust(connection, vote.option_id, -1)
+
+@event.listens_for(PollVote, 'after_update')
+def _vote_changed(mapper, connection, vote):
+    history = inspect(vote).attrs.option_id.history
+    if not history.has_changes():
+        return
+    for option_id in history.deleted:
+        _adjust(connection, option_id, -1)
+    for option_id in history.added:
+        _adjust(connection, option_id, 1)
+
+def cast_vote(poll, option, user_id):
+    """
+    Records `user_id`'s vote for `option`, moving their earlier vote on the poll if they had one.
+    The counters follow through the events above. Does not commit. Returns the ids of the
+    options whose counts changed (none if the vote was already there).
+    """
+    vote = PollVote.query.filter_by(poll_id=poll.id, user_id=user_id).first()
+    if vote is None:
+        try:
+            # A savepoint, so a double-submitted first vote falls through to the update below
+            with db.session.begin_nested():
+                db.session.add(PollVote(poll_id=poll.id, option_id=option.id, user_id=user_id))
+            return [option.id]
+        except IntegrityError:
+            vote = PollVote.query.filter_by(poll_id=poll.id, user_id=user_id).first()
+    if vote.option_id == option.id:
+        return []
+    previous_option_id = vote.option_id
+    vote.option_id = option.id
+    return [previous_option_id, option.id]
+
+def poll_tallies(poll):
+    """[{'id', 'text', 'votes', 'percentage'}] for a poll's options, from the stored counters."""
+    total_votes = sum(option.vote_count for option in poll.options)
+    return [{
+        'id': option.id,
+        'text': option.text,
+        'votes': option.vote_count,
+        'percentage': round(option.vote_count / total_votes * 100) if total_votes > 0 else 0
+    } for option in poll.options]
+
+def reconcile_poll_counts():
+    """Recomputes every option's vote_count from PollVote and fixes any that drifted. Does not commit."""
+    table = PollOption.__table__
+    actual = select(func.count()).where(PollVote.option_id == table.c.id).scalar_subquery()
+    return db.session.execute(update(table).where(table.c.vote_count != actual).values(vote_count=actual)).rowcount
+
+class PollUpdateBroadcaster:
+    """
+    Coalesces the 'poll_update' events of busy chat polls.
+
+    After a vote commits, `changed` records which options moved. The first change in a window
+    schedules a flush POLL_UPDATE_INTERVAL_MS later, and every vote until then joins it, so each
+    poll emits at most one update per interval however many people vote. The update carries the
+    current counts of just the changed options, read from the counters when it is sent, plus
+    the poll's total. POLL_UPDATE_INTERVAL_MS = 0 sends each update straight away.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0.25
+        self.sent = 0
+        self.coalesced = 0
+        self._pending = {} # {poll_id: (room_id, set of option ids)}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with self._lock:
+            self.app = app
+            self.interval = app.config.get('POLL_UPDATE_INTERVAL_MS', 250) / 1000
+            self._pending.clear()
+
+    def changed(self, poll_id, room_id, option_ids):
+        if not option_ids:
+            return
+        with self._lock:
+            pending = self._pending.get(poll_id)
+            if pending is not None:
+                pending[1].update(option_ids)
+                self.coalesced += 1
+                return
+            self._pending[poll_id] = (room_id, set(option_ids))
+        if self.interval <= 0:
+            self.flush(poll_id)
+        else:
+            socketio.start_background_task(self._flush_later, poll_id)
+
+    def _flush_later(self, poll_id):
+        socketio.sleep(self.interval)
+        with self.app.app_context():
+            try:
+                self.flush(poll_id)
+            finally:
+                db.session.remove()
+
+    def flush(self, poll_id):
+        """Emits the pending update for one poll, if there is one."""
+        with self._lock:
+            pending = self._pending.pop(poll_id, None)
+        if pending is None:
+            return
+        room_id, option_ids = pending
+        counts = db.session.query(PollOption.id, PollOption.vote_count).filter(PollOption.id.in_(option_ids)).all()
+        total_votes = db.session.query(func.sum(PollOption.vote_count)).filter(PollOption.poll_id == poll_id).scalar()
+        socketio.emit('poll_update', {
+            'poll_id': poll_id,
+            'room_id': room_id,
+            'options': [{'id': option_id, 'votes': votes} for option_id, votes in counts],
+            'total_votes': total_votes or 0
+        }, to=room_id)
+        self.sent += 1
+
+poll_updates = PollUpdateBroadcaster()
@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import threading
+import time
+
+class MemoryPresenceStore:
+    """
+    Keeps presence and group-call membership in this process only.
+    Fine for a single Socket.IO worker; use SQLitePresenceStore when running several.
+    """
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sids = {} # {user_id: (sid, expires_at)}
+        self._calls = {} # {call_id: {user_id: (sid, expires_at)}}
+
+    def set_online(self, user_id, sid):
+        with self._lock:
+            self._sids[user_id] = (sid, time.time() + self.ttl)
+
+    def heartbeat(self, user_id, sid):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._sids[user_id] = (sid, expires_at)
+            for participants in self._calls.values():
+                if user_id in participants and participants[user_id][0] == sid:
+                    participants[user_id] = (sid, expires_at)
+
+            # Heartbeats double as the sweeper for entries whose connection went away silently
+            for uid in [uid for uid, entry in self._sids.items() if entry[1] <= now]:
+                del self._sids[uid]
+            for call_id, participants in list(self._calls.items()):
+                for uid in [uid for uid, entry in participants.items() if entry[1] <= now]:
+                    del participants[uid]
+                if not participants:
+                    del self._calls[call_id]
+
+    def set_offline(self, user_id, sid):
+        """Removes the user if `sid` is still their current connection. Returns True if it was."""
+        with self._lock:
+            current = self._sids.get(user_id)
+            if not current or current[0] != sid:
+                return False
+            del self._sids[user_id]
+            return True
+
+    def get_sid(self, user_id):
+        with self._lock:
+            entry = self._sids.get(user_id)
+            if entry and entry[1] > time.time():
+                return entry[0]
+            return None
+
+    def is_online(self, user_id):
+        return self.get_sid(user_id) is not None
+
+    def join_call(self, call_id, user_id, sid):
+        """Adds a user to a group call and returns the participants that were already in it."""
+        now = time.time()
+        with self._lock:
+            participants = self._calls.setdefault(str(call_id), {})
+            existing = {uid: entry[0] for uid, entry in participants.items() if entry[1] > now and uid != user_id}
+            participants[user_id] = (sid, now + self.ttl)
+            return existing
+
+    def leave_call(self, call_id, user_id):
+        """Removes a user from a group call and returns the remaining participants, or None if they weren't in it."""
+        now = time.time()
+        with self._lock:
+            participants = self._calls.get(str(call_id))
+            if not participants or user_id not in participants:
+                return None
+            del participants[user_id]
+            remaining = {uid: entry[0] for uid, entry in participants.items() if entry[1] > now}
+            if not remaining:
+                del self._calls[str(call_id)]
+            return remaining
+
+    def leave_all_calls(self, user_id, sid):
+        """
+        Removes a connection from every call it joined, even if the user has since connected
+        from somewhere else. Returns {call_id: remaining participants}.
+        """
+        with self._lock:
+            call_ids = [
+                call_id for call_id, participants in self._calls.items()
+                if user_id in participants and participants[user_id][0] == sid
+            ]
+        left = {}
+        for call_id in call_ids:
+            remaining = self.leave_call(call_id, user_id)
+            if remaining is not None:
+                left[call_id] = remaining
+        return left
+
+
+class SQLitePresenceStore:
+    """
+    Shares presence and group-call membership between workers through a WAL-mode SQLite file.
+    Entries expire after `ttl` seconds unless refreshed by a heartbeat, so a crashed worker
+    cannot leave users online forever.
+    """
+
+    def __init__(self, path, ttl=90):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # WAL lets every worker read presence while another one is writing
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS presence (user_id INTEGER PRIMARY KEY, sid TEXT NOT NULL, expires_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS call_participant (call_id TEXT NOT NULL, user_id INTEGER NOT NULL, sid TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (call_id, user_id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_call_participant_user_id ON call_participant (user_id)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return _Transaction(conn)
+
+    def set_online(self, user_id, sid):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO presence (user_id, sid, expires_at) VALUES (?, ?, ?)',
+                         (user_id, sid, time.time() + self.ttl))
+
+    def heartbeat(self, user_id, sid):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO presence (user_id, sid, expires_at) VALUES (?, ?, ?)',
+                         (user_id, sid, now + self.ttl))
+            conn.execute('UPDATE call_participant SET expires_at = ? WHERE user_id = ? AND sid = ?', (now + self.ttl, user_id, sid))
+            # Heartbeats double as the sweeper for entries left behind by dead workers
+            conn.execute('DELETE FROM presence WHERE expires_at <= ?', (now,))
+            conn.execute('DELETE FROM call_participant WHERE expires_at <= ?', (now,))
+
+    def set_offline(self, user_id, sid):
+        with self._connect() as conn:
+            cursor = conn.execute('DELETE FROM presence WHERE user_id = ? AND sid = ?', (user_id, sid))
+            return cursor.rowcount > 0
+
+    def get_sid(self, user_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT sid FROM presence WHERE user_id = ? AND expires_at > ?',
+                               (user_id, time.time())).fetchone()
+        return row[0] if row else None
+
+    def is_online(self, user_id):
+        return self.get_sid(user_id) is not None
+
+    def join_call(self, call_id, user_id, sid):
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute('SELECT user_id, sid FROM call_participant WHERE call_id = ? AND user_id != ? AND expires_at > ?',
+                                (str(call_id), user_id, now)).fetchall()
+            conn.execute('INSERT OR REPLACE INTO call_participant (call_id, user_id, sid, expires_at) VALUES (?, ?, ?, ?)',
+                         (str(call_id), user_id, sid, now + self.ttl))
+        return dict(rows)
+
+    def leave_call(self, call_id, user_id):
+        with self._connect() as conn:
+            cursor = conn.execute('DELETE FROM call_participant WHERE call_id = ? AND user_id = ?', (str(call_id), user_id))
+            if cursor.rowcount == 0:
+                return None
+            rows = conn.execute('SELECT user_id, sid FROM call_participant WHERE call_id = ? AND expires_at > ?',
+                                (str(call_id), time.time())).fetchall()
+        return dict(rows)
+
+    def leave_all_calls(self, user_id, sid):
+        with self._connect() as conn:
+            call_ids = [row[0] for row in conn.execute('SELECT call_id FROM call_participant WHERE user_id = ? AND sid = ?', (user_id, sid))]
+        left = {}
+        for call_id in call_ids:
+            remaining = self.leave_call(call_id, user_id)
+            if remaining is not None:
+                left[call_id] = remaining
+        return left
+
+
+class _Transaction:
+    """Runs a block of statements in one immediate transaction and closes the connection afterwards."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.conn.close()
+        return False
+
+
+class Presence:
+    """
+    Flask-style extension that picks the presence backend from the app config:
+    PRESENCE_BACKEND ('memory' or 'sqlite'), PRESENCE_DB_PATH and PRESENCE_TTL (seconds).
+    """
+
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('PRESENCE_BACKEND', 'memory')
+        ttl = app.config.get('PRESENCE_TTL', 90)
+        if backend == 'sqlite':
+            path = app.config.get('PRESENCE_DB_PATH') or os.path.join(app.instance_path, 'presence.db')
+            self.store = SQLitePresenceStore(path, ttl=ttl)
+        elif backend == 'memory':
+            self.store = MemoryPresenceStore(ttl=ttl)
+        else:
+            raise ValueError(f"Unknown PRESENCE_BACKEND: {backend}")
+
+    def __getattr__(self, name):
+        store = self.__dict__.get('store')
+        if store is None:
+            raise RuntimeError("Presence store is not initialized. Call presence.init_app(app) first.")
+        return getattr(store, name)
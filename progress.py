@@ -0,0 +1,209 @@
+import threading
+import time
+from sqlalchemy.orm import contains_eager
+from models import Module, Quiz, Assignment, FinalExam, QuizSubmission, AssignmentSubmission, ExamSubmission
+
+PASSING_GRADES = {'a', 'b', 'c', 'pass'}
+
+class CourseRecords:
+    """A student's assessments and submissions for one course, as loaded by `load_course_records`."""
+
+    def __init__(self, course):
+        self.course = course
+        self.quizzes = [] # [(quiz, latest submission, best-scoring submission)]
+        self.assignments = [] # [(assignment, submission)]
+        self.final_exam = None
+        self.exam_submission = None # latest attempt
+        self.best_exam_submission = None
+
+def load_course_records(student_id, courses):
+    """
+    Loads everything needed to work out a student's progress in several courses with six
+    queries, however many courses, quizzes and assignments there are.
+    Returns {course_id: CourseRecords}.
+    """
+    records = {course.id: CourseRecords(course) for course in courses}
+    if not records:
+        return records
+    course_ids = list(records)
+
+    quizzes = Quiz.query.join(Module).options(contains_eager(Quiz.module)).filter(
+        Module.course_id.in_(course_ids)
+    ).order_by(Module.order, Module.id).all()
+    assignments = Assignment.query.join(Module).options(contains_eager(Assignment.module)).filter(
+        Module.course_id.in_(course_ids)
+    ).order_by(Module.order, Module.id).all()
+    exams = FinalExam.query.filter(FinalExam.course_id.in_(course_ids)).all()
+
+    latest_quiz, best_quiz = {}, {}
+    if quizzes:
+        for submission in QuizSubmission.query.filter(
+            QuizSubmission.student_id == student_id,
+            QuizSubmission.quiz_id.in_([quiz.id for quiz in quizzes])
+        ).order_by(QuizSubmission.id):
+            latest_quiz[submission.quiz_id] = submission
+            best = best_quiz.get(submission.quiz_id)
+            if best is None or (submission.score or 0) > (best.score or 0):
+                best_quiz[submission.quiz_id] = submission
+
+    assignment_submissions = {}
+    if assignments:
+        for submission in AssignmentSubmission.query.filter(
+            AssignmentSubmission.student_id == student_id,
+            AssignmentSubmission.assignment_id.in_([assignment.id for assignment in assignments])
+        ).order_by(AssignmentSubmission.id):
+            assignment_submissions.setdefault(submission.assignment_id, submission)
+
+    latest_exam, best_exam = {}, {}
+    if exams:
+        for submission in ExamSubmission.query.filter(
+            ExamSubmission.student_id == student_id,
+            ExamSubmission.final_exam_id.in_([exam.id for exam in exams])
+        ).order_by(ExamSubmission.id):
+            latest_exam[submission.final_exam_id] = submission
+            if submission.score is not None:
+                best = best_exam.get(submission.final_exam_id)
+                if best is None or submission.score > best.score:
+                    best_exam[submission.final_exam_id] = submission
+
+    for quiz in quizzes:
+        records[quiz.module.course_id].quizzes.append((quiz, latest_quiz.get(quiz.id), best_quiz.get(quiz.id)))
+    for assignment in assignments:
+        records[assignment.module.course_id].assignments.append((assignment, assignment_submissions.get(assignment.id)))
+    for exam in exams:
+        course_records = records[exam.course_id]
+        course_records.final_exam = exam
+        course_records.exam_submission = latest_exam.get(exam.id)
+        course_records.best_exam_submission = best_exam.get(exam.id)
+    return records
+
+def compute_progress(records):
+    """
+    Works out progress from a CourseRecords without touching the database: which quizzes are
+    passed and assignments approved, the completion percentage, and whether the student may
+    request a certificate (with the reasons if not).
+    """
+    course = records.course
+    progress = {
+        'quizzes': [],
+        'assignments': [],
+        'final_exam': None,
+        'all_prerequisites_met': True,
+        'can_request_certificate': False,
+        'reasons': [],
+        'percentage': 0
+    }
+
+    for quiz, submission, _ in records.quizzes:
+        passed = bool(submission and submission.score is not None and submission.score >= quiz.pass_mark)
+        if not passed:
+            progress['all_prerequisites_met'] = False
+            progress['reasons'].append(f"Quiz not passed: {quiz.module.title}")
+        progress['quizzes'].append({'quiz': quiz, 'submission': submission, 'passed': passed})
+
+    for assignment, submission in records.assignments:
+        approved = bool(submission and submission.grade and submission.grade.lower() in PASSING_GRADES)
+        if not approved:
+            progress['all_prerequisites_met'] = False
+            progress['reasons'].append(f"Assignment not approved: {assignment.title}")
+        progress['assignments'].append({'assignment': assignment, 'submission': submission, 'approved': approved})
+
+    if course.final_exam_enabled and records.final_exam:
+        exam = records.final_exam
+        submission = records.exam_submission
+        exam_passed = bool(submission and submission.score is not None and submission.score >= exam.pass_mark)
+        progress['final_exam'] = {'exam': exam, 'submission': submission, 'passed': exam_passed}
+
+        if progress['all_prerequisites_met'] and exam_passed:
+            progress['can_request_certificate'] = True
+        elif not exam_passed:
+            progress['reasons'].append("Final exam not passed.")
+    # If final exam is not enabled, certificate eligibility depends only on prerequisites
+    elif not course.final_exam_enabled:
+        progress['can_request_certificate'] = progress['all_prerequisites_met']
+
+    total_items = len(progress['quizzes']) + len(progress['assignments'])
+    if total_items:
+        completed_items = sum(1 for q in progress['quizzes'] if q['passed'])
+        completed_items += sum(1 for a in progress['assignments'] if a['approved'])
+        progress['percentage'] = (completed_items / total_items) * 100
+    return progress
+
+def get_course_progress(user, course):
+    """
+    Checks a user's progress in a given course and determines eligibility for the final exam and certificate.
+    """
+    return compute_progress(load_course_records(user.id, [course])[course.id])
+
+def _snapshot(progress):
+    # Plain values only, so a snapshot can outlive the session that computed it
+    return {
+        'percentage': progress['percentage'],
+        'all_prerequisites_met': progress['all_prerequisites_met'],
+        'can_request_certificate': progress['can_request_certificate'],
+        'reasons': list(progress['reasons'])
+    }
+
+class ProgressCache:
+    """
+    Optional per-process cache of progress snapshots keyed by (student_id, course_id).
+
+    Snapshots hold the percentage, certificate eligibility and reasons, which is all the
+    dashboard and course lists show. PROGRESS_CACHE_TTL sets their lifetime in seconds; the
+    default of 0 turns caching off. Code that records or changes a grade must call
+    `invalidate` after committing, as must code that changes a course's assessments.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self._entries = {} # {(student_id, course_id): (snapshot, expires_at)}
+        self._generation = 0 # bumped on every eviction
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PROGRESS_CACHE_TTL', 0)
+        self.clear()
+
+    def get_snapshots(self, student_id, courses):
+        """Returns {course_id: snapshot} for the given courses, computing the missing ones together."""
+        now = time.time()
+        snapshots = {}
+        with self._lock:
+            generation = self._generation
+            if self.ttl > 0:
+                for course in courses:
+                    cached = self._entries.get((student_id, course.id))
+                    if cached and cached[1] > now:
+                        snapshots[course.id] = cached[0]
+
+        missing = [course for course in courses if course.id not in snapshots]
+        computed = {
+            course_id: _snapshot(compute_progress(records))
+            for course_id, records in load_course_records(student_id, missing).items()
+        }
+        snapshots.update(computed)
+
+        if self.ttl > 0 and computed:
+            with self._lock:
+                # Don't store snapshots that were computed before an eviction landed
+                if generation == self._generation:
+                    for course_id, snapshot in computed.items():
+                        self._entries[(student_id, course_id)] = (snapshot, now + self.ttl)
+        return snapshots
+
+    def invalidate(self, student_id=None, course_id=None):
+        """Evicts one student's snapshot for a course, all of a student's, or all of a course's."""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries
+                        if (student_id is None or key[0] == student_id) and (course_id is None or key[1] == course_id)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+progress_cache = ProgressCache()
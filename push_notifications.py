@@ -1,7 +1,18 @@
 import firebase_admin
 from firebase_admin import credentials, messaging
 import os
-from models import User
+import queue
+import threading
+import time
+from extensions import db
+from background import WorkerPool
+from models import User, ChatRoom, ChatRoomMember, MutedRoom, FCMToken
+
+# FCM accepts at most this many registration tokens per multicast request
+MULTICAST_LIMIT = 500
+
+# Errors meaning the token will never work again and should be forgotten
+INVALID_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
 
 def initialize_firebase():
     """
@@ -19,11 +30,140 @@ def initialize_firebase():
     else:
         print("GOOGLE_APPLICATION_CREDENTIALS environment variable not set. Push notifications will be disabled.")
 
+class FirebaseTransport:
+    """Sends multicasts through Firebase Cloud Messaging."""
+
+    def is_available(self):
+        return bool(firebase_admin._apps)
+
+    def send(self, tokens, title, body, data=None):
+        """Sends one multicast and returns the tokens Firebase reported as no longer valid."""
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=body,
+            ),
+            data=data or {},
+            tokens=tokens,
+        )
+        response = messaging.send_each_for_multicast(message)
+        print(f'Successfully sent message to {response.success_count} devices.')
+        return [
+            tokens[idx] for idx, resp in enumerate(response.responses)
+            if not resp.success and isinstance(resp.exception, INVALID_TOKEN_ERRORS)
+        ]
+
+class FakeTransport:
+    """
+    Records multicasts in memory instead of calling Firebase, so the dispatcher can be
+    tested and load-tested offline. `latency` simulates the Firebase round trip.
+    """
+
+    def __init__(self, invalid_tokens=None, latency=0):
+        self.invalid_tokens = set(invalid_tokens or ())
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        return True
+
+    def send(self, tokens, title, body, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent.append({'tokens': list(tokens), 'title': title, 'body': body, 'data': data or {}})
+        return [token for token in tokens if token in self.invalid_tokens]
+
+class NotificationDispatcher(WorkerPool):
+    """
+    Fans chat notifications out to room members from a bounded queue served by a pool of
+    background workers, so socket handlers never wait on Firebase.
+
+    Configured from PUSH_TRANSPORT ('firebase' or 'fake'), PUSH_QUEUE_SIZE and PUSH_WORKERS.
+    """
+
+    name = 'push-worker'
+
+    def __init__(self, app=None):
+        self.transport = None
+        self.dropped = 0
+        super().__init__(app)
+
+    def init_app(self, app):
+        transport = app.config.get('PUSH_TRANSPORT', 'firebase')
+        if transport == 'fake':
+            transport = FakeTransport()
+        elif transport == 'firebase':
+            transport = FirebaseTransport()
+        else:
+            raise ValueError(f"Unknown PUSH_TRANSPORT: {transport}")
+
+        super().init_app(app, app.config.get('PUSH_WORKERS', 4), app.config.get('PUSH_QUEUE_SIZE', 1000))
+        with self._lock:
+            self.transport = transport
+            self.dropped = 0
+
+    def notify_room(self, room_id, sender_id, title, body, data=None):
+        """
+        Queues a notification for every member of a room except the sender.
+        Returns False if notifications are disabled or the queue is full.
+        """
+        if not self.transport or not self.transport.is_available():
+            return False
+
+        try:
+            self.submit((room_id, sender_id, title, body, data), block=False)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print(f"Notification queue is full, dropped notification for room {room_id}.")
+            return False
+        return True
+
+    def process(self, job):
+        self._deliver(*job)
+
+    def _deliver(self, room_id, sender_id, title, body, data):
+        room = ChatRoom.query.get(room_id)
+        if not room:
+            return
+
+        # Private chats follow the message setting, everything else the group setting
+        if room.room_type == 'private':
+            preference = User.message_notifications_enabled
+        else:
+            preference = User.group_notifications_enabled
+
+        muted_user_ids = db.session.query(MutedRoom.user_id).filter(MutedRoom.room_id == room_id)
+        tokens = [token for (token,) in db.session.query(FCMToken.token).join(
+            User, User.id == FCMToken.user_id
+        ).join(
+            ChatRoomMember, ChatRoomMember.user_id == User.id
+        ).filter(
+            ChatRoomMember.chat_room_id == room_id,
+            User.id != sender_id,
+            preference.isnot(False),
+            User.id.notin_(muted_user_ids)
+        ).all()]
+
+        invalid_tokens = []
+        for start in range(0, len(tokens), MULTICAST_LIMIT):
+            invalid_tokens.extend(self.transport.send(tokens[start:start + MULTICAST_LIMIT], title, body, data))
+
+        if invalid_tokens:
+            FCMToken.query.filter(FCMToken.token.in_(invalid_tokens)).delete(synchronize_session=False)
+            db.session.commit()
+            print(f'Pruned {len(invalid_tokens)} invalid FCM tokens.')
+
+notification_dispatcher = NotificationDispatcher()
+
 def send_push_notification(user_id, title, body, data=None):
     """
     Sends a push notification to a specific user.
     """
-    if not firebase_admin._apps:
+    transport = FirebaseTransport()
+    if not transport.is_available():
         # Silently fail if Firebase is not initialized
         return
 
@@ -36,24 +176,9 @@ def send_push_notification(user_id, title, body, data=None):
     if not registration_tokens:
         return
 
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data=data or {},
-        tokens=registration_tokens,
-    )
-
     try:
-        response = messaging.send_multicast(message)
-        print(f'Successfully sent message to {response.success_count} devices.')
-        if response.failure_count > 0:
-            responses = response.responses
-            failed_tokens = []
-            for idx, resp in enumerate(responses):
-                if not resp.success:
-                    failed_tokens.append(registration_tokens[idx])
+        failed_tokens = transport.send(registration_tokens, title, body, data)
+        if failed_tokens:
             print(f'List of failed tokens: {failed_tokens}')
     except Exception as e:
         print(f"Error sending push notification: {e}")
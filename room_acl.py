@@ -0,0 +1,122 @@
+import threading
+import time
+from models import ChatRoomMember, BlockedUser, MutedUser
+
+def check_room_access(user, room):
+    """Works out from the database whether a user may read and post in a chat room."""
+    if user.role == 'admin':
+        return True
+
+    # Specific student restrictions
+    if user.role == 'student':
+        is_member = ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
+        if room.room_type == 'course' and room.course_room:
+            return is_member or user.is_enrolled(room.course_room)
+        # Students can only access rooms they are members of (no public access by default)
+        return is_member
+
+    if room.room_type == 'private':
+        # Check if either user has blocked the other
+        members = room.members.all()
+        if len(members) == 2:
+            other_user_id = members[0].user_id if members[0].user_id != user.id else members[1].user_id
+
+            # Check if current user blocked the other user
+            if BlockedUser.query.filter_by(blocker_id=user.id, blocked_id=other_user_id).first():
+                return False
+            # Check if the other user blocked the current user
+            if BlockedUser.query.filter_by(blocker_id=other_user_id, blocked_id=user.id).first():
+                return False
+
+    if room.room_type == 'public' or room.room_type == 'community_channel':
+        return True
+
+    # Check for course-based access for course rooms
+    if room.room_type == 'course' and room.course_room:
+        if user.id == room.course_room.instructor_id or user.is_enrolled(room.course_room):
+            return True
+
+    # Check for explicit membership
+    return ChatRoomMember.query.filter_by(user_id=user.id, chat_room_id=room.id).count() > 0
+
+class RoomAccessCache:
+    """
+    Per-process cache of room authorization and mute decisions keyed by (user_id, room_id).
+
+    Code that changes membership, enrollment, blocks or mutes must call `invalidate` after
+    committing. Entries also expire after ROOM_ACL_TTL seconds, which bounds how long another
+    worker's process can keep serving a decision this one already evicted.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self._authorized = {} # {(user_id, room_id): (bool, expires_at)}
+        self._muted = {} # {(user_id, room_id): (bool, expires_at)}
+        self._generation = 0 # bumped on every eviction
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('ROOM_ACL_TTL', 300)
+        self.clear()
+
+    def is_authorized(self, user, room):
+        if user.role == 'admin':
+            return True
+        return self._lookup(self._authorized, (user.id, room.id), lambda: check_room_access(user, room))
+
+    def is_muted(self, user_id, room_id):
+        return self._lookup(
+            self._muted, (user_id, room_id),
+            lambda: MutedUser.query.filter_by(user_id=user_id, room_id=room_id).first() is not None
+        )
+
+    def invalidate(self, user_id=None, room_id=None):
+        """
+        Evicts cached decisions for one (user, room) pair, every room of a user, or every
+        user of a room, depending on which arguments are given.
+        """
+        with self._lock:
+            self._generation += 1
+            for entries in (self._authorized, self._muted):
+                for key in [key for key in entries
+                            if (user_id is None or key[0] == user_id) and (room_id is None or key[1] == room_id)]:
+                    del entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._authorized.clear()
+            self._muted.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._authorized) + len(self._muted),
+            }
+
+    def _lookup(self, entries, key, compute):
+        now = time.time()
+        with self._lock:
+            cached = entries.get(key)
+            if cached and cached[1] > now:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+        with self._lock:
+            # Don't store a decision that was computed before an eviction landed
+            if generation == self._generation:
+                entries[key] = (value, now + self.ttl)
+        return value
+
+room_access = RoomAccessCache()
@@ -1,77 +1,38 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, send_from_directory, jsonify, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify, current_app, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from datetime import datetime, timedelta
 import random
 import secrets
 import os
 from werkzeug.utils import secure_filename
-from models import User, Course, Category, CourseComment, Lesson, LibraryMaterial, Assignment, AssignmentSubmission, Quiz, FinalExam, QuizSubmission, ExamSubmission, Enrollment, LessonCompletion, Module, Certificate, CertificateRequest, LibraryPurchase, ChatRoom, ChatRoomMember, MutedRoom, UserLastRead, ChatMessage, ExamViolation, GroupRequest, Choice, Answer, Status, Community, Poll, ChatClearTimestamp, SupportTicket, MutedStatusUser, LinkPreview, FCMToken, CallHistory, Post, Badge, SocialLink
+from models import User, Course, Category, CourseComment, Lesson, LibraryMaterial, Assignment, AssignmentSubmission, Quiz, FinalExam, QuizSubmission, ExamSubmission, Enrollment, LessonCompletion, Module, Certificate, CertificateRequest, LibraryPurchase, ChatRoom, ChatRoomMember, MutedRoom, UserLastRead, ChatMessage, ExamViolation, GroupRequest, Choice, Answer, Status, StatusView, Community, Poll, PollOption, ChatClearTimestamp, SupportTicket, MutedStatusUser, FCMToken, CallHistory, Post, Badge, SocialLink
 from forms import EditProfileForm, AddBadgeForm, AddSocialLinkForm, AddCertificateForm, EditBadgeForm, EditSocialLinkForm
 from extensions import db
-from utils import save_chat_file, save_status_file, get_or_create_platform_setting, is_contact, get_or_create_private_room
+from utils import save_chat_file, save_status_file, get_or_create_platform_setting, is_contact, get_or_create_private_room, encode_cursor
+from chat_unread import get_room_summaries, get_total_unread_count, invalidate_unread_counts, clear_unread_count, read_upto
+from room_acl import room_access
+from chat_export import generate_export, EXPORT_FORMATS
+from search_index import search_index
+from timeline import remove_author
+from progress import get_course_progress, load_course_records, progress_cache
+from grading import answer_keys, grade_exam_submission, grade_quiz_answers
+from image_pipeline import image_pipeline
+from storage import room_storage_summary, user_usage, quota_for, within_quota, upload_size, release_messages
+from chunked_uploads import claim_upload
+from link_previews import link_previewer, serialize_preview
+from status_tray import status_tray, categorize
+from polls import cast_vote, poll_tallies
+from file_delivery import send_protected, signed_url, load_signed_url, url_ttl, download_counter, starts_download
+from chat_history import get_history_page, HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE
+from chat_archive import get_history
 from datetime import timedelta
 import re
 from flask import url_for
 import json
-import requests
-from bs4 import BeautifulSoup
 from PIL import Image
 
 main = Blueprint('main', __name__)
 
-def get_course_progress(user, course):
-    """
-    Checks a user's progress in a given course and determines eligibility for the final exam and certificate.
-    """
-    progress = {
-        'quizzes': [],
-        'assignments': [],
-        'final_exam': None,
-        'all_prerequisites_met': True,
-        'can_request_certificate': False,
-        'reasons': []
-    }
-
-    PASSING_GRADES = {'a', 'b', 'c', 'pass'}
-
-    # Check quizzes
-    all_quizzes = Quiz.query.join(Module).filter(Module.course_id == course.id).all()
-    for quiz in all_quizzes:
-        latest_submission = QuizSubmission.query.filter_by(student_id=user.id, quiz_id=quiz.id).order_by(QuizSubmission.id.desc()).first()
-        passed = latest_submission and latest_submission.score >= quiz.pass_mark
-        if not passed:
-            progress['all_prerequisites_met'] = False
-            progress['reasons'].append(f"Quiz not passed: {quiz.module.title}")
-        progress['quizzes'].append({'quiz': quiz, 'submission': latest_submission, 'passed': passed})
-
-    # Check assignments
-    all_assignments = Assignment.query.join(Module).filter(Module.course_id == course.id).all()
-    for assignment in all_assignments:
-        submission = AssignmentSubmission.query.filter_by(student_id=user.id, assignment_id=assignment.id).first()
-        approved = submission and submission.grade and submission.grade.lower() in PASSING_GRADES
-        if not approved:
-            progress['all_prerequisites_met'] = False
-            progress['reasons'].append(f"Assignment not approved: {assignment.title}")
-        progress['assignments'].append({'assignment': assignment, 'submission': submission, 'approved': approved})
-
-    # Check final exam status
-    if course.final_exam_enabled and course.final_exam:
-        exam_submission = ExamSubmission.query.filter_by(student_id=user.id, final_exam_id=course.final_exam.id).order_by(ExamSubmission.id.desc()).first()
-        exam_passed = exam_submission and exam_submission.score is not None and exam_submission.score >= course.final_exam.pass_mark
-        progress['final_exam'] = {'exam': course.final_exam, 'submission': exam_submission, 'passed': exam_passed}
-
-        if progress['all_prerequisites_met'] and exam_passed:
-            progress['can_request_certificate'] = True
-        elif not exam_passed:
-            progress['reasons'].append("Final exam not passed.")
-
-    # If final exam is not enabled, certificate eligibility depends only on prerequisites
-    elif not course.final_exam_enabled:
-        if progress['all_prerequisites_met']:
-            progress['can_request_certificate'] = True
-
-    return progress
-
 @main.route('/')
 @main.route('/home')
 def home():
@@ -104,7 +65,7 @@ def courses():
     # Search
     search_term = request.args.get('search')
     if search_term:
-        query = query.filter(Course.title.ilike(f'%{search_term}%'))
+        query = search_index.filter(query, 'course', search_term)
 
     # Category filter
     category_ids = request.args.getlist('category')
@@ -171,6 +132,7 @@ def save_assignment_file(file):
     _, f_ext = os.path.splitext(file.filename)
     filename = random_hex + f_ext
     filepath = os.path.join(current_app.root_path, 'static/assignments', filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
     file.save(filepath)
     return filename
 
@@ -198,29 +160,29 @@ def submit_assignment(assignment_id):
 
     text_submission = request.form.get('text_submission')
     file = request.files.get('file_submission')
+    # A file sent ahead through the resumable upload API
+    upload = claim_upload(request.form['upload_id'], current_user.id, 'assignment') if request.form.get('upload_id') else None
 
     file_path = None
     # Basic validation
     if assignment.submission_type == 'text' and not text_submission:
         flash('Text submission is required.', 'danger')
         return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
-    if assignment.submission_type == 'file' and not file:
+    if assignment.submission_type == 'file' and not file and not upload:
         flash('A file upload is required.', 'danger')
         return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
-    if assignment.submission_type == 'both' and not text_submission and not file:
+    if assignment.submission_type == 'both' and not text_submission and not file and not upload:
         flash('At least one form of submission (text or file) is required.', 'danger')
         return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
 
-    if file:
+    if file or upload:
         # Check file size
-        if assignment.max_file_size:
-            max_bytes = assignment.max_file_size * 1024 * 1024
-            if len(file.read()) > max_bytes:
-                flash(f'File size exceeds the maximum limit of {assignment.max_file_size}MB.', 'danger')
-                return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
-            file.seek(0) # Reset file pointer after reading
+        size = upload.total_size if upload else upload_size(file)
+        if assignment.max_file_size and size > assignment.max_file_size * 1024 * 1024:
+            flash(f'File size exceeds the maximum limit of {assignment.max_file_size}MB.', 'danger')
+            return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
 
-        file_path = save_assignment_file(file)
+        file_path = upload.result_path if upload else save_assignment_file(file)
 
     # Check for existing submission to update it (resubmission)
     submission = AssignmentSubmission.query.filter_by(student_id=current_user.id, assignment_id=assignment.id).first()
@@ -240,6 +202,7 @@ def submit_assignment(assignment_id):
         db.session.add(submission)
 
     db.session.commit()
+    progress_cache.invalidate(student_id=current_user.id, course_id=assignment.module.course_id)
     flash('Your assignment has been submitted.', 'success')
 
     return redirect(url_for('main.view_assignment', assignment_id=assignment.id))
@@ -288,17 +251,13 @@ def submit_quiz(quiz_id):
         flash('You have already submitted the maximum number of attempts for this quiz.', 'danger')
         return redirect(url_for('main.course_detail', course_id=quiz.module.course.id))
 
-    score = 0
+    answer_key = answer_keys.for_quiz(quiz)
     answers = {}
-    questions = quiz.questions.all()
-    for question in questions:
-        user_answer_id = request.form.get(f'q_{question.id}')
+    for question in answer_key.questions:
+        user_answer_id = request.form.get(f'q_{question.question_id}')
         if user_answer_id:
-            answers[str(question.id)] = user_answer_id
-            if int(user_answer_id) == question.correct_choice_id:
-                score += 1
-
-    final_score = (score / len(questions)) * 100 if questions else 0
+            answers[str(question.question_id)] = user_answer_id
+    final_score = grade_quiz_answers(answer_key, answers)
 
     new_submission = QuizSubmission(
         quiz_id=quiz.id,
@@ -308,6 +267,7 @@ def submit_quiz(quiz_id):
     )
     db.session.add(new_submission)
     db.session.commit()
+    progress_cache.invalidate(student_id=current_user.id, course_id=quiz.module.course_id)
     flash(f'Quiz submitted! Your score: {final_score:.2f}%', 'success')
     return redirect(url_for('main.course_detail', course_id=quiz.module.course.id))
 
@@ -361,6 +321,7 @@ def start_exam(exam_id):
     )
     db.session.add(new_submission)
     db.session.commit()
+    progress_cache.invalidate(student_id=current_user.id, course_id=exam.course_id)
 
     return redirect(url_for('main.take_assessment', submission_id=new_submission.id))
 
@@ -411,49 +372,11 @@ def submit_exam(submission_id):
          return redirect(url_for('main.course_detail', course_id=submission.final_exam.course.id))
 
     exam = submission.final_exam
-    questions = exam.questions.all()
-    score = 0
-
-    for question in questions:
-        answer_data = {}
-        if question.question_type == 'multiple_choice_single':
-            choice_id = request.form.get(f'q_{question.id}')
-            if choice_id:
-                answer_data['selected_choice_id'] = int(choice_id)
-                choice = Choice.query.get(int(choice_id))
-                if choice and choice.is_correct:
-                    score += question.marks
-        elif question.question_type == 'multiple_choice_multiple':
-            choice_ids = request.form.getlist(f'q_{question.id}')
-            if choice_ids:
-                answer_data['selected_choices'] = [int(cid) for cid in choice_ids]
-                correct_choices = {c.id for c in question.choices if c.is_correct}
-                selected_choices = {int(cid) for cid in choice_ids}
-                if correct_choices == selected_choices:
-                    score += question.marks
-        elif question.question_type == 'true_false':
-            tf_answer = request.form.get(f'q_{question.id}')
-            if tf_answer:
-                answer_data['true_false_answer'] = (tf_answer == 'True')
-                if (tf_answer == 'True') == question.true_false_answer:
-                    score += question.marks
-        else: # short_answer, essay, file_upload
-            # These will be manually graded, so just store the answer
-            answer_data['text_answer'] = request.form.get(f'q_{question.id}')
-            # File upload logic will need to be added here
-
-        answer = Answer(
-            exam_submission_id=submission.id,
-            question_id=question.id,
-            **answer_data
-        )
-        db.session.add(answer)
-
-    total_marks = sum(q.marks for q in questions)
-    submission.score = (score / total_marks) * 100 if total_marks > 0 else 0
+    grade_exam_submission(submission, answer_keys.for_exam(exam), request.form)
     submission.status = 'pending_review'
     submission.submitted_at = datetime.utcnow()
     db.session.commit()
+    progress_cache.invalidate(student_id=current_user.id, course_id=exam.course_id)
 
     return render_template('post_exam.html', submission=submission)
 
@@ -466,6 +389,7 @@ def enroll(course_id):
         new_enrollment = Enrollment(user_id=current_user.id, course_id=course.id, status='approved')
         db.session.add(new_enrollment)
         db.session.commit()
+        room_access.invalidate(user_id=current_user.id)
         flash('You have been successfully enrolled in this free course!', 'success')
         return redirect(url_for('main.course_detail', course_id=course.id))
 
@@ -511,7 +435,7 @@ def submit_payment_proof(course_id):
     return redirect(url_for('main.course_detail', course_id=course.id))
 
 from sqlalchemy import or_
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, joinedload
 import re
 
 @main.route('/chat/create_private/<int:other_user_id>', methods=['POST'])
@@ -557,10 +481,7 @@ def library():
     # Search
     search_term = request.args.get('search')
     if search_term:
-        query = query.filter(or_(
-            LibraryMaterial.title.ilike(f'%{search_term}%'),
-            LibraryMaterial.description.ilike(f'%{search_term}%')
-        ))
+        query = search_index.filter(query, 'library_material', search_term)
 
     # Category filter
     category_id = request.args.get('category')
@@ -650,7 +571,7 @@ def login():
     return render_template('login.html')
 
 import os
-from PIL import Image
+from PIL import Image, ImageOps
 from flask import current_app
 
 @main.route('/logout')
@@ -735,10 +656,11 @@ def save_picture(form_picture):
     os.makedirs(os.path.dirname(picture_path), exist_ok=True)
 
     output_size = (125, 125)
-    i = Image.open(form_picture)
+    i = ImageOps.exif_transpose(Image.open(form_picture))
     i.thumbnail(output_size)
     i.save(picture_path)
 
+    image_pipeline.enqueue(f'profile_pics/{picture_fn}')
     return picture_fn
 
 @main.route('/profile')
@@ -845,7 +767,13 @@ def block_user(user_id):
             current_user.unfollow(user_to_block)
         if user_to_block.is_following(current_user):
             user_to_block.unfollow(current_user)
+        remove_author(current_user.id, user_to_block.id)
+        remove_author(user_to_block.id, current_user.id)
         db.session.commit()
+        room_access.invalidate(user_id=current_user.id)
+        status_tray.invalidate(current_user.id)
+        status_tray.invalidate(user_id)
+        room_access.invalidate(user_id=user_id)
 
     return jsonify({'status': 'success', 'message': f'You have blocked {user_to_block.name}.'})
 
@@ -858,6 +786,8 @@ def unblock_user(user_id):
     if existing_block:
         db.session.delete(existing_block)
         db.session.commit()
+        room_access.invalidate(user_id=current_user.id)
+        room_access.invalidate(user_id=user_id)
 
     return jsonify({'status': 'success', 'message': f'You have unblocked {user_to_unblock.name}.'})
 
@@ -1123,6 +1053,7 @@ def add_members(room_id):
                 new_member = ChatRoomMember(user_id=user.id, chat_room_id=room.id)
                 db.session.add(new_member)
         db.session.commit()
+        room_access.invalidate(room_id=room.id)
         flash('Members added successfully!', 'success')
         return redirect(url_for('main.chat_room_info', room_id=room.id))
 
@@ -1154,6 +1085,7 @@ def join_chat(token):
         new_member = ChatRoomMember(user_id=current_user.id, chat_room_id=room.id)
         db.session.add(new_member)
         db.session.commit()
+        room_access.invalidate(user_id=current_user.id, room_id=room.id)
         flash('You have successfully joined the group!', 'success')
 
     return redirect(url_for('main.chat_room', room_id=room.id))
@@ -1174,22 +1106,16 @@ def chat_list():
             (ChatRoom.room_type == 'public') | (ChatRoom.id.in_(member_room_ids))
         ).order_by(ChatRoom.last_message_timestamp.desc().nullslast()).all()
 
+    summaries = get_room_summaries(current_user.id, [room.id for room in user_rooms])
+    db.session.commit()  # keep any counters seeded by the summary
+
     chat_data = []
     for room in user_rooms:
-        # Get last message
-        last_message = room.messages.order_by(ChatMessage.timestamp.desc()).first()
-
-        # Get unread count, but only for non-muted rooms
-        is_muted = MutedRoom.query.filter_by(user_id=current_user.id, room_id=room.id).first() is not None
-        unread_count = 0
-        if not is_muted:
-            last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-            last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-            unread_count = db.session.query(ChatMessage).filter(
-                ChatMessage.room_id == room.id,
-                ChatMessage.timestamp > last_read_time,
-                ChatMessage.user_id != current_user.id
-            ).count()
+        summary = summaries[room.id]
+        last_message = summary['last_message']
+
+        # Only show unread counts for non-muted rooms
+        unread_count = 0 if summary['is_muted'] else summary['unread_count']
 
         chat_data.append({
             'id': room.id,
@@ -1260,13 +1186,17 @@ def chat_room(room_id):
     # Fetch recent messages
     clear_record = ChatClearTimestamp.query.filter_by(user_id=current_user.id, room_id=room.id).first()
 
-    messages_query = room.messages
-    if clear_record:
-        messages_query = messages_query.filter(ChatMessage.timestamp >= clear_record.cleared_at)
+    recent_messages, _ = get_history_page(room.id, since=clear_record.cleared_at if clear_record else None)
 
-    recent_messages = messages_query.order_by(ChatMessage.timestamp.asc()).limit(50).all()
+    # Read receipts come from the read watermarks: ours for incoming messages, everyone else's for our own
+    my_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room.id).first()
+    read_receipts = {
+        'mine': (my_read.last_read_message_id or 0) if my_read else 0,
+        'others': read_upto(room.id, current_user.id)
+    }
 
-    return render_template('chat/room.html', chat_info=chat_info, messages=recent_messages, current_user_id=current_user.id)
+    return render_template('chat/room.html', chat_info=chat_info, messages=recent_messages, current_user_id=current_user.id,
+                           read_receipts=read_receipts)
 
 @main.route('/chat/<int:room_id>/info')
 @login_required
@@ -1402,9 +1332,14 @@ def upload_chat_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
+    if not within_quota(current_user, upload_size(file)):
+        return jsonify({'error': 'This file would take you over your storage quota.'}), 413
+
     if file:
         file_path, file_name = save_chat_file(file)
         if file_path:
+            # Record the blob now; the message that uses it is sent later over the socket
+            db.session.commit()
             return jsonify({'file_path': file_path, 'file_name': file_name})
         else:
             return jsonify({'error': 'Invalid file type'}), 400
@@ -1439,28 +1374,23 @@ def get_unread_counts():
     # This is a simplified version. A real app might need a more optimized query.
 
     # Get all rooms the user has access to
-    user_rooms = []
+    room_ids = []
     if current_user.role == 'student':
         general_room = ChatRoom.query.filter_by(room_type='general').first()
         if general_room:
-            user_rooms.append(general_room)
-        enrollments = Enrollment.query.filter_by(user_id=current_user.id, status='approved').all()
-        for enrollment in enrollments:
-            if enrollment.course.chat_room:
-                user_rooms.append(enrollment.course.chat_room)
+            room_ids.append(general_room.id)
+        course_room_ids = db.session.query(ChatRoom.id).join(
+            Enrollment, Enrollment.course_id == ChatRoom.course_id
+        ).filter(
+            Enrollment.user_id == current_user.id,
+            Enrollment.status == 'approved'
+        ).all()
+        room_ids.extend(room_id for (room_id,) in course_room_ids)
     # Add logic for instructors and admins if they need unread counts too
 
-    unread_counts = {}
-    for room in user_rooms:
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room.id).first()
-        last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-
-        count = ChatMessage.query.filter(
-            ChatMessage.room_id == room.id,
-            ChatMessage.timestamp > last_read_time,
-            ChatMessage.user_id != current_user.id # Don't count user's own messages
-        ).count()
-        unread_counts[room.id] = count
+    summaries = get_room_summaries(current_user.id, room_ids)
+    unread_counts = {room_id: summary['unread_count'] for room_id, summary in summaries.items()}
+    db.session.commit()  # keep any counters seeded by the summary
 
     return jsonify(unread_counts)
 
@@ -1475,10 +1405,11 @@ def search_chat_messages(room_id):
     room = ChatRoom.query.get_or_404(room_id)
     # A full authorization check like in chat_events.py should be here
 
-    messages = ChatMessage.query.filter(
-        ChatMessage.room_id == room_id,
-        ChatMessage.content.ilike(f'%{query}%')
-    ).order_by(ChatMessage.timestamp.desc()).limit(50).all()
+    page = request.args.get('page', 1, type=int)
+    messages = search_index.filter(
+        ChatMessage.query.options(joinedload(ChatMessage.author)).filter(ChatMessage.room_id == room_id),
+        'chat_message', query
+    ).order_by(ChatMessage.timestamp.desc()).paginate(page=page, per_page=50, error_out=False).items
 
     results = [{
         'user_name': msg.author.name,
@@ -1495,30 +1426,44 @@ def get_chat_history(room_id):
     room = ChatRoom.query.get_or_404(room_id)
 
     clear_record = ChatClearTimestamp.query.filter_by(user_id=current_user.id, room_id=room.id).first()
+    messages, _, _, _ = get_history(room.id, since=clear_record.cleared_at if clear_record else None)
 
-    messages_query = ChatMessage.query.filter_by(room_id=room_id)
-    if clear_record:
-        messages_query = messages_query.filter(ChatMessage.timestamp >= clear_record.cleared_at)
+    return jsonify(messages)
 
-    messages = messages_query.order_by(ChatMessage.timestamp.desc()).limit(50).all()
+@main.route('/chat/room/<int:room_id>/messages')
+@login_required
+def get_chat_messages(room_id):
+    """
+    Cursor-paginated history. Pass `before` (older) or `after` (newer) from a previous
+    response to keep scrolling; every page costs the same few queries however deep it is.
+    Past the oldest message still in the database, pages come from the room's archive.
+    """
+    room = ChatRoom.query.get_or_404(room_id)
+    if not room_access.is_authorized(current_user, room):
+        abort(403)
 
-    # Reverse the messages to be in chronological order
-    messages.reverse()
+    limit = min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), MAX_HISTORY_PAGE_SIZE)
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if limit < 1 or (before and after):
+        return jsonify({'status': 'error', 'message': 'Pass a positive limit and at most one of before/after.'}), 400
 
-    history = [{
-        'user_name': msg.author.name,
-        'user_id': msg.author.id,
-        'user_profile_pic': msg.author.profile_pic or 'default.jpg',
-        'content': msg.content,
-        'file_path': msg.file_path,
-        'file_name': msg.file_name,
-        'timestamp': msg.timestamp.isoformat() + "Z",
-        'message_id': msg.id,
-        'is_pinned': msg.is_pinned,
-        'reactions': [{'user_name': r.user.name, 'reaction': r.reaction} for r in msg.reactions]
-    } for msg in messages]
+    clear_record = ChatClearTimestamp.query.filter_by(user_id=current_user.id, room_id=room.id).first()
+    try:
+        messages, has_more, first, last = get_history(
+            room.id, before=before, after=after, limit=limit,
+            since=clear_record.cleared_at if clear_record else None
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
-    return jsonify(history)
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        # Cursors for the next older and newer pages
+        'before': encode_cursor(first) if first else before,
+        'after': encode_cursor(last) if last else after
+    })
 
 @main.route('/student/dashboard')
 @login_required
@@ -1534,21 +1479,14 @@ def student_dashboard():
     completed_courses_count = 0
     enrolled_course_ids = []
 
+    snapshots = progress_cache.get_snapshots(
+        current_user.id, [e.course for e in enrollments if e.status == 'approved']
+    )
     for enrollment in enrollments:
         progress_data = None
         if enrollment.status == 'approved':
             enrolled_course_ids.append(enrollment.course_id)
-            progress_data = get_course_progress(current_user, enrollment.course)
-
-            # Calculate progress percentage
-            total_items = len(progress_data['quizzes']) + len(progress_data['assignments'])
-            completed_items = 0
-            if total_items > 0:
-                completed_items += sum(1 for q in progress_data['quizzes'] if q['passed'])
-                completed_items += sum(1 for a in progress_data['assignments'] if a['approved'])
-                progress_data['percentage'] = (completed_items / total_items) * 100
-            else:
-                progress_data['percentage'] = 0
+            progress_data = snapshots[enrollment.course_id]
 
             # Update counts
             if progress_data['can_request_certificate']:
@@ -1574,18 +1512,11 @@ def student_dashboard():
     certificates_count = Certificate.query.filter_by(user_id=current_user.id).count()
 
     # Unread Messages Count
-    unread_messages_count = 0
     # Querying ChatRoomMember directly is more robust than relying on the backref
     memberships = ChatRoomMember.query.filter_by(user_id=current_user.id).all()
     member_room_ids = [m.chat_room_id for m in memberships]
-    for room_id in member_room_ids:
-        last_read = UserLastRead.query.filter_by(user_id=current_user.id, room_id=room_id).first()
-        last_read_time = last_read.last_read_timestamp if last_read else datetime.min
-        unread_messages_count += db.session.query(ChatMessage).filter(
-            ChatMessage.room_id == room_id,
-            ChatMessage.timestamp > last_read_time,
-            ChatMessage.user_id != current_user.id
-        ).count()
+    unread_messages_count = get_total_unread_count(current_user.id, member_room_ids)
+    db.session.commit()  # keep any counters seeded by the summary
 
     # Profile Completion
     profile_fields = ['name', 'email', 'profile_pic', 'bio']
@@ -1618,21 +1549,12 @@ def my_courses():
         return redirect(url_for('main.home'))
 
     enrollments = current_user.enrollments.filter_by(status='approved').all()
+    snapshots = progress_cache.get_snapshots(current_user.id, [e.course for e in enrollments])
     enrollment_data = []
     for enrollment in enrollments:
-        progress_data = get_course_progress(current_user, enrollment.course)
-        total_items = len(progress_data['quizzes']) + len(progress_data['assignments'])
-        completed_items = 0
-        if total_items > 0:
-            completed_items += sum(1 for q in progress_data['quizzes'] if q['passed'])
-            completed_items += sum(1 for a in progress_data['assignments'] if a['approved'])
-            progress_data['percentage'] = (completed_items / total_items) * 100
-        else:
-            progress_data['percentage'] = 0
-
         enrollment_data.append({
             'enrollment': enrollment,
-            'progress': progress_data
+            'progress': snapshots[enrollment.course_id]
         })
 
     return render_template('my_courses.html', enrollment_data=enrollment_data)
@@ -1646,22 +1568,17 @@ def assignments():
 
     assignments_data = []
     enrollments = current_user.enrollments.filter_by(status='approved').all()
+    records = load_course_records(current_user.id, [e.course for e in enrollments])
     for enrollment in enrollments:
         course = enrollment.course
-        for module in course.modules:
-            if module.assignment:
-                assignment = module.assignment
-                submission = AssignmentSubmission.query.filter_by(
-                    student_id=current_user.id,
-                    assignment_id=assignment.id
-                ).first()
-                assignments_data.append({
-                    'course_title': course.title,
-                    'assignment_title': assignment.title,
-                    'due_date': 'N/A',  # Assignment model doesn't have a due date yet
-                    'status': submission.grade if submission and submission.grade else ('Submitted' if submission else 'Pending'),
-                    'assignment_id': assignment.id
-                })
+        for assignment, submission in records[course.id].assignments:
+            assignments_data.append({
+                'course_title': course.title,
+                'assignment_title': assignment.title,
+                'due_date': 'N/A',  # Assignment model doesn't have a due date yet
+                'status': submission.grade if submission and submission.grade else ('Submitted' if submission else 'Pending'),
+                'assignment_id': assignment.id
+            })
 
     return render_template('assignments.html', assignments_data=assignments_data)
 
@@ -1674,52 +1591,40 @@ def grades():
 
     grades_data = {}
     enrollments = current_user.enrollments.filter_by(status='approved').all()
+    records = load_course_records(current_user.id, [e.course for e in enrollments])
 
     for enrollment in enrollments:
         course = enrollment.course
+        course_records = records[course.id]
         grades_data[course.title] = []
 
         # Get assignment grades
-        for module in course.modules:
-            if module.assignment:
-                submission = AssignmentSubmission.query.filter_by(
-                    student_id=current_user.id,
-                    assignment_id=module.assignment.id
-                ).first()
-                if submission and submission.grade:
-                    grades_data[course.title].append({
-                        'type': 'Assignment',
-                        'title': module.assignment.title,
-                        'grade': submission.grade
-                    })
+        for assignment, submission in course_records.assignments:
+            if submission and submission.grade:
+                grades_data[course.title].append({
+                    'type': 'Assignment',
+                    'title': assignment.title,
+                    'grade': submission.grade
+                })
 
         # Get quiz grades
-        for module in course.modules:
-            if module.quiz:
-                submission = QuizSubmission.query.filter_by(
-                    student_id=current_user.id,
-                    quiz_id=module.quiz.id
-                ).order_by(QuizSubmission.score.desc()).first()
-                if submission:
-                    grades_data[course.title].append({
-                        'type': 'Quiz',
-                        'title': module.quiz.module.title, # Quizzes are tied to modules
-                        'grade': f"{submission.score:.2f}%"
-                    })
-
-        # Get final exam grade
-        if course.final_exam:
-            submission = ExamSubmission.query.filter_by(
-                student_id=current_user.id,
-                final_exam_id=course.final_exam.id
-            ).order_by(ExamSubmission.score.desc()).first()
-            if submission and submission.score is not None:
+        for quiz, _, best_submission in course_records.quizzes:
+            if best_submission:
                 grades_data[course.title].append({
-                    'type': 'Final Exam',
-                    'title': course.final_exam.title,
-                    'grade': f"{submission.score:.2f}%"
+                    'type': 'Quiz',
+                    'title': quiz.module.title, # Quizzes are tied to modules
+                    'grade': f"{best_submission.score:.2f}%"
                 })
 
+        # Get final exam grade
+        submission = course_records.best_exam_submission
+        if course_records.final_exam and submission:
+            grades_data[course.title].append({
+                'type': 'Final Exam',
+                'title': course_records.final_exam.title,
+                'grade': f"{submission.score:.2f}%"
+            })
+
     return render_template('grades.html', grades_data=grades_data)
 
 @main.route('/student/certificates')
@@ -1755,10 +1660,15 @@ def download_library_material(material_id):
             flash('You do not have access to this material.', 'danger')
             return redirect(url_for('main.library'))
 
-    material.download_count += 1
-    db.session.commit()
-
-    return send_from_directory(os.path.join(current_app.root_path, 'static'), material.file_path, as_attachment=True)
+    download_name = secure_filename(material.title) + os.path.splitext(material.file_path)[1]
+    if request.args.get('link'):
+        # A short-lived URL for download managers, which resume without the session cookie. Minting
+        # it counts the download; fetches through the URL don't
+        download_counter.add(material.id)
+        return jsonify({'url': signed_url(material.file_path, download_name), 'expires_in': url_ttl()})
+    if starts_download():
+        download_counter.add(material.id)
+    return send_protected(material.file_path, download_name=download_name)
 
 @main.route('/exam/submission/<int:submission_id>/appeal', methods=['GET'])
 @login_required
@@ -1824,6 +1734,21 @@ def request_certificate(course_id):
     flash('Your certificate request has been submitted for approval.', 'success')
     return redirect(url_for('main.student_dashboard'))
 
+def _certificate_status(certificate):
+    return {
+        'certificate_id': certificate.id,
+        'status': certificate.status,
+        'download_url': url_for('main.download_certificate', certificate_id=certificate.id) if certificate.status == 'ready' else None
+    }
+
+@main.route('/student/certificate/<int:certificate_id>/status')
+@login_required
+def certificate_status(certificate_id):
+    certificate = Certificate.query.get_or_404(certificate_id)
+    if certificate.user_id != current_user.id:
+        abort(403)
+    return jsonify(_certificate_status(certificate))
+
 @main.route('/student/certificate/<int:certificate_id>/download')
 @login_required
 def download_certificate(certificate_id):
@@ -1831,8 +1756,28 @@ def download_certificate(certificate_id):
     if certificate.user_id != current_user.id:
         abort(403)
 
-    # Assuming certificates are stored in a 'certificates' directory in 'static'
-    return send_from_directory(os.path.join(current_app.root_path, 'static'), certificate.file_path, as_attachment=True)
+    if certificate.status != 'ready':
+        # Still rendering (or failed); answer straight away instead of waiting on it
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(_certificate_status(certificate)), 202
+        if certificate.status == 'failed':
+            flash('Your certificate could not be generated. Please contact support.', 'danger')
+        else:
+            flash('Your certificate is still being generated. Please try again in a moment.', 'info')
+        return redirect(url_for('main.certificates'))
+
+    if request.args.get('link'):
+        return jsonify({'url': signed_url(certificate.file_path), 'expires_in': url_ttl()})
+    return send_protected(certificate.file_path)
+
+@main.route('/files/<token>')
+def signed_file(token):
+    """Serves a file named by a signed_url link; the signature stands in for the access check."""
+    signed = load_signed_url(token)
+    if signed is None:
+        abort(403)
+    path, download_name = signed
+    return send_protected(path, download_name=download_name)
 
 @main.route('/pending_approval')
 @login_required
@@ -1904,41 +1849,10 @@ def storage_settings():
 @main.route('/settings/storage/manage')
 @login_required
 def manage_storage():
-    storage_data = []
-    memberships = ChatRoomMember.query.filter_by(user_id=current_user.id).all()
-
-    for membership in memberships:
-        room = membership.room
-        total_size = 0
-
-        # Find all messages with files in this room
-        file_messages = ChatMessage.query.filter(
-            ChatMessage.room_id == room.id,
-            ChatMessage.file_path.isnot(None)
-        ).all()
-
-        for message in file_messages:
-            try:
-                # Construct the full path to the file
-                # Assumes file_path is relative to the 'static' folder
-                full_path = os.path.join(current_app.root_path, 'static', message.file_path)
-                if os.path.exists(full_path):
-                    total_size += os.path.getsize(full_path)
-            except Exception as e:
-                print(f"Could not get size for file {message.file_path}: {e}")
-
-        if total_size > 0:
-            # Format size to MB
-            size_in_mb = total_size / (1024 * 1024)
-            storage_data.append({
-                'name': room.name,
-                'size': f"{size_in_mb:.2f} MB"
-            })
-
-    # Sort by size, largest first
-    storage_data.sort(key=lambda x: float(x['size'].split(' ')[0]), reverse=True)
-
-    return render_template('settings/manage_storage.html', storage_data=storage_data)
+    storage_data = room_storage_summary(current_user.id)
+    used = user_usage(current_user.id)
+    return render_template('settings/manage_storage.html', storage_data=storage_data,
+                           used=used, quota=quota_for(current_user))
 
 @main.route('/settings/storage/network')
 @login_required
@@ -2079,55 +1993,8 @@ def status():
         Status.expires_at > now
     ).order_by(Status.created_at.desc()).all()
 
-    # --- Categorization Logic ---
-    muted_user_ids = {m.muted_id for m in current_user.muted_status_users}
-
-    # Get all active statuses from other users
-    all_updates = Status.query.filter(
-        Status.user_id != current_user.id,
-        Status.expires_at > now
-    ).order_by(Status.user_id, Status.created_at.desc()).all()
-
-    # Group statuses by user
-    updates_by_user = {}
-    for s in all_updates:
-        if s.user_id not in updates_by_user:
-            updates_by_user[s.user_id] = {'user': s.user, 'statuses': [], 'all_viewed': True, 'last_viewed': None}
-        updates_by_user[s.user_id]['statuses'].append(s)
-
-    # Determine 'all_viewed' and find last view time for each user group
-    from sqlalchemy import func
-    for user_id, data in updates_by_user.items():
-        status_ids = [s.id for s in data['statuses']]
-        viewed_statuses_count = db.session.query(func.count(StatusView.id)).filter(
-            StatusView.status_id.in_(status_ids),
-            StatusView.user_id == current_user.id
-        ).scalar()
-
-        data['all_viewed'] = (viewed_statuses_count == len(status_ids))
-
-        if data['all_viewed']:
-            last_view = db.session.query(func.max(StatusView.viewed_at)).filter(
-                StatusView.status_id.in_(status_ids),
-                StatusView.user_id == current_user.id
-            ).scalar()
-            data['last_viewed'] = last_view
-
-    # Categorize into unviewed, viewed, and muted
-    unviewed_updates = []
-    viewed_updates = []
-    muted_updates = []
-
-    for user_id, data in updates_by_user.items():
-        if user_id in muted_user_ids:
-            muted_updates.append(data)
-        elif data['all_viewed']:
-            viewed_updates.append(data)
-        else:
-            unviewed_updates.append(data)
-
-    # Sort viewed updates by the most recently viewed
-    viewed_updates.sort(key=lambda x: x['last_viewed'], reverse=True)
+    # Other authors' statuses, grouped per author with the viewer's unseen count (see status_tray.py)
+    unviewed_updates, viewed_updates, muted_updates = categorize(status_tray.get(current_user.id))
 
     return render_template('status.html',
                            my_statuses=my_statuses,
@@ -2154,54 +2021,39 @@ def view_my_status():
 @login_required
 def get_user_status_data(user_id):
     now = datetime.utcnow()
-    statuses = Status.query.filter(
+    statuses = Status.query.options(
+        joinedload(Status.poll).selectinload(Poll.options),
+        joinedload(Status.link_preview)
+    ).filter(
         Status.user_id == user_id,
         Status.expires_at > now
     ).order_by(Status.created_at).all()
 
+    viewed_ids = {status_id for (status_id,) in db.session.query(StatusView.status_id).filter(
+        StatusView.user_id == current_user.id, StatusView.status_id.in_([s.id for s in statuses])
+    )} if statuses else set()
+
     statuses_data = []
     for s in statuses:
-        is_viewed = StatusView.query.filter_by(status_id=s.id, user_id=current_user.id).first() is not None
         status_item = {
             'id': s.id,
             'content_type': s.content_type,
             'content': s.content if s.content_type == 'text' else url_for('static', filename=s.content),
             'caption': s.caption,
             'background': s.background,
-            'viewed': is_viewed,
+            'viewed': s.id in viewed_ids,
             'poll': None,
             'link_preview': None
         }
-        if s.content_type == 'poll' and s.poll:
-            poll_data = {
+        if s.content_type in ('poll', 'quiz') and s.poll:
+            status_item['poll'] = {
                 'id': s.poll.id,
                 'question': s.poll.question,
-                'options': []
-            }
-            total_votes = 0
-            # Calculate total votes first
-            for opt in s.poll.options:
-                total_votes += len(opt.votes)
-
-            for opt in s.poll.options:
-                vote_count = len(opt.votes)
-                percentage = (vote_count / total_votes * 100) if total_votes > 0 else 0
-                poll_data['options'].append({
-                    'id': opt.id,
-                    'text': opt.text,
-                    'votes': vote_count,
-                    'percentage': round(percentage)
-                })
-            status_item['poll'] = poll_data
-
-        if s.link_preview:
-            status_item['link_preview'] = {
-                'url': s.link_preview.url,
-                'title': s.link_preview.title,
-                'description': s.link_preview.description,
-                'image_url': s.link_preview.image_url
+                'options': poll_tallies(s.poll)
             }
 
+        status_item['link_preview'] = serialize_preview(s.link_preview)
+
         statuses_data.append(status_item)
 
     user = User.query.get_or_404(user_id)
@@ -2222,8 +2074,26 @@ def mark_status_viewed(status_id):
         new_view = StatusView(status_id=status_id, user_id=current_user.id)
         db.session.add(new_view)
         db.session.commit()
+        status_tray.invalidate(current_user.id)
     return jsonify({'status': 'success'})
 
+@main.route('/status/poll/<int:option_id>/vote', methods=['POST'])
+@login_required
+def vote_status_poll(option_id):
+    option = PollOption.query.get_or_404(option_id)
+    status = option.poll.status
+    if status is None or status.expires_at <= datetime.utcnow():
+        return jsonify({'status': 'error', 'message': 'This poll has ended.'}), 404
+    if BlockedUser.query.filter(
+        ((BlockedUser.blocker_id == status.user_id) & (BlockedUser.blocked_id == current_user.id)) |
+        ((BlockedUser.blocker_id == current_user.id) & (BlockedUser.blocked_id == status.user_id))
+    ).first():
+        return jsonify({'status': 'error', 'message': 'You cannot vote on this poll.'}), 403
+
+    cast_vote(option.poll, option, current_user.id)
+    db.session.commit()
+    return jsonify({'status': 'success', 'options': poll_tallies(option.poll)})
+
 @main.route('/status/add', methods=['GET', 'POST'])
 @login_required
 def add_status():
@@ -2254,23 +2124,9 @@ def add_status():
 
             new_status = Status(user_id=current_user.id, content_type='text', content=content, background=background)
             db.session.add(new_status)
+            link_previewer.attach(new_status, content)
             db.session.commit()
-
-            url_match = re.search(r'https?://[^\s]+', content)
-            if url_match:
-                url = url_match.group(0)
-                try:
-                    response = requests.get(url, timeout=5)
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    title = soup.find('meta', property='og:title')
-                    description = soup.find('meta', property='og:description')
-                    image = soup.find('meta', property='og:image')
-                    if title:
-                        preview = LinkPreview(status_id=new_status.id, url=url, title=title.get('content'), description=description.get('content') if description else None, image_url=image.get('content') if image else None)
-                        db.session.add(preview)
-                        db.session.commit()
-                except Exception as e:
-                    print(f"Could not fetch link preview for {url}: {e}")
+            status_tray.invalidate()
 
             flash("Your status has been posted.", "success")
             return redirect(url_for('main.status'))
@@ -2299,6 +2155,7 @@ def add_status():
             new_status = Status(user_id=current_user.id, content_type='image', content=saved_path, caption=caption)
             db.session.add(new_status)
             db.session.commit()
+            status_tray.invalidate()
             flash("Your image status has been posted.", "success")
             return redirect(url_for('main.status'))
 
@@ -2310,6 +2167,7 @@ def add_status():
             new_status = Status(user_id=current_user.id, content_type='voice', content=voice_path)
             db.session.add(new_status)
             db.session.commit()
+            status_tray.invalidate()
             flash("Your voice status has been posted.", "success")
             return redirect(url_for('main.status'))
 
@@ -2321,6 +2179,7 @@ def add_status():
             new_status = Status(user_id=current_user.id, content_type='video', content=video_path)
             db.session.add(new_status)
             db.session.commit()
+            status_tray.invalidate()
             flash("Your video status has been posted.", "success")
             return redirect(url_for('main.status'))
 
@@ -2353,6 +2212,7 @@ def add_status():
                 db.session.add(poll_option)
 
             db.session.commit()
+            status_tray.invalidate()
             flash(f'Your {status_type} has been posted as a status.', 'success')
             return redirect(url_for('main.status'))
 
@@ -2472,6 +2332,7 @@ def upload_status_voice():
         # We can reuse save_status_file, but need to ensure it allows audio
         filepath = save_status_file(file)
         if filepath:
+            db.session.commit() # record the blob; the status that uses it is posted later
             return jsonify({'status': 'success', 'filepath': filepath})
         else:
             return jsonify({'status': 'error', 'message': 'Invalid file type'}), 400
@@ -2490,6 +2351,7 @@ def upload_status_video():
     try:
         filepath = save_status_file(file)
         if filepath:
+            db.session.commit() # record the blob; the status that uses it is posted later
             return jsonify({'status': 'success', 'filepath': filepath})
         else:
             return jsonify({'status': 'error', 'message': 'Invalid file type'}), 400
@@ -2519,6 +2381,9 @@ def clear_all_chats():
                 )
                 db.session.add(clear_record)
 
+            # Cleared messages are no longer shown, so they no longer count as unread
+            clear_unread_count(current_user.id, room_id)
+
         db.session.commit()
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -2557,25 +2422,23 @@ def export_chat(room_id):
     if not room.members.filter_by(user_id=current_user.id).first() and current_user.role != 'admin':
         abort(403)
 
-    messages = room.messages.order_by(ChatMessage.timestamp.asc()).all()
-
-    export_content = f"Chat export for: {room.name}\n\n"
-    for msg in messages:
-        timestamp = msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        export_content += f"[{timestamp}] {msg.author.name}: {msg.content or 'File: ' + msg.file_name}\n"
-
-    from io import BytesIO
-    from flask import send_file
-
-    buffer = BytesIO()
-    buffer.write(export_content.encode('utf-8'))
-    buffer.seek(0)
-
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'{room.name}_export.txt',
-        mimetype='text/plain'
+    # ?format=txt|jsonl|csv, plus ?gzip=1 for a compressed download
+    export_format = request.args.get('format', 'txt')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    compress = request.args.get('gzip') == '1'
+    mimetype, extension = EXPORT_FORMATS[export_format]
+
+    download_name = f"{secure_filename(room.name) or 'chat'}_export.{extension}"
+    if compress:
+        mimetype = 'application/gzip'
+        download_name += '.gz'
+
+    # Stream straight to the client instead of building the whole export in memory
+    return Response(
+        stream_with_context(generate_export(room, export_format, compress)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
     )
 
 @main.route('/api/status/user/<int:user_id>/toggle_mute', methods=['POST'])
@@ -2598,6 +2461,7 @@ def toggle_mute_status(user_id):
         new_status = 'muted'
 
     db.session.commit()
+    status_tray.invalidate(current_user.id)
     return jsonify({'status': 'success', 'mute_status': new_status})
 
 @main.route('/settings/close_friends')
@@ -2647,8 +2511,11 @@ def remove_close_friend():
 @login_required
 def delete_all_messages():
     try:
+        affected_room_ids = [room_id for (room_id,) in db.session.query(ChatMessage.room_id).filter_by(user_id=current_user.id).distinct()]
         # This is a bulk delete operation, which is efficient.
+        release_messages(ChatMessage.query.filter_by(user_id=current_user.id))
         ChatMessage.query.filter_by(user_id=current_user.id).delete(synchronize_session=False)
+        invalidate_unread_counts(affected_room_ids)
         db.session.commit()
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -0,0 +1,152 @@
+import re
+from sqlalchemy import event, text, or_, false, literal, select, Integer, Float
+from extensions import db
+from models import ChatMessage, Post, Course, LibraryMaterial
+
+# kind -> (model, indexed columns, bm25 column weights)
+SEARCHABLE = {
+    'chat_message': (ChatMessage, ['content'], [1.0]),
+    'post': (Post, ['content'], [1.0]),
+    'course': (Course, ['title', 'description'], [10.0, 1.0]),
+    'library_material': (LibraryMaterial, ['title', 'description'], [10.0, 1.0]),
+}
+
+def _search_terms(term):
+    return re.findall(r'\w+', term or '', re.UNICODE)
+
+class LikeSearchBackend:
+    """Substring matching with ILIKE. Works on any database but scans the whole table."""
+
+    name = 'like'
+
+    def matches(self, kind, term):
+        model, columns, _ = SEARCHABLE[kind]
+        words = _search_terms(term)
+        if not words:
+            return select(model.id.label('id'), literal(0.0).label('rank')).where(false())
+        return select(model.id.label('id'), literal(0.0).label('rank')).where(*[
+            or_(*[getattr(model, column).ilike(f'%{word}%') for column in columns]) for word in words
+        ])
+
+    def create(self, connection):
+        pass
+
+    def drop(self, connection):
+        pass
+
+    def rebuild(self, connection, kind):
+        pass
+
+class FTS5SearchBackend:
+    """
+    SQLite FTS5 external-content indexes, one per searchable table, kept in sync by
+    triggers so that ORM writes, bulk `query.delete()`s and raw SQL all update them.
+    Matches every word as a prefix and ranks with bm25.
+    """
+
+    name = 'fts5'
+
+    def matches(self, kind, term):
+        model, _, weights = SEARCHABLE[kind]
+        words = _search_terms(term)
+        if not words:
+            return select(model.id.label('id'), literal(0.0).label('rank')).where(false())
+        # Quote each word so FTS5 operators in user input are taken literally
+        match = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+        fts = self._fts_table(kind)
+        return text(
+            f"SELECT rowid AS id, bm25({fts}, {', '.join(str(w) for w in weights)}) AS rank "
+            f"FROM {fts} WHERE {fts} MATCH :match"
+        ).bindparams(match=match).columns(id=Integer, rank=Float)
+
+    def create(self, connection):
+        for kind, (model, columns, _) in SEARCHABLE.items():
+            for statement in self._ddl(kind, model.__tablename__, columns):
+                connection.exec_driver_sql(statement)
+
+    def drop(self, connection):
+        for kind in SEARCHABLE:
+            connection.exec_driver_sql(f"DROP TABLE IF EXISTS {self._fts_table(kind)}")
+
+    def rebuild(self, connection, kind):
+        fts = self._fts_table(kind)
+        connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def _fts_table(self, kind):
+        return f"{kind}_fts"
+
+    def _ddl(self, kind, table, columns):
+        fts = self._fts_table(kind)
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column_list}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column_list} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column_list}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values}); END",
+        ]
+
+BACKENDS = {backend.name: backend for backend in (FTS5SearchBackend, LikeSearchBackend)}
+
+class SearchIndex:
+    """
+    Full-text search over chat messages, posts, courses and library materials.
+
+    SEARCH_BACKEND picks the implementation: 'fts5' (the default on SQLite) or 'like'
+    (the default elsewhere). Routes call `filter` to narrow and rank an existing query,
+    so their own filters and pagination keep working.
+    """
+
+    def __init__(self, app=None):
+        self.backend = LikeSearchBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.get('SEARCH_BACKEND')
+        if not name:
+            is_sqlite = app.config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite')
+            name = 'fts5' if is_sqlite else 'like'
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown SEARCH_BACKEND: {name}")
+        self.backend = BACKENDS[name]()
+
+    def filter(self, query, kind, term):
+        """Restricts `query` to rows of `kind` matching `term`, best matches first."""
+        model = SEARCHABLE[kind][0]
+        matches = self.backend.matches(kind, term).subquery()
+        return query.join(matches, model.id == matches.c.id).order_by(matches.c.rank)
+
+    def rebuild(self, kinds=None):
+        """Re-indexes the given kinds (all by default) from their tables. Returns the kinds rebuilt."""
+        kinds = list(kinds or SEARCHABLE)
+        with db.engine.begin() as connection:
+            self.backend.create(connection)
+            for kind in kinds:
+                self.backend.rebuild(connection, kind)
+        return kinds
+
+    @staticmethod
+    def include_object(object, name, type_, reflected, compare_to):
+        """Keeps Alembic autogenerate from trying to drop the FTS5 tables it doesn't know about."""
+        return not (type_ == 'table' and reflected and compare_to is None and
+                    (name.endswith('_fts') or re.search(r'_fts_(data|idx|docsize|config|content)$', name)))
+
+search_index = SearchIndex()
+
+# FTS tables and triggers aren't part of the models' metadata, so create and drop
+# them alongside it (db.create_all() in init-db, reset-db and the tests).
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_tables(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        FTS5SearchBackend().create(connection)
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_search_tables(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        FTS5SearchBackend().drop(connection)
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from flask import request
+
+# event -> (tokens added per second, bucket size); None means unlimited
+DEFAULT_LIMITS = {
+    'message': (2, 10),
+    'edit_message': (1, 5),
+    'forward_message': (1, 5),
+    'react_to_message': (3, 10),
+    'typing_start': (1, 3),
+    'typing_stop': (1, 3),
+    'mark_as_read': (2, 10),
+    'poll_vote': (2, 5),
+    'create_poll': (0.2, 3),
+    'heartbeat': (0.5, 3),
+    'join': (2, 10),
+    'leave': (2, 10),
+    # Call signalling: joining a group call sends an offer or answer to every peer, and trickle
+    # ICE sends a dozen or more candidates per peer, all within the first second
+    'offer': (5, 50),
+    'answer': (5, 50),
+    'ice_candidate': (20, 200),
+    'webrtc_offer': (5, 50),
+    'webrtc_answer': (5, 50),
+    'webrtc_ice_candidate': (20, 200),
+}
+# Budget of every other event
+DEFAULT_LIMIT = (2, 10)
+# Connection lifecycle events are never limited
+UNLIMITED_EVENTS = ('connect', 'disconnect')
+
+class SocketRateLimiter:
+    """
+    Per-connection token buckets for Socket.IO events.
+
+    Each (connection, event) pair gets a bucket that holds up to `burst` tokens and refills at
+    `rate` tokens a second; handling an event takes one, and events arriving to an empty bucket
+    are dropped before their handler runs and counted in `dropped`. SOCKET_RATE_LIMITS overrides
+    the budget of individual events and SOCKET_RATE_LIMIT_DEFAULT that of the rest; set
+    SOCKET_RATE_LIMITS_ENABLED = False to turn limiting off.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.limits = dict(DEFAULT_LIMITS)
+        self.default = DEFAULT_LIMIT
+        self.dropped = Counter()
+        self._buckets = {} # {sid: {event: [tokens, refilled at]}}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with self._lock:
+            self.enabled = app.config.get('SOCKET_RATE_LIMITS_ENABLED', True)
+            self.limits = {**DEFAULT_LIMITS, **app.config.get('SOCKET_RATE_LIMITS', {})}
+            self.default = app.config.get('SOCKET_RATE_LIMIT_DEFAULT', DEFAULT_LIMIT)
+            self._buckets.clear()
+
+    def allow(self, sid, event, now=None):
+        """Takes a token from the connection's bucket for `event`; False if it was empty."""
+        limit = self.limits.get(event, self.default)
+        if not self.enabled or limit is None or event in UNLIMITED_EVENTS:
+            return True
+        rate, burst = limit
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = self._buckets.setdefault(sid, {})
+            bucket = buckets.get(event)
+            tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens < 1:
+                buckets[event] = [tokens, now]
+                self.dropped[event] += 1
+                return False
+            buckets[event] = [tokens - 1, now]
+            return True
+
+    def forget(self, sid):
+        """Drops a closed connection's buckets."""
+        with self._lock:
+            self._buckets.pop(sid, None)
+
+    def limit(self, event, handler):
+        """Wraps a Socket.IO handler so that it only runs while the connection has budget for `event`."""
+        @wraps(handler)
+        def limited(*args, **kwargs):
+            if not self.allow(request.sid, event):
+                return None
+            return handler(*args, **kwargs)
+        return limited
+
+    def wrap(self, socketio):
+        """A stand-in for `socketio` whose `on` registers rate-limited handlers."""
+        return _LimitedSocketIO(socketio, self)
+
+class _LimitedSocketIO:
+    def __init__(self, socketio, limiter):
+        self._socketio = socketio
+        self._limiter = limiter
+
+    def on(self, event, namespace=None):
+        register = self._socketio.on(event, namespace)
+        limiter = self._limiter
+
+        def decorator(handler):
+            if event == 'disconnect':
+                @wraps(handler)
+                def wrapped(*args, **kwargs):
+                    try:
+                        return handler(*args, **kwargs)
+                    finally:
+                        limiter.forget(request.sid)
+            elif event in UNLIMITED_EVENTS:
+                wrapped = handler
+            else:
+                wrapped = limiter.limit(event, handler)
+            register(wrapped)
+            return handler
+        return decorator
+
+    def __getattr__(self, name):
+        return getattr(self._socketio, name)
+
+socket_limiter = SocketRateLimiter()
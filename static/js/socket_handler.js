@@ -10,6 +10,11 @@ socket.on('connect', function() {
     console.log('Socket.IO connected via shared handler!');
 });
 
+// Keep our presence entry alive; the server expires it without a heartbeat
+setInterval(function() {
+    socket.emit('heartbeat');
+}, 30000);
+
 // You can add other global, non-page-specific handlers here if needed.
 // For example, a handler for global notifications.
 socket.on('error', function(data) {
@@ -106,8 +111,9 @@ function register_chat_room_handlers(chat_info, current_user_id) {
         });
 
         if (messagesToMarkAsRead.length > 0) {
+            // The server keeps one read watermark per room, so the newest message seen is enough
             socket.emit('mark_as_read', {
-                message_ids: messagesToMarkAsRead,
+                message_id: Math.max(...messagesToMarkAsRead.map(Number)),
                 room_id: chat_info.id
             });
         }
@@ -124,95 +130,86 @@ function register_chat_room_handlers(chat_info, current_user_id) {
     }
 
     socket.on('messages_read', (data) => {
-        if (data.room_id === chat_info.id) {
-            data.message_ids.forEach(messageId => {
-                const messageBubble = document.querySelector(`.message-bubble-wrapper.sender[data-message-id="${messageId}"]`);
-                if (messageBubble) {
-                    const receipt = messageBubble.querySelector('.read-receipts i');
-                    if (receipt) {
-                        receipt.classList.remove('fa-check');
-                        receipt.classList.add('fa-check-double');
-                    }
-                    messageBubble.dataset.isRead = 'true';
-                }
-            });
+        if (data.room_id !== chat_info.id || data.read_by_user_id === current_user_id) {
+            return;
         }
+        // Everything up to the reader's watermark has been read
+        document.querySelectorAll('.message-bubble-wrapper.sender').forEach(messageBubble => {
+            if (Number(messageBubble.dataset.messageId) > data.last_read_message_id) {
+                return;
+            }
+            const receipt = messageBubble.querySelector('.read-receipts i');
+            if (receipt) {
+                receipt.classList.remove('fa-check');
+                receipt.classList.add('fa-check-double');
+            }
+            messageBubble.dataset.isRead = 'true';
+        });
     });
 
-    initializeReadReceipts();
-}
-
-function register_chat_room_handlers(chat_info, current_user_id) {
-    socket.on('message', function(data) {
-        console.log('New message received:', data);
-        if (data.room_id !== chat_info.id) {
-            return; // Ignore messages for other rooms
-        }
-
-        const messageArea = document.querySelector('.message-area');
-        const messageBubbleWrapper = document.createElement('div');
-        messageBubbleWrapper.classList.add('message-bubble-wrapper');
-        messageBubbleWrapper.dataset.messageId = data.message_id;
-        if (data.user_id === current_user_id) {
-            messageBubbleWrapper.classList.add('sender');
-        } else {
-            messageBubbleWrapper.classList.add('receiver');
+    // Typing indicator: the server tracks who is typing and sends each room one aggregated
+    // 'typing_update' per interval, so reports here only need to keep it current.
+    const TYPING_REFRESH_MS = 3000;
+    const TYPING_IDLE_MS = 4000;
+    const messageInput = document.querySelector('.message-input');
+    let typingReportedAt = 0;
+    let typingIdleTimer = null;
+
+    function stopTyping() {
+        clearTimeout(typingIdleTimer);
+        typingIdleTimer = null;
+        if (typingReportedAt) {
+            typingReportedAt = 0;
+            socket.emit('typing_stop', { room_id: chat_info.id });
         }
+    }
 
-        let fileHtml = '';
-        if (data.file_path) {
-            const fileName = data.file_name.toLowerCase();
-            if (fileName.match(/\.(png|jpg|jpeg|gif|webp)$/)) {
-                fileHtml = `<img src="/static/${data.file_path}" alt="${data.file_name}" class="message-image">`;
-            } else if (fileName.match(/\.(mp4|webm|ogg)$/) && fileName.includes('video')) {
-                fileHtml = `<video src="/static/${data.file_path}" controls class="message-video"></video>`;
-            } else if (fileName.match(/\.(mp3|wav|webm|ogg)$/)) {
-                fileHtml = `<audio src="/static/${data.file_path}" controls class="message-audio"></audio>`;
-            } else {
-                fileHtml = `<a href="/static/${data.file_path}" class="message-file" download>
-                                <i class="fa-solid fa-file-arrow-down"></i> ${data.file_name}
-                            </a>`;
+    if (messageInput) {
+        messageInput.addEventListener('input', () => {
+            if (!messageInput.value.trim()) {
+                stopTyping();
+                return;
             }
-        }
-
-        let contentHtml;
-        try {
-            const contentData = JSON.parse(data.content);
-            if (contentData && contentData.type === 'contact') {
-                contentHtml = `
-                    <div class="contact-card">
-                        <img src="/static/profile_pics/${contentData.profile_pic}" alt="${contentData.name}">
-                        <div class="contact-card-info">
-                            <strong>${contentData.name}</strong>
-                            <a href="/user/${contentData.user_id}">View Profile</a>
-                        </div>
-                    </div>
-                `;
-            } else if (contentData && contentData.type === 'location') {
-                contentHtml = `
-                    <div class="location-card">
-                        <a href="https://www.openstreetmap.org/?mlat=${contentData.latitude}&mlon=${contentData.longitude}#map=15/${contentData.latitude}/${contentData.longitude}" target="_blank">
-                            <i class="fa-solid fa-map-location-dot"></i>
-                            <span>View Location</span>
-                        </a>
-                    </div>
-                `;
-            } else {
-                throw new Error("Not a contact card");
+            const now = Date.now();
+            if (now - typingReportedAt > TYPING_REFRESH_MS) {
+                typingReportedAt = now;
+                socket.emit('typing_start', { room_id: chat_info.id });
             }
-        } catch (e) {
-            contentHtml = data.content ? `<p class="message-content">${data.content}</p>` : '';
+            clearTimeout(typingIdleTimer);
+            typingIdleTimer = setTimeout(stopTyping, TYPING_IDLE_MS);
+        });
+        messageInput.addEventListener('blur', stopTyping);
+    }
+
+    // Sending a message ends the server's typing state for us; the next keystroke reports again
+    socket.on('message', (data) => {
+        if (data.room_id === chat_info.id && data.user_id === current_user_id) {
+            clearTimeout(typingIdleTimer);
+            typingIdleTimer = null;
+            typingReportedAt = 0;
         }
+    });
 
-        const messageBubble = `
-            <div class="message-bubble">
-                ${fileHtml}
-                ${contentHtml}
-                <span class="message-timestamp">${new Date(data.timestamp).toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'})}</span>
-            </div>
-        `;
-        messageBubbleWrapper.innerHTML = messageBubble;
-        messageArea.appendChild(messageBubbleWrapper);
-        messageArea.scrollTop = messageArea.scrollHeight;
+    socket.on('typing_update', (data) => {
+        if (data.room_id !== chat_info.id) {
+            return;
+        }
+        const indicator = document.getElementById('typing-indicator');
+        if (!indicator) {
+            return;
+        }
+        const names = data.users.filter(user => user.user_id !== current_user_id).map(user => user.user_name);
+        let text = '';
+        if (names.length === 1) {
+            text = `${names[0]} is typing...`;
+        } else if (names.length === 2) {
+            text = `${names[0]} and ${names[1]} are typing...`;
+        } else if (names.length > 2) {
+            text = `${names.length} people are typing...`;
+        }
+        indicator.querySelector('p').textContent = text;
+        indicator.classList.toggle('hidden', !text);
     });
+
+    initializeReadReceipts();
 }
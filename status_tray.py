@@ -0,0 +1,109 @@
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import aliased
+from extensions import db
+from models import Status, StatusView, User, BlockedUser, MutedStatusUser
+
+def load_tray(viewer_id, now=None):
+    """
+    One row per other author with active statuses the viewer may see, from a single grouped
+    query: {'user': {'id', 'name', 'profile_pic'}, 'count', 'unseen', 'latest_at',
+    'last_viewed', 'muted', 'expires_at'} where expires_at is when the earliest status lapses.
+    Authors who blocked the viewer, or whom the viewer blocked, are left out.
+    """
+    now = now or datetime.utcnow()
+    view = aliased(StatusView)
+    blocked = select(BlockedUser.blocked_id).where(BlockedUser.blocker_id == viewer_id)
+    blocked_by = select(BlockedUser.blocker_id).where(BlockedUser.blocked_id == viewer_id)
+    muted = select(MutedStatusUser.muted_id).where(MutedStatusUser.muter_id == viewer_id)
+    rows = db.session.query(
+        Status.user_id, User.name, User.profile_pic,
+        func.count(Status.id).label('count'),
+        func.count(view.id).label('viewed'),
+        func.max(Status.created_at).label('latest_at'),
+        func.min(Status.expires_at).label('expires_at'),
+        func.max(view.viewed_at).label('last_viewed'),
+        Status.user_id.in_(muted).label('muted'),
+    ).join(User, User.id == Status.user_id).outerjoin(
+        view, and_(view.status_id == Status.id, view.user_id == viewer_id)
+    ).filter(
+        Status.expires_at > now,
+        Status.user_id != viewer_id,
+        ~Status.user_id.in_(blocked),
+        ~Status.user_id.in_(blocked_by),
+    ).group_by(Status.user_id, User.name, User.profile_pic).all()
+
+    return [{
+        'user': {'id': row.user_id, 'name': row.name, 'profile_pic': row.profile_pic},
+        'count': row.count,
+        'unseen': row.count - row.viewed,
+        'latest_at': row.latest_at,
+        'last_viewed': row.last_viewed,
+        'muted': bool(row.muted),
+        'expires_at': row.expires_at,
+    } for row in rows]
+
+def categorize(tray):
+    """Splits a tray into (unviewed, viewed, muted), newest first and most recently viewed first."""
+    unviewed = sorted((e for e in tray if not e['muted'] and e['unseen']), key=lambda e: e['latest_at'], reverse=True)
+    viewed = sorted((e for e in tray if not e['muted'] and not e['unseen']), key=lambda e: e['last_viewed'], reverse=True)
+    muted = sorted((e for e in tray if e['muted']), key=lambda e: e['latest_at'], reverse=True)
+    return unviewed, viewed, muted
+
+class StatusTrayCache:
+    """
+    Per-process cache of each viewer's status tray.
+
+    An entry lives for STATUS_TRAY_TTL seconds (0 turns caching off), and never past the moment
+    the earliest status in it expires. Code must call `invalidate` after committing: with the
+    viewer's id when they view a status or change a mute or block, and with no arguments when a
+    status is posted or deleted, since that changes the trays of every viewer.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 60
+        self._entries = {} # {viewer_id: (tray, expires_at)}
+        self._generation = 0 # bumped on every eviction
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('STATUS_TRAY_TTL', 60)
+        self.clear()
+
+    def get(self, viewer_id):
+        now = time.time()
+        with self._lock:
+            generation = self._generation
+            cached = self._entries.get(viewer_id)
+            if self.ttl > 0 and cached and cached[1] > now:
+                return cached[0]
+
+        tray = load_tray(viewer_id)
+        if self.ttl > 0:
+            expires_at = now + self.ttl
+            utcnow = datetime.utcnow()
+            for entry in tray:
+                expires_at = min(expires_at, now + (entry['expires_at'] - utcnow).total_seconds())
+            with self._lock:
+                # Don't store a tray that was loaded before an eviction landed
+                if generation == self._generation:
+                    self._entries[viewer_id] = (tray, expires_at)
+        return tray
+
+    def invalidate(self, viewer_id=None):
+        """Evicts one viewer's tray, or every tray."""
+        with self._lock:
+            self._generation += 1
+            if viewer_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(viewer_id, None)
+
+    def clear(self):
+        self.invalidate()
+
+status_tray = StatusTrayCache()
@@ -0,0 +1,170 @@
+import os
+from collections import Counter
+from flask import current_app
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from extensions import db
+from models import Blob, StorageUsage, ChatMessage, Post, ChatRoom, ChatRoomMember
+from blob_store import blob_paths
+
+# model -> (path column, owners of its files as [(owner_type, owner id attribute)])
+ACCOUNTED = {
+    ChatMessage: ('file_path', [('room', 'room_id'), ('user', 'user_id')]),
+    Post: ('media_url', [('user', 'user_id')]),
+}
+
+def _sizes(connection, paths):
+    """Total size of the given blob paths (a path listed twice counts twice)."""
+    counts = Counter(paths)
+    if not counts:
+        return 0
+    sizes = dict(connection.execute(select(Blob.path, Blob.size).where(Blob.path.in_(list(counts)))).all())
+    return sum(sizes.get(path, 0) * count for path, count in counts.items())
+
+def _charge(connection, owners, size, files):
+    """Adds `size` bytes and `files` files to each (owner_type, owner_id) total, creating it if needed."""
+    if not size and not files:
+        return
+    table = StorageUsage.__table__
+    dialect = connection.dialect.name
+    for owner_type, owner_id in owners:
+        if owner_id is None:
+            continue
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            statement = insert(table).values(owner_type=owner_type, owner_id=owner_id, bytes=size, files=files)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=['owner_type', 'owner_id'],
+                set_={'bytes': table.c.bytes + statement.excluded.bytes, 'files': table.c.files + statement.excluded.files}
+            ))
+            continue
+        result = connection.execute(
+            update(table).where(table.c.owner_type == owner_type, table.c.owner_id == owner_id)
+            .values(bytes=table.c.bytes + size, files=table.c.files + files)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(owner_type=owner_type, owner_id=owner_id, bytes=size, files=files))
+
+# Totals are updated with SQL on the flush's own connection, so they commit or roll back with the
+# message or post that changed them. Sizes come from the Blob rows recorded at upload time, so no
+# file is ever stat'ed. Bulk deletes skip these events; call release_messages first, or
+# run `flask reconcile-storage` afterwards.
+
+def _listen(model, column, owner_attrs):
+    def owners(target):
+        return [(owner_type, getattr(target, attr)) for owner_type, attr in owner_attrs]
+
+    @event.listens_for(model, 'after_insert')
+    def _stored(mapper, connection, target):
+        paths = blob_paths(getattr(target, column))
+        _charge(connection, owners(target), _sizes(connection, paths), len(paths))
+
+    @event.listens_for(model, 'before_delete')
+    def _released(mapper, connection, target):
+        paths = blob_paths(getattr(target, column))
+        _charge(connection, owners(target), -_sizes(connection, paths), -len(paths))
+
+    @event.listens_for(model, 'after_update')
+    def _changed(mapper, connection, target):
+        history = inspect(target).attrs[column].history
+        if not history.has_changes():
+            return
+        added = [p for value in history.added for p in blob_paths(value)]
+        removed = [p for value in history.deleted for p in blob_paths(value)]
+        _charge(connection, owners(target), _sizes(connection, added) - _sizes(connection, removed),
+                len(added) - len(removed))
+
+for _model, (_column, _owners) in ACCOUNTED.items():
+    _listen(_model, _column, _owners)
+
+def release_messages(messages_query):
+    """
+    Takes the files of messages that are about to be bulk-deleted out of the totals, which the
+    events would otherwise miss. Call it with the query before deleting; does not commit.
+    """
+    paths_by_owner = {}
+    for file_path, room_id, user_id in messages_query.filter(ChatMessage.file_path.isnot(None)).with_entities(
+        ChatMessage.file_path, ChatMessage.room_id, ChatMessage.user_id
+    ):
+        for owner in (('room', room_id), ('user', user_id)):
+            paths_by_owner.setdefault(owner, []).extend(blob_paths(file_path))
+    connection = db.session.connection()
+    for owner, paths in paths_by_owner.items():
+        _charge(connection, [owner], -_sizes(connection, paths), -len(paths))
+
+def reconcile_storage():
+    """
+    Recomputes every room and user total from the accounted rows and the blob sizes, fixing any
+    that drifted. Does not commit. Returns the number of totals corrected.
+    """
+    sizes = dict(db.session.query(Blob.path, Blob.size))
+    totals = {}
+    for model, (column, owner_attrs) in ACCOUNTED.items():
+        attr = getattr(model, column)
+        owner_columns = [getattr(model, owner_attr) for _, owner_attr in owner_attrs]
+        for row in db.session.query(attr, *owner_columns).filter(attr.isnot(None)).yield_per(1000):
+            paths = blob_paths(row[0])
+            if not paths:
+                continue
+            size = sum(sizes.get(path, 0) for path in paths)
+            for (owner_type, _), owner_id in zip(owner_attrs, row[1:]):
+                total = totals.setdefault((owner_type, owner_id), [0, 0])
+                total[0] += size
+                total[1] += len(paths)
+
+    corrected = 0
+    for usage in StorageUsage.query.all():
+        actual_bytes, actual_files = totals.pop((usage.owner_type, usage.owner_id), (0, 0))
+        if (usage.bytes, usage.files) != (actual_bytes, actual_files):
+            usage.bytes, usage.files = actual_bytes, actual_files
+            corrected += 1
+    for (owner_type, owner_id), (size, files) in totals.items():
+        db.session.add(StorageUsage(owner_type=owner_type, owner_id=owner_id, bytes=size, files=files))
+        corrected += 1
+    return corrected
+
+def room_usage(room_ids):
+    """{room_id: (bytes, files)} for the given rooms that have stored any files."""
+    room_ids = list(room_ids)
+    if not room_ids:
+        return {}
+    return {
+        owner_id: (size, files) for owner_id, size, files in db.session.query(
+            StorageUsage.owner_id, StorageUsage.bytes, StorageUsage.files
+        ).filter(StorageUsage.owner_type == 'room', StorageUsage.owner_id.in_(room_ids), StorageUsage.files > 0)
+    }
+
+def user_usage(user_id):
+    """Bytes of uploaded files currently used by a user's messages and posts."""
+    size = db.session.query(StorageUsage.bytes).filter_by(owner_type='user', owner_id=user_id).scalar()
+    return size or 0
+
+def quota_for(user):
+    """A user's upload quota in bytes, or None for unlimited."""
+    if user.storage_quota is not None:
+        return user.storage_quota
+    return current_app.config.get('STORAGE_QUOTA')
+
+def upload_size(file):
+    """Size of an uploaded FileStorage, measured by seeking rather than reading it."""
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    return size
+
+def within_quota(user, incoming_bytes):
+    """Whether `user` may store `incoming_bytes` more without going over their quota."""
+    quota = quota_for(user)
+    if quota is None:
+        return True
+    return user_usage(user.id) + incoming_bytes <= quota
+
+def room_storage_summary(user_id):
+    """[{'name', 'bytes', 'files'}] for each of a user's rooms holding files, largest first."""
+    rooms = dict(db.session.query(ChatRoom.id, ChatRoom.name).join(
+        ChatRoomMember, ChatRoomMember.chat_room_id == ChatRoom.id
+    ).filter(ChatRoomMember.user_id == user_id))
+    usage = room_usage(rooms)
+    summary = [{'name': rooms[room_id], 'bytes': size, 'files': files} for room_id, (size, files) in usage.items()]
+    summary.sort(key=lambda item: item['bytes'], reverse=True)
+    return summary
@@ -2,6 +2,9 @@ from extensions import db
 from models import Post, Community, CommunityAnalytics, GenericComment
 from datetime import datetime, date, time
 from sqlalchemy import func
+from timeline import fan_out_post
+from expiry import reap_expired, summarize
+from chat_archive import archive_chat_history
 
 def publish_scheduled_posts(app):
     """
@@ -24,6 +27,9 @@ def publish_scheduled_posts(app):
             for post in due_posts:
                 print(f"Publishing post ID: {post.id} (Scheduled for: {post.scheduled_for})")
                 post.post_status = 'published'
+                # Feeds order by timestamp; a scheduled post goes out as of now, not when it was written
+                post.timestamp = datetime.utcnow()
+                fan_out_post(post)
 
             db.session.commit()
             print(f"Successfully published {len(due_posts)} posts.")
@@ -81,3 +87,40 @@ def snapshot_community_analytics(app):
             db.session.rollback()
         finally:
             print("--- Community Analytics Snapshot finished ---")
+
+
+def reap_expired_content(app):
+    """
+    Deletes expired statuses and stories with their views, polls, link previews and media,
+    in batches of EXPIRY_REAPER_BATCH_SIZE rows.
+    """
+    with app.app_context():
+        print(f"[{datetime.now()}] --- Running Expiry Reaper ---")
+
+        try:
+            report = reap_expired(batch_size=app.config.get('EXPIRY_REAPER_BATCH_SIZE', 500))
+            print(summarize(report))
+
+        except Exception as e:
+            print(f"An error occurred while reaping expired content: {e}")
+            db.session.rollback()
+        finally:
+            print("--- Expiry Reaper finished ---")
+
+
+def archive_old_messages(app):
+    """
+    Moves chat messages past their room's retention period into the compressed archive.
+    """
+    with app.app_context():
+        print(f"[{datetime.now()}] --- Running Chat Archiver ---")
+
+        try:
+            report = archive_chat_history()
+            print(f"Archived {sum(report.values())} messages from {len(report)} rooms.")
+
+        except Exception as e:
+            print(f"An error occurred while archiving chat history: {e}")
+            db.session.rollback()
+        finally:
+            print("--- Chat Archiver finished ---")
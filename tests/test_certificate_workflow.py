@@ -8,6 +8,7 @@ import uuid
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
+from certificate_renderer import certificate_renderer
 from extensions import db
 from models import User, Course, Category, Enrollment, Module, Lesson, Quiz, Assignment, FinalExam, LessonCompletion, QuizSubmission, AssignmentSubmission, ExamSubmission, CertificateRequest, Certificate, Question, Choice
 
@@ -129,11 +130,14 @@ class CertificateWorkflowTests(unittest.TestCase):
         self.login('admin@test.com', 'pw')
         response = self.client.post(f'/admin/certificate-request/{request_obj.id}/approve', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'has been approved and the certificate has been generated', response.data)
+        self.assertIn(b'has been approved and the certificate is being generated', response.data)
 
-        # Verify certificate object and file
+        # Verify certificate object and file once the background render has finished
+        certificate_renderer.join()
+        db.session.expire_all()
         cert = Certificate.query.filter_by(user_id=self.student.id, course_id=self.course.id).first()
         self.assertIsNotNone(cert)
+        self.assertEqual(cert.status, 'ready')
         self.assertTrue(os.path.exists(os.path.join(self.app.static_folder, cert.file_path)))
 
         # 6. Student sees certificate on profile
@@ -144,5 +148,82 @@ class CertificateWorkflowTests(unittest.TestCase):
         # The new design does not show the file path, so we remove this assertion.
         # We could add an assertion for the issue date if we wanted to be more thorough.
 
+    def test_progress_engine(self):
+        from sqlalchemy import event
+        from progress import load_course_records, compute_progress, progress_cache
+
+        # A second course so records are loaded for several courses at once
+        other = Course(title='Other Course', instructor_id=self.instructor.id, category_id=self.category.id, price_naira=0)
+        db.session.add(other)
+        db.session.commit()
+        for order in range(3):
+            module = Module(course_id=other.id, title=f'Other Module {order}', order=order)
+            db.session.add(module)
+            db.session.flush()
+            db.session.add(Assignment(module_id=module.id, title=f'Other Assignment {order}', description='Desc'))
+        db.session.commit()
+
+        courses = [db.session.get(Course, self.course.id), db.session.get(Course, other.id)]
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            records = load_course_records(self.student.id, courses)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), 6)
+        self.assertEqual(len(records[other.id].assignments), 3)
+        self.assertEqual(compute_progress(records[other.id])['percentage'], 0)
+
+        # Snapshots are served from the cache until a grade is recorded
+        progress_cache.ttl = 60
+        self.assertEqual(progress_cache.get_snapshots(self.student.id, [self.course])[self.course.id]['percentage'], 0)
+        submission = AssignmentSubmission(student_id=self.student.id, assignment_id=self.assignment.id, grade='A', file_path='')
+        db.session.add(submission)
+        db.session.commit()
+        self.assertEqual(progress_cache.get_snapshots(self.student.id, [self.course])[self.course.id]['percentage'], 0)
+
+        submission.grade = None
+        db.session.commit()
+        self.login('inst@test.com', 'pw')
+        self.client.post(f'/instructor/submission/{submission.id}/grade', data={'grade': 'Pass'})
+        snapshot = progress_cache.get_snapshots(self.student.id, [self.course])[self.course.id]
+        self.assertEqual(snapshot['percentage'], 50)
+        self.assertEqual(snapshot['reasons'], ['Quiz not passed: Test Module'])
+
+    def test_bulk_certificate_approval(self):
+        students = []
+        for i in range(3):
+            student = User(name=f'Graduate {i}', email=f'grad{i}@test.com', role='student', approved=True)
+            student.set_password('pw')
+            students.append(student)
+        db.session.add_all(students)
+        db.session.commit()
+        requests = [CertificateRequest(user_id=student.id, course_id=self.course.id) for student in students]
+        db.session.add_all(requests)
+        db.session.commit()
+
+        self.login('admin@test.com', 'pw')
+        response = self.client.post('/admin/certificate-requests/approve', data={
+            'request_ids': [req.id for req in requests[:2]]
+        }, follow_redirects=True)
+        self.assertIn(b'Approved 2 certificate requests', response.data)
+        certificate_renderer.join()
+        db.session.expire_all()
+
+        certificates = Certificate.query.filter_by(course_id=self.course.id).all()
+        self.assertEqual(sorted(c.user_id for c in certificates), [students[0].id, students[1].id])
+        self.assertTrue(all(c.status == 'ready' for c in certificates))
+        self.assertEqual(requests[2].status, 'pending')
+
+        # Downloads of certificates that aren't rendered yet report their status instead of waiting
+        certificates[0].status = 'rendering'
+        db.session.commit()
+        self.login('grad0@test.com', 'pw')
+        response = self.client.get(f'/student/certificate/{certificates[0].id}/download', headers={'Accept': 'application/json'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['status'], 'rendering')
+
 if __name__ == "__main__":
     unittest.main()
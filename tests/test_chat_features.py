@@ -8,7 +8,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Category, LibraryMaterial, LibraryPurchase, Course, Enrollment, ChatMessage, MutedUser, ChatRoom
+from models import User, Category, LibraryMaterial, LibraryPurchase, Course, Enrollment, ChatMessage, MutedUser, ChatRoom, ChatRoomMember, MutedRoom, FCMToken
 
 class TestConfig:
     TESTING = True
@@ -150,6 +150,842 @@ class ChatFeaturesTests(unittest.TestCase):
         self.assertEqual(json_data[0]['content'], 'Message 0')
         self.assertEqual(json_data[9]['content'], 'Message 9')
 
+    def test_chat_history_cursor_pagination(self):
+        from datetime import datetime
+        from sqlalchemy import event
+        from models import MessageReaction
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(user_id=self.student.id, chat_room_id=room.id))
+        # Messages sharing a timestamp are ordered by id
+        same_time = datetime(2026, 1, 1, 12, 0)
+        messages = [ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Message {i}", timestamp=same_time)
+                    for i in range(25)]
+        db.session.add_all(messages)
+        db.session.commit()
+        messages[24].replied_to_id = messages[0].id
+        db.session.add(MessageReaction(message_id=messages[24].id, user_id=self.student.id, reaction='👍'))
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(f'/chat/room/{room.id}/messages?limit=10')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        page = response.get_json()
+        self.assertEqual([m['content'] for m in page['messages']], [f"Message {i}" for i in range(15, 25)])
+        self.assertTrue(page['has_more'])
+        self.assertEqual(page['messages'][-1]['replied_to'], {'user_name': 'Instructor', 'content': 'Message 0'})
+        self.assertEqual(page['messages'][-1]['reactions'], [{'user_name': 'Student', 'reaction': '👍'}])
+        self.assertEqual(page['messages'][-1]['room_id'], room.id)
+        first_page_queries = len(statements)
+
+        contents = [m['content'] for m in page['messages']]
+        while page['has_more']:
+            statements.clear()
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                page = self.client.get(f"/chat/room/{room.id}/messages?limit=10&before={page['before']}").get_json()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+            self.assertLessEqual(len(statements), first_page_queries)
+            contents = [m['content'] for m in page['messages']] + contents
+        self.assertEqual(contents, [f"Message {i}" for i in range(25)])
+
+        # Scrolling forward from the oldest page returns the newer messages
+        page = self.client.get(f"/chat/room/{room.id}/messages?limit=10&after={page['after']}").get_json()
+        self.assertEqual([m['content'] for m in page['messages']], [f"Message {i}" for i in range(5, 15)])
+
+        self.assertEqual(self.client.get(f'/chat/room/{room.id}/messages?before=garbage').status_code, 400)
+
+    def test_chat_export_formats(self):
+        import csv
+        import gzip
+        import io
+        import json
+        import chat_export
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(user_id=self.student.id, chat_room_id=room.id))
+        for i in range(7):
+            db.session.add(ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Message {i}"))
+        db.session.add(ChatMessage(room_id=room.id, user_id=self.student.id, file_path='chat/a.pdf', file_name='a.pdf'))
+        db.session.commit()
+        # Small chunks so the export has to page through the room
+        self.addCleanup(setattr, chat_export, 'EXPORT_CHUNK_SIZE', chat_export.EXPORT_CHUNK_SIZE)
+        chat_export.EXPORT_CHUNK_SIZE = 3
+
+        self.login('stud@test.com', 'pw')
+        response = self.client.get(f'/chat/{room.id}/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'Chat export for: General')
+        self.assertTrue(lines[2].endswith('] Instructor: Message 0'))
+        self.assertTrue(lines[-1].endswith('] Student: File: a.pdf'))
+        self.assertEqual(len(lines), 10)
+
+        response = self.client.get(f'/chat/{room.id}/export?format=jsonl')
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['content'] for r in records[:7]], [f"Message {i}" for i in range(7)])
+        self.assertEqual(records[7]['file_name'], 'a.pdf')
+
+        response = self.client.get(f'/chat/{room.id}/export?format=csv&gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertIn('General_export.csv.gz', response.headers['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(gzip.decompress(response.data).decode('utf-8'))))
+        self.assertEqual(rows[0], ['message_id', 'timestamp', 'user_name', 'content', 'file_name'])
+        self.assertEqual(len(rows), 9)
+
+        self.assertEqual(self.client.get(f'/chat/{room.id}/export?format=xml').status_code, 400)
+
+    def test_unread_counts(self):
+        from chat_unread import get_room_summaries, increment_unread_counts, reset_unread_count
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(user_id=self.student.id, chat_room_id=room.id))
+        for i in range(3):
+            db.session.add(ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Message {i}"))
+        db.session.add(ChatMessage(room_id=room.id, user_id=self.student.id, content="My own message"))
+        db.session.commit()
+
+        # First read seeds the counter from UserLastRead; own messages don't count
+        summary = get_room_summaries(self.student.id, [room.id])[room.id]
+        self.assertEqual(summary['unread_count'], 3)
+        self.assertEqual(summary['last_message'].content, 'My own message')
+        self.assertFalse(summary['is_muted'])
+
+        # New messages bump the stored counter
+        increment_unread_counts(room.id, self.instructor.id)
+        db.session.commit()
+        self.assertEqual(get_room_summaries(self.student.id, [room.id])[room.id]['unread_count'], 4)
+
+        # Muted rooms are hidden in the chat list but still counted
+        db.session.add(MutedRoom(user_id=self.student.id, room_id=room.id))
+        db.session.commit()
+        summary = get_room_summaries(self.student.id, [room.id])[room.id]
+        self.assertTrue(summary['is_muted'])
+        self.assertEqual(summary['unread_count'], 4)
+
+        self.login('stud@test.com', 'pw')
+        response = self.client.get('/chat')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'chat-unread-whatsapp', response.data)
+
+        # Joining the room marks it read
+        reset_unread_count(self.student.id, room.id)
+        db.session.commit()
+        self.assertEqual(get_room_summaries(self.student.id, [room.id])[room.id]['unread_count'], 0)
+
+    def test_unread_counts_follow_socket_events(self):
+        from extensions import socketio
+        from models import RoomUnreadCounter
+        room = ChatRoom.query.filter_by(name='General').first()
+        room_id = room.id
+        db.session.add_all([
+            ChatRoomMember(user_id=self.student.id, chat_room_id=room_id),
+            ChatRoomMember(user_id=self.instructor.id, chat_room_id=room_id),
+            RoomUnreadCounter(user_id=self.student.id, room_id=room_id, unread_count=0),
+        ])
+        db.session.commit()
+        student_id = self.student.id
+
+        def unread():
+            return RoomUnreadCounter.query.filter_by(user_id=student_id, room_id=room_id).first().unread_count
+
+        # Socket handlers push their own contexts; keep the test's context (and its cached
+        # current_user) out of the way while they run.
+        self.app_context.pop()
+        try:
+            instructor_http = self.app.test_client()
+            instructor_http.post('/login', data={'email': 'inst@test.com', 'password': 'pw'})
+            instructor = socketio.test_client(self.app, flask_test_client=instructor_http)
+            instructor.emit('message', {'room_id': room_id, 'content': 'First'})
+            instructor.emit('message', {'room_id': room_id, 'content': 'Second'})
+            with self.app.app_context():
+                self.assertEqual(unread(), 2)
+                message_id = ChatMessage.query.filter_by(content='Second').first().id
+
+            instructor.emit('delete_message', {'message_id': message_id})
+            with self.app.app_context():
+                self.assertEqual(unread(), 1)
+
+            student_http = self.app.test_client()
+            student_http.post('/login', data={'email': 'stud@test.com', 'password': 'pw'})
+            student = socketio.test_client(self.app, flask_test_client=student_http)
+            student.emit('join', {'room_id': room_id})
+            with self.app.app_context():
+                self.assertEqual(unread(), 0)
+
+            instructor.disconnect()
+            student.disconnect()
+        finally:
+            self.app_context.push()
+
+    def test_read_watermarks(self):
+        from extensions import socketio
+        from models import RoomUnreadCounter, UserLastRead
+        from chat_unread import get_room_summaries, read_upto
+        room = ChatRoom.query.filter_by(name='General').first()
+        other = ChatRoom(name='Elsewhere', room_type='public')
+        db.session.add(other)
+        room_id = room.id
+        db.session.add_all([
+            ChatRoomMember(user_id=self.student.id, chat_room_id=room_id),
+            ChatRoomMember(user_id=self.instructor.id, chat_room_id=room_id),
+            RoomUnreadCounter(user_id=self.student.id, room_id=room_id, unread_count=0),
+        ])
+        db.session.commit()
+        other_message = ChatMessage(room_id=other.id, user_id=self.instructor.id, content='Elsewhere')
+        db.session.add(other_message)
+        db.session.commit()
+        student_id, other_message_id = self.student.id, other_message.id
+        instructor_id = self.instructor.id
+
+        def watermark():
+            return UserLastRead.query.filter_by(user_id=student_id, room_id=room_id).one().last_read_message_id
+
+        def unread():
+            return RoomUnreadCounter.query.filter_by(user_id=student_id, room_id=room_id).one().unread_count
+
+        self.app_context.pop()
+        try:
+            instructor_http = self.app.test_client()
+            instructor_http.post('/login', data={'email': 'inst@test.com', 'password': 'pw'})
+            instructor = socketio.test_client(self.app, flask_test_client=instructor_http)
+            instructor.emit('join', {'room_id': room_id})
+            for content in ('One', 'Two', 'Three'):
+                instructor.emit('message', {'room_id': room_id, 'content': content})
+            with self.app.app_context():
+                ids = [m.id for m in ChatMessage.query.filter_by(room_id=room_id).order_by(ChatMessage.id)]
+            instructor.get_received()
+
+            # Opening the room reads everything in it: one watermark, one event
+            student_http = self.app.test_client()
+            student_http.post('/login', data={'email': 'stud@test.com', 'password': 'pw'})
+            student = socketio.test_client(self.app, flask_test_client=student_http)
+            student.emit('join', {'room_id': room_id})
+            events = [e['args'][0] for e in instructor.get_received() if e['name'] == 'messages_read']
+            self.assertEqual(events, [{'room_id': room_id, 'read_by_user_id': student_id, 'last_read_message_id': ids[-1]}])
+            with self.app.app_context():
+                self.assertEqual((watermark(), unread()), (ids[-1], 0))
+
+            instructor.emit('message', {'room_id': room_id, 'content': 'Four'})
+            instructor.emit('message', {'room_id': room_id, 'content': 'Five'})
+            with self.app.app_context():
+                four, five = [m.id for m in ChatMessage.query.filter(ChatMessage.id > ids[-1]).order_by(ChatMessage.id)]
+                self.assertEqual(unread(), 2)
+            instructor.get_received()
+
+            student.emit('mark_as_read', {'room_id': room_id, 'message_ids': [ids[0], four]})
+            with self.app.app_context():
+                self.assertEqual((watermark(), unread()), (four, 1))
+            # The watermark never moves back, and other rooms' ids can't move it
+            student.emit('mark_as_read', {'room_id': room_id, 'message_id': ids[1]})
+            student.emit('mark_as_read', {'room_id': room_id, 'message_id': other_message_id})
+            with self.app.app_context():
+                self.assertEqual(watermark(), four)
+                self.assertEqual(UserLastRead.query.filter_by(user_id=student_id).count(), 1)
+            events = [e['args'][0]['last_read_message_id'] for e in instructor.get_received() if e['name'] == 'messages_read']
+            self.assertEqual(events, [four])
+
+            # Receipts for the sender come from the other members' watermarks
+            with self.app.app_context():
+                self.assertEqual(read_upto(room_id, instructor_id), four)
+
+            # Clearing the chat zeroes the counter without reading what it hides
+            student.emit('clear_chat', {'room_id': room_id})
+            with self.app.app_context():
+                self.assertEqual((watermark(), unread()), (four, 0))
+                self.assertEqual(read_upto(room_id, instructor_id), four)
+                # and a recount from the watermark skips the cleared messages
+                RoomUnreadCounter.query.filter_by(user_id=student_id, room_id=room_id).delete()
+                db.session.commit()
+                self.assertEqual(get_room_summaries(student_id, [room_id])[room_id]['unread_count'], 0)
+                db.session.commit()
+            self.assertFalse([e for e in instructor.get_received() if e['name'] == 'messages_read'])
+
+            instructor.disconnect()
+            student.disconnect()
+        finally:
+            self.app_context.push()
+
+    def test_room_access_cache(self):
+        from room_acl import room_access
+        from sqlalchemy import event
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(user_id=self.student.id, chat_room_id=room.id))
+        db.session.commit()
+
+        self.assertTrue(room_access.is_authorized(self.student, room))
+        self.assertFalse(room_access.is_muted(self.student.id, room.id))
+        self.assertEqual(room_access.stats()['misses'], 2)
+
+        # Repeat decisions come from the cache without touching the database
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            for _ in range(3):
+                self.assertTrue(room_access.is_authorized(self.student, room))
+                self.assertFalse(room_access.is_muted(self.student.id, room.id))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+        self.assertEqual(room_access.stats()['hits'], 6)
+
+        # Muting through the admin API evicts the cached decision
+        self.login('admin@test.com', 'pw')
+        response = self.client.post(f'/admin/chat/room/{room.id}/mute', json={'user_id': self.student.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(room_access.is_muted(self.student.id, room.id))
+        self.assertTrue(room_access.is_authorized(self.student, room))
+
+        # Changes that skip the invalidation hooks stay invisible until the entry is evicted
+        ChatRoomMember.query.filter_by(user_id=self.student.id, chat_room_id=room.id).delete()
+        db.session.commit()
+        self.assertTrue(room_access.is_authorized(self.student, room))
+        room_access.invalidate(user_id=self.student.id, room_id=room.id)
+        self.assertFalse(room_access.is_authorized(self.student, room))
+
+        response = self.client.get('/admin/api/room_acl_stats')
+        self.assertEqual(response.get_json()['misses'], 5)
+
+    def test_push_notification_fan_out(self):
+        from push_notifications import notification_dispatcher
+        self.app.config['PUSH_TRANSPORT'] = 'fake'
+        notification_dispatcher.init_app(self.app)
+        self.addCleanup(notification_dispatcher.shutdown)
+        notification_dispatcher.transport.invalid_tokens = {'stale-token'}
+
+        sender = User(name='Sender', email='sender@test.com', role='student', approved=True)
+        db.session.add(sender)
+        db.session.commit()
+        room = ChatRoom.query.filter_by(name='General').first()
+        for user in [sender, self.student, self.instructor, self.admin]:
+            db.session.add(ChatRoomMember(user_id=user.id, chat_room_id=room.id))
+        db.session.add_all([
+            FCMToken(user_id=sender.id, token='sender-token'),
+            FCMToken(user_id=self.student.id, token='student-token'),
+            FCMToken(user_id=self.student.id, token='stale-token'),
+            FCMToken(user_id=self.instructor.id, token='muted-token'),
+            FCMToken(user_id=self.admin.id, token='disabled-token'),
+            MutedRoom(user_id=self.instructor.id, room_id=room.id),
+        ])
+        self.admin.group_notifications_enabled = False
+        db.session.commit()
+
+        self.assertTrue(notification_dispatcher.notify_room(room.id, sender.id, 'New message from Sender', 'Hello'))
+        notification_dispatcher.join()
+
+        # One multicast covering every eligible device
+        sent = notification_dispatcher.transport.sent
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sorted(sent[0]['tokens']), ['stale-token', 'student-token'])
+
+        # Tokens Firebase rejected are pruned
+        db.session.expire_all()
+        self.assertIsNone(FCMToken.query.filter_by(token='stale-token').first())
+        self.assertIsNotNone(FCMToken.query.filter_by(token='student-token').first())
+
+    def test_storage_accounting(self):
+        from models import Blob
+        from storage import reconcile_storage, user_usage
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(chat_room_id=room.id, user_id=self.student.id))
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        response = self.client.post('/chat/upload', data={'file': (BytesIO(b'%PDF' + b'x' * 2044), 'notes.pdf')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        file_path = response.get_json()['file_path']
+        full_path = os.path.join(self.app.static_folder, file_path)
+        self.addCleanup(os.remove, full_path)
+        self.assertEqual(Blob.query.filter_by(path=file_path).one().size, 2048)
+
+        # Sending the file twice counts it twice, for the room and for the sender
+        messages = [ChatMessage(room_id=room.id, user_id=self.student.id, file_path=file_path) for _ in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.assertEqual(user_usage(self.student.id), 4096)
+
+        # The storage page reads the totals without touching the files
+        os.rename(full_path, full_path + '.moved')
+        try:
+            response = self.client.get('/settings/storage/manage')
+        finally:
+            os.rename(full_path + '.moved', full_path)
+        self.assertIn(b'General', response.data)
+        self.assertIn(b'4.1 kB (2 files)', response.data)
+
+        db.session.delete(messages[0])
+        db.session.commit()
+        self.assertEqual(user_usage(self.student.id), 2048)
+
+        # Uploads that would go over the quota are refused before anything is stored
+        self.student.storage_quota = 3000
+        db.session.commit()
+        response = self.client.post('/chat/upload', data={'file': (BytesIO(b'y' * 1000), 'more.pdf')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Blob.query.count(), 1)
+
+        self.client.post('/api/chats/delete_all')
+        self.assertEqual(user_usage(self.student.id), 0)
+        self.assertEqual(reconcile_storage(), 0)
+
+
+    def test_link_previews(self):
+        import threading
+        from collections import Counter
+        from unittest import mock
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from extensions import socketio
+        from models import Status, Post, LinkPreview
+        from link_previews import link_previewer
+
+        hits = Counter()
+        pages = {
+            '/article': ('text/html; charset=utf-8', b'<html><head><title>Fallback</title>'
+                         b'<meta property="og:title" content="Stub Article">'
+                         b'<meta property="og:description" content="About stubs">'
+                         b'<meta property="og:image" content="/cover.png"></head><body></body></html>'),
+            '/notes.txt': ('text/plain', b'just text'),
+            '/huge': ('text/html', b'<html><head>' + b' ' * 100000 + b'<title>Too far in</title></head></html>'),
+        }
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits[self.path] += 1
+                if self.path.startswith('/redirect?to='):
+                    self.send_response(302)
+                    self.send_header('Location', self.path[len('/redirect?to='):])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content_type, body = pages.get(self.path, ('text/html', b''))
+                self.send_response(200 if self.path in pages else 404)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        self.app.config.update(LINK_PREVIEW_ALLOW_PRIVATE=True, LINK_PREVIEW_MAX_BYTES=4096)
+        link_previewer.init_app(self.app)
+
+        # Private addresses are refused unless allowed
+        self.app.config['LINK_PREVIEW_ALLOW_PRIVATE'] = False
+        self.assertRaises(ValueError, link_previewer.fetch, f'{base}/article')
+        # ...including when a public page redirects to one; here 'localhost' stands in for a public host
+        public = base.replace('127.0.0.1', 'localhost')
+        with mock.patch('link_previews._is_public_host', lambda host: host == 'localhost'):
+            self.assertEqual(link_previewer.fetch(f'{public}/redirect?to=/article')['title'], 'Stub Article')
+            with self.assertRaisesRegex(ValueError, 'not public'):
+                link_previewer.fetch(f'{public}/redirect?to={base}/article')
+        self.assertEqual(hits['/article'], 1)
+        hits.clear()
+        self.app.config['LINK_PREVIEW_ALLOW_PRIVATE'] = True
+
+        # Fetched on a worker; the shared row is created pending and filled in
+        link_previewer.enqueue(f'{base}/article')
+        link_previewer.join()
+        preview = LinkPreview.query.filter_by(url=f'{base}/article').one()
+        self.assertEqual((preview.state, preview.title, preview.description, preview.image_url),
+                         ('ready', 'Stub Article', 'About stubs', f'{base}/cover.png'))
+
+        # A status and a post linking the same URL reuse the cached preview instead of fetching again
+        self.login('admin@test.com', 'pw')
+        self.client.post('/status/add', data={'status_type': 'text', 'text_content': f'Read this: {base}/article.'})
+        status = Status.query.filter_by(user_id=self.admin.id).one()
+        self.assertEqual(status.link_preview_id, preview.id)
+        self.client.post('/create_post', data={'content': f'Also {base}/article'})
+        self.assertEqual(Post.query.filter_by(user_id=self.admin.id).one().link_preview_id, preview.id)
+        self.assertEqual(hits['/article'], 1)
+
+        # Pages that can't be previewed are remembered as failures, not refetched each time
+        self.app.config['LINK_PREVIEW_WORKERS'] = 0
+        link_previewer.init_app(self.app)
+        for path in ('/notes.txt', '/huge', '/missing'):
+            failed = link_previewer.attach(Status(user_id=self.admin.id, content='x'), base + path)
+            self.assertEqual(failed.state, 'failed', path)
+            link_previewer.attach(Status(user_id=self.admin.id, content='x'), base + path)
+            self.assertEqual(hits[path], 1)
+        db.session.rollback()
+
+        # Chat messages carry the preview in their payload
+        room = ChatRoom.query.filter_by(name='General').first()
+        room_id = room.id
+        self.app_context.pop()
+        try:
+            sender_http = self.app.test_client()
+            sender_http.post('/login', data={'email': 'inst@test.com', 'password': 'pw'})
+            sender = socketio.test_client(self.app, flask_test_client=sender_http)
+            sender.emit('join', {'room_id': room_id})
+            sender.get_received()
+            sender.emit('message', {'room_id': room_id, 'content': f'See {base}/article'})
+            payloads = [event['args'] for event in sender.get_received() if event['name'] == 'message']
+            self.assertEqual(payloads[0]['link_preview']['title'], 'Stub Article')
+            sender.disconnect()
+        finally:
+            self.app_context.push()
+        self.assertEqual(hits['/article'], 1)
+
+    def test_status_tray(self):
+        from models import Status, StatusView, Poll, PollOption, PollVote, BlockedUser
+        from status_tray import status_tray, load_tray
+        self.app.config['STATUS_TRAY_TTL'] = 60
+        status_tray.init_app(self.app)
+        room = ChatRoom.query.filter_by(name='General').first()
+        first = Status(user_id=self.instructor.id, content_type='text', content='One')
+        second = Status(user_id=self.instructor.id, content_type='poll', content='Which?')
+        admins = Status(user_id=self.admin.id, content_type='text', content='Announcement')
+        db.session.add_all([first, second, admins])
+        db.session.commit()
+        poll = Poll(room_id=room.id, user_id=self.instructor.id, question='Which?', status_id=second.id)
+        yes, no = PollOption(poll=poll, text='Yes'), PollOption(poll=poll, text='No')
+        db.session.add_all([poll, yes, no])
+        db.session.commit()
+        db.session.add_all([PollVote(poll_id=poll.id, option_id=yes.id, user_id=self.admin.id),
+                            PollVote(poll_id=poll.id, option_id=yes.id, user_id=self.student.id)])
+        db.session.commit()
+        vote = PollVote.query.filter_by(user_id=self.student.id).one()
+        vote.option_id = no.id
+        db.session.commit()
+        self.assertEqual((yes.vote_count, no.vote_count), (1, 1))
+
+        self.login('stud@test.com', 'pw')
+        self.client.post(f'/status/mark_viewed/{first.id}')
+        tray = {entry['user']['id']: entry for entry in status_tray.get(self.student.id)}
+        self.assertEqual((tray[self.instructor.id]['count'], tray[self.instructor.id]['unseen']), (2, 1))
+        self.assertEqual(tray[self.admin.id]['unseen'], 1)
+
+        # Viewing the rest moves the instructor to viewed updates
+        self.client.post(f'/status/mark_viewed/{second.id}')
+        tray = {entry['user']['id']: entry for entry in status_tray.get(self.student.id)}
+        self.assertEqual(tray[self.instructor.id]['unseen'], 0)
+        self.assertIsNotNone(tray[self.instructor.id]['last_viewed'])
+        response = self.client.get('/status')
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(response.data.index(b'Recent Updates'), response.data.index(b'Viewed Updates'))
+
+        data = self.client.get(f'/status/data/{self.instructor.id}').get_json()
+        self.assertEqual([s['viewed'] for s in data['statuses']], [True, True])
+        self.assertEqual([(o['text'], o['votes'], o['percentage']) for o in data['statuses'][1]['poll']['options']],
+                         [('Yes', 1, 50), ('No', 1, 50)])
+
+        # Blocks hide authors in both directions
+        db.session.add(BlockedUser(blocker_id=self.admin.id, blocked_id=self.student.id))
+        db.session.commit()
+        self.assertIn(self.admin.id, [entry['user']['id'] for entry in status_tray.get(self.student.id)]) # cached
+        status_tray.invalidate(self.student.id)
+        self.assertEqual([entry['user']['id'] for entry in status_tray.get(self.student.id)], [self.instructor.id])
+
+        # New statuses, text ones included, reach every cached tray
+        self.login('inst@test.com', 'pw')
+        self.client.post('/status/add', data={'status_type': 'text', 'text_content': 'Three'})
+        self.assertEqual(status_tray.get(self.student.id)[0]['unseen'], 1)
+        self.assertEqual(load_tray(self.student.id), status_tray.get(self.student.id))
+
+    def test_poll_votes(self):
+        from sqlalchemy.exc import IntegrityError
+        from extensions import socketio
+        from models import Status, Poll, PollOption, PollVote
+        from polls import cast_vote, poll_updates
+        room = ChatRoom.query.filter_by(name='General').first()
+        room_id = room.id
+        db.session.add_all([ChatRoomMember(user_id=self.student.id, chat_room_id=room_id),
+                            ChatRoomMember(user_id=self.instructor.id, chat_room_id=room_id)])
+        poll = Poll(room_id=room_id, user_id=self.instructor.id, question='Lunch?')
+        yes, no = PollOption(poll=poll, text='Yes'), PollOption(poll=poll, text='No')
+        db.session.add_all([poll, yes, no])
+        db.session.commit()
+        poll_id, yes_id, no_id = poll.id, yes.id, no.id
+        instructor_id = self.instructor.id
+
+        # Voting again changes nothing; changing a vote moves one count
+        self.assertEqual(cast_vote(poll, yes, self.student.id), [yes_id])
+        db.session.commit()
+        self.assertEqual(cast_vote(poll, yes, self.student.id), [])
+        self.assertEqual(cast_vote(poll, no, self.student.id), [yes_id, no_id])
+        db.session.commit()
+        self.assertEqual((yes.vote_count, no.vote_count), (0, 1))
+        db.session.add(PollVote(poll_id=poll_id, option_id=yes_id, user_id=self.student.id))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        self.app_context.pop()
+        try:
+            instructor_http = self.app.test_client()
+            instructor_http.post('/login', data={'email': 'inst@test.com', 'password': 'pw'})
+            instructor = socketio.test_client(self.app, flask_test_client=instructor_http)
+            instructor.emit('join', {'room_id': room_id})
+            instructor.get_received()
+
+            # Votes inside one interval go out as a single update of the options they touched
+            self.app.config['POLL_UPDATE_INTERVAL_MS'] = 60000
+            poll_updates.init_app(self.app)
+            sent, coalesced = poll_updates.sent, poll_updates.coalesced
+            instructor.emit('poll_vote', {'option_id': yes_id})
+            instructor.emit('poll_vote', {'option_id': yes_id})
+            student_http = self.app.test_client()
+            student_http.post('/login', data={'email': 'stud@test.com', 'password': 'pw'})
+            student = socketio.test_client(self.app, flask_test_client=student_http)
+            student.emit('poll_vote', {'option_id': yes_id})
+            self.assertEqual([e for e in instructor.get_received() if e['name'] == 'poll_update'], [])
+            with self.app.app_context():
+                poll_updates.flush(poll_id)
+            updates = [e['args'][0] for e in instructor.get_received() if e['name'] == 'poll_update']
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(sorted((o['id'], o['votes']) for o in updates[0]['options']), [(yes_id, 2), (no_id, 0)])
+            self.assertEqual(updates[0]['total_votes'], 2)
+            self.assertEqual((poll_updates.sent - sent, poll_updates.coalesced - coalesced), (1, 1))
+
+            self.app.config['POLL_UPDATE_INTERVAL_MS'] = 0
+            poll_updates.init_app(self.app)
+            student.emit('poll_vote', {'option_id': no_id})
+            updates = [e['args'][0] for e in instructor.get_received() if e['name'] == 'poll_update']
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(sorted((o['id'], o['votes']) for o in updates[0]['options']), [(yes_id, 1), (no_id, 1)])
+
+            instructor.disconnect()
+            student.disconnect()
+        finally:
+            self.app_context.push()
+
+        # Status polls are voted on over HTTP
+        status = Status(user_id=instructor_id, content_type='poll', content='Tea?')
+        db.session.add(status)
+        db.session.commit()
+        status_poll = Poll(user_id=instructor_id, question='Tea?', status_id=status.id)
+        tea = PollOption(poll=status_poll, text='Tea')
+        db.session.add_all([status_poll, tea, PollOption(poll=status_poll, text='Coffee')])
+        db.session.commit()
+        self.login('stud@test.com', 'pw')
+        response = self.client.post(f'/status/poll/{tea.id}/vote')
+        self.assertEqual([(o['text'], o['votes']) for o in response.get_json()['options']], [('Tea', 1), ('Coffee', 0)])
+        self.client.post(f'/status/poll/{tea.id}/vote')
+        self.assertEqual(PollVote.query.filter_by(poll_id=status_poll.id).count(), 1)
+
+    def test_expiry_reaper(self):
+        import io
+        from datetime import datetime, timedelta
+        from models import Status, StatusView, Story, StoryView, Poll, PollOption, PollVote, LinkPreview, Blob
+        from blob_store import store_upload
+        from expiry import reap_expired
+        shared = store_upload(io.BytesIO(b'shared status image'), '.png')
+        own = store_upload(io.BytesIO(b'story clip only'), '.mp4')
+        for path in (shared, own):
+            file_path = os.path.join(self.app.static_folder, path)
+            self.addCleanup(lambda p=file_path: os.path.exists(p) and os.remove(p))
+        preview = LinkPreview(url_hash='a' * 64, url='https://example.com', state='ready')
+        db.session.add(preview)
+        db.session.commit()
+
+        yesterday = datetime.utcnow() - timedelta(hours=25)
+        expired = [Status(user_id=self.instructor.id, content_type='image', content=shared, created_at=yesterday),
+                   Status(user_id=self.instructor.id, content_type='poll', content='Done?', created_at=yesterday),
+                   Status(user_id=self.instructor.id, content_type='text', content='Old link', created_at=yesterday,
+                          link_preview=preview)]
+        live = Status(user_id=self.instructor.id, content_type='image', content=shared)
+        story = Story(user_id=self.instructor.id, media_type='video', media_url=own, created_at=yesterday)
+        db.session.add_all(expired + [live, story])
+        db.session.commit()
+        poll = Poll(user_id=self.instructor.id, question='Done?', status_id=expired[1].id)
+        option = PollOption(poll=poll, text='Yes')
+        db.session.add_all([poll, option,
+                            StatusView(status_id=expired[0].id, user_id=self.student.id),
+                            StoryView(story_id=story.id, user_id=self.student.id)])
+        db.session.commit()
+        db.session.add(PollVote(poll_id=poll.id, option_id=option.id, user_id=self.student.id))
+        message = ChatMessage(room_id=ChatRoom.query.first().id, user_id=self.student.id, content='Nice',
+                              replied_to_status_id=expired[0].id)
+        db.session.add(message)
+        Blob.query.update({'stored_at': yesterday})
+        db.session.commit()
+        live_id, message_id = live.id, message.id
+
+        report = reap_expired(batch_size=2)
+        self.assertEqual((report['statuses'], report['status_views'], report['polls'], report['link_previews']), (3, 1, 1, 1))
+        self.assertEqual((report['stories'], report['story_views']), (1, 1))
+        # The image is still used by a live status; the story's clip goes
+        self.assertEqual((report['files'], report['bytes']), (1, len(b'story clip only')))
+        self.assertEqual([s.id for s in Status.query.all()], [live_id])
+        self.assertEqual((Poll.query.count(), PollOption.query.count(), PollVote.query.count(), LinkPreview.query.count()), (0, 0, 0, 0))
+        self.assertIsNone(db.session.get(ChatMessage, message_id).replied_to_status_id)
+        self.assertEqual(Blob.query.filter_by(path=shared).one().ref_count, 1)
+        self.assertIsNone(Blob.query.filter_by(path=own).first())
+        self.assertTrue(os.path.exists(os.path.join(self.app.static_folder, shared)))
+        self.assertFalse(os.path.exists(os.path.join(self.app.static_folder, own)))
+        self.assertEqual(reap_expired()['statuses'], 0)
+
+    def test_chat_archive(self):
+        import json
+        import tempfile
+        from datetime import datetime, timedelta
+        from models import MessageReaction, ChatArchiveSegment
+        from chat_archive import archive_chat_history
+        archive = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive, True)
+        self.app.config['CHAT_ARCHIVE_FOLDER'] = archive
+        room = ChatRoom.query.filter_by(name='General').first()
+        db.session.add(ChatRoomMember(user_id=self.student.id, chat_room_id=room.id))
+        now = datetime.utcnow()
+        # Two old months, a pinned message among them, and a recent week
+        timestamps = [now - timedelta(days=400 - i) for i in range(3)] + [now - timedelta(days=370 - i) for i in range(3)] + \
+                     [now - timedelta(days=7 - i) for i in range(3)]
+        messages = [ChatMessage(room_id=room.id, user_id=self.instructor.id, content=f"Message {i}", timestamp=ts)
+                    for i, ts in enumerate(timestamps)]
+        messages[4].is_pinned = True
+        db.session.add_all(messages)
+        db.session.commit()
+        messages[7].replied_to_id = messages[1].id
+        messages[2].replied_to_id = messages[0].id
+        db.session.add(MessageReaction(message_id=messages[2].id, user_id=self.student.id, reaction='👍'))
+        db.session.commit()
+        room_id, pinned_id, reply_id = room.id, messages[4].id, messages[7].id
+
+        # Nothing is archived until a retention period is set
+        self.assertEqual(archive_chat_history(), {})
+        room.retention_days = 30
+        db.session.commit()
+        self.assertEqual(archive_chat_history(batch_size=2), {room_id: 5})
+        self.assertEqual(ChatMessage.query.count(), 4)
+        self.assertEqual(MessageReaction.query.count(), 0)
+        reply = db.session.get(ChatMessage, reply_id)
+        self.assertEqual((reply.replied_to_id, reply.replied_to_quote), (None, {"user_name": "Instructor", "content": "Message 1"}))
+        self.assertEqual(sorted((s.month, s.message_count) for s in ChatArchiveSegment.query),
+                         [(timestamps[0].strftime('%Y-%m'), 3), (timestamps[3].strftime('%Y-%m'), 2)] if
+                         timestamps[0].strftime('%Y-%m') != timestamps[3].strftime('%Y-%m') else
+                         [(timestamps[0].strftime('%Y-%m'), 5)])
+        self.assertIsNotNone(db.session.get(ChatMessage, pinned_id))
+
+        # A batch whose transaction failed leaves bytes past the committed length; they are ignored and overwritten
+        segment = ChatArchiveSegment.query.order_by(ChatArchiveSegment.month.desc()).first()
+        with open(os.path.join(archive, segment.path), 'ab') as f:
+            f.write(b'half a gzip member')
+        late = ChatMessage(room_id=room_id, user_id=self.student.id, content='Message 5b', timestamp=timestamps[5] + timedelta(minutes=1))
+        db.session.add(late)
+        db.session.commit()
+        self.assertEqual(archive_chat_history(), {room_id: 1})
+
+        # Scrolling back walks from the hot table into the archive in order
+        self.login('stud@test.com', 'pw')
+        expected = ['Message 0', 'Message 1', 'Message 2', 'Message 3', 'Message 4', 'Message 5', 'Message 5b',
+                    'Message 6', 'Message 7', 'Message 8']
+        page = self.client.get(f'/chat/room/{room_id}/messages?limit=3').get_json()
+        contents = [m['content'] for m in page['messages']]
+        self.assertEqual(contents, expected[-3:])
+        pages = [page]
+        while page['has_more']:
+            page = self.client.get(f"/chat/room/{room_id}/messages?limit=3&before={page['before']}").get_json()
+            pages.append(page)
+            contents = [m['content'] for m in page['messages']] + contents
+        self.assertEqual(contents, expected)
+        archived = {m['content']: m for p in pages for m in p['messages'] if m.get('archived')}
+        self.assertEqual(sorted(archived), ['Message 0', 'Message 1', 'Message 2', 'Message 3', 'Message 5', 'Message 5b'])
+        self.assertEqual(archived['Message 2']['reactions'], [{'user_name': 'Student', 'reaction': '👍'}])
+        self.assertEqual(archived['Message 2']['replied_to'], {'user_name': 'Instructor', 'content': 'Message 0'})
+
+        # And forward again from the oldest page
+        page = self.client.get(f"/chat/room/{room_id}/messages?limit=4&after={pages[-1]['after']}").get_json()
+        self.assertEqual([m['content'] for m in page['messages']], expected[1:5])
+
+        # Exports include the archived messages, in id order
+        response = self.client.get(f'/chat/{room_id}/export?format=jsonl')
+        records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['content'] for r in records], [f'Message {i}' for i in range(9)] + ['Message 5b'])
+
+    def test_socket_rate_limits_and_typing(self):
+        from extensions import socketio
+        from socket_limits import socket_limiter
+        from typing_indicators import typing_tracker
+        room = ChatRoom.query.filter_by(name='General').first()
+        room_id = room.id
+        db.session.add_all([ChatRoomMember(user_id=self.student.id, chat_room_id=room_id),
+                            ChatRoomMember(user_id=self.instructor.id, chat_room_id=room_id)])
+        db.session.commit()
+        student_id, instructor_id = self.student.id, self.instructor.id
+
+        # Buckets refill at their rate up to the burst size
+        self.assertTrue(all(socket_limiter.allow('sid', 'typing_start', now=0) for _ in range(3)))
+        self.assertFalse(socket_limiter.allow('sid', 'typing_start', now=0.5))
+        self.assertTrue(socket_limiter.allow('sid', 'typing_start', now=1))
+        self.assertTrue(socket_limiter.allow('other', 'typing_start', now=1))
+        # Trickle ICE for a group call fits in the signalling budget
+        self.assertTrue(all(socket_limiter.allow('sid', 'webrtc_ice_candidate', now=0) for _ in range(150)))
+        socket_limiter.forget('sid')
+        self.assertTrue(socket_limiter.allow('sid', 'typing_start', now=1))
+
+        self.app_context.pop()
+        try:
+            def connect(email):
+                http = self.app.test_client()
+                http.post('/login', data={'email': email, 'password': 'pw'})
+                client = socketio.test_client(self.app, flask_test_client=http)
+                client.emit('join', {'room_id': room_id})
+                client.get_received()
+                return client
+            instructor, student = connect('inst@test.com'), connect('stud@test.com')
+            self.app.config['SOCKET_RATE_LIMITS_ENABLED'] = False
+            socket_limiter.init_app(self.app)
+
+            # Reports inside one interval go out as a single update listing everyone typing
+            self.app.config['TYPING_UPDATE_INTERVAL_MS'] = 60000
+            typing_tracker.init_app(self.app)
+            sent, coalesced = typing_tracker.sent, typing_tracker.coalesced
+            student.emit('typing_start', {'room_id': room_id})
+            student.emit('typing_start', {'room_id': room_id})
+            instructor.emit('typing_start', {'room_id': room_id})
+            self.assertEqual([e for e in student.get_received() if e['name'] == 'typing_update'], [])
+            typing_tracker.flush(room_id)
+            updates = [e['args'][0] for e in student.get_received() if e['name'] == 'typing_update']
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(sorted(u['user_id'] for u in updates[0]['users']), sorted([student_id, instructor_id]))
+            self.assertEqual((typing_tracker.sent - sent, typing_tracker.coalesced - coalesced), (1, 2))
+
+            # Lapsed typers drop out
+            self.assertEqual(typing_tracker.expire(room_id, now=float('inf')), 2)
+            typing_tracker.flush(room_id)
+            updates = [e['args'][0] for e in instructor.get_received() if e['name'] == 'typing_update']
+            self.assertEqual(updates[-1]['users'], [])
+
+            # Sending a message or disconnecting ends typing straight away with no interval
+            self.app.config['TYPING_UPDATE_INTERVAL_MS'] = 0
+            typing_tracker.init_app(self.app)
+            student.emit('typing_start', {'room_id': room_id})
+            student.emit('message', {'room_id': room_id, 'content': 'Hello'})
+            updates = [e['args'][0] for e in instructor.get_received() if e['name'] == 'typing_update']
+            self.assertEqual([[u['user_id'] for u in update['users']] for update in updates], [[student_id], []])
+            student.emit('typing_start', {'room_id': room_id})
+            instructor.get_received()
+            student.disconnect()
+            updates = [e['args'][0] for e in instructor.get_received() if e['name'] == 'typing_update']
+            self.assertEqual(updates[-1]['users'], [])
+
+            # Events past a connection's budget are dropped before the handler runs
+            self.app.config['SOCKET_RATE_LIMITS_ENABLED'] = True
+            self.app.config['SOCKET_RATE_LIMITS'] = {'typing_start': (1, 2), 'typing_stop': (1, 2)}
+            socket_limiter.init_app(self.app)
+            dropped = socket_limiter.dropped.copy()
+            for _ in range(4):
+                instructor.emit('typing_start', {'room_id': room_id})
+                instructor.emit('typing_stop', {'room_id': room_id})
+            updates = [e for e in instructor.get_received() if e['name'] == 'typing_update']
+            self.assertEqual(len(updates), 4)
+            self.assertEqual(socket_limiter.dropped - dropped, {'typing_start': 2, 'typing_stop': 2})
+            instructor.disconnect()
+        finally:
+            self.app_context.push()
 
 if __name__ == "__main__":
     unittest.main()
@@ -131,6 +131,102 @@ class ExamFeaturesTests(unittest.TestCase):
         self.assertIn(b'Request Certificate', response.data)
         self.assertNotIn(b'disabled', response.data)
 
+    def test_answer_key_grading_and_regrade(self):
+        from grading import answer_keys, regrade_exam
+        from models import Answer
+        exam = FinalExam(course_id=self.course_id, pass_mark=50, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        single = Question(exam_id=exam.id, question_text='2+2?', marks=2.0, negative_marking=1.0)
+        multiple = Question(exam_id=exam.id, question_text='Even numbers?', question_type='multiple_choice_multiple', marks=2.0)
+        true_false = Question(exam_id=exam.id, question_text='Sky is blue?', question_type='true_false', true_false_answer=True, marks=1.0)
+        essay = Question(exam_id=exam.id, question_text='Explain.', question_type='essay', marks=5.0)
+        db.session.add_all([single, multiple, true_false, essay])
+        db.session.commit()
+        three, four = Choice(question_id=single.id, choice_text='3'), Choice(question_id=single.id, choice_text='4', is_correct=True)
+        two, five, six = (Choice(question_id=multiple.id, choice_text='2', is_correct=True),
+                          Choice(question_id=multiple.id, choice_text='5'),
+                          Choice(question_id=multiple.id, choice_text='6', is_correct=True))
+        db.session.add_all([three, four, two, five, six])
+        db.session.commit()
+
+        self.login('stud@test.com', 'pw')
+        self.client.get(f'/course/{self.course_id}/enroll', follow_redirects=True)
+        self.client.post(f'/exam/{exam.id}/start')
+        submission = ExamSubmission.query.filter_by(final_exam_id=exam.id, student_id=self.student.id).first()
+
+        # Wrong single choice costs its negative marking; the essay waits for the instructor
+        response = self.client.post(f'/exam/{submission.id}/submit', data={
+            f'q_{single.id}': three.id,
+            f'q_{multiple.id}': [two.id, six.id],
+            f'q_{true_false.id}': 'True',
+            f'q_{essay.id}': 'Because.'
+        })
+        self.assertEqual(response.status_code, 200)
+        submission = db.session.get(ExamSubmission, submission.id)
+        self.assertAlmostEqual(submission.score, (-1 + 2 + 1) / 10 * 100)
+        marks = {a.question_id: a.marks_awarded for a in Answer.query.filter_by(exam_submission_id=submission.id)}
+        self.assertEqual(marks, {single.id: -1.0, multiple.id: 2.0, true_false.id: 1.0, essay.id: None})
+
+        # Correct the key to '3' and re-score what was already submitted
+        three.is_correct = True
+        four.is_correct = False
+        db.session.commit()
+        self.assertEqual(regrade_exam(exam), 1)
+        db.session.commit()
+        self.assertAlmostEqual(submission.score, (2 + 2 + 1) / 10 * 100)
+        self.assertEqual(answer_keys.for_exam(exam).questions[0].correct_choices, frozenset([three.id]))
+
+
+    def test_item_analysis_report(self):
+        from datetime import datetime
+        from werkzeug.datastructures import MultiDict
+        from grading import answer_keys, grade_exam_submission
+        from item_analysis import item_analysis
+        exam = FinalExam(course_id=self.course_id, is_published=True)
+        db.session.add(exam)
+        db.session.commit()
+        easy = Question(exam_id=exam.id, question_text='Easy?', question_type='true_false', true_false_answer=True)
+        hard = Question(exam_id=exam.id, question_text='Hard?')
+        db.session.add_all([easy, hard])
+        db.session.commit()
+        right, wrong = Choice(question_id=hard.id, choice_text='Right', is_correct=True), Choice(question_id=hard.id, choice_text='Wrong')
+        db.session.add_all([right, wrong])
+        db.session.commit()
+
+        students = []
+        for i in range(4):
+            student = User(name=f'S{i}', email=f's{i}@test.com', role='student', approved=True)
+            student.set_password('pw')
+            students.append(student)
+        db.session.add_all(students)
+        db.session.commit()
+
+        # Everyone gets the easy question; only the strongest student gets the hard one
+        for i, student in enumerate(students):
+            submission = ExamSubmission(final_exam_id=exam.id, student_id=student.id, submitted_at=datetime.utcnow(), status='pending_review')
+            db.session.add(submission)
+            db.session.flush()
+            grade_exam_submission(submission, answer_keys.for_exam(exam), MultiDict({
+                f'q_{easy.id}': 'True',
+                f'q_{hard.id}': str(right.id if i == 3 else wrong.id)
+            }))
+        db.session.commit()
+
+        report = item_analysis.for_exam(exam)
+        self.assertEqual(report['respondents'], 4)
+        easy_item, hard_item = report['items']
+        self.assertEqual(easy_item['difficulty'], 1.0)
+        self.assertEqual(hard_item['difficulty'], 0.25)
+        self.assertEqual(hard_item['discrimination'], 1.0)
+        self.assertEqual([o['count'] for o in hard_item['options']], [1, 3])
+        self.assertEqual(report['histogram'][5], ('50-60', 3))
+        self.assertIs(item_analysis.for_exam(exam), report)
+
+        self.login('inst@test.com', 'pw')
+        response = self.client.get(f'/instructor/exam/{exam.id}/item-analysis')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Hard?', response.data)
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 import sys
 import os
+import shutil
+import tempfile
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -30,6 +32,12 @@ class FeedWorldTests(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def use_temporary_static_folder(self):
+        """Points uploads at a throwaway static folder instead of the repository's."""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.app.static_folder = folder
+
     def seed_users(self):
         self.user1 = User(name='Test User 1', email='test1@example.com', role='student', approved=True)
         self.user1.set_password('pw')
@@ -106,5 +114,219 @@ class FeedWorldTests(unittest.TestCase):
         self.assertIsNotNone(report)
         self.assertEqual(report.reported_by_id, self.user1.id)
 
+    def test_search_posts(self):
+        from search_index import search_index
+        posts = [
+            Post(user_id=self.user1.id, content='Learning photosynthesis today'),
+            Post(user_id=self.user2.id, content='Photography walk in the park'),
+            Post(user_id=self.user2.id, content='Nothing to see here'),
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        def matching(term):
+            return [p.content for p in search_index.filter(Post.query, 'post', term).all()]
+
+        # Prefix matching, and edits and deletes keep the index in sync
+        self.assertEqual(sorted(matching('photo')), ['Learning photosynthesis today', 'Photography walk in the park'])
+        posts[0].content = 'Learning chemistry today'
+        db.session.commit()
+        self.assertEqual(matching('photo'), ['Photography walk in the park'])
+        Post.query.filter_by(id=posts[1].id).delete()
+        db.session.commit()
+        self.assertEqual(matching('photo'), [])
+        # FTS5 syntax in user input is taken literally
+        self.assertEqual(matching('"see" OR'), [])
+        self.assertEqual(matching('see'), ['Nothing to see here'])
+
+        # Rebuilding from the table gives the same results
+        search_index.rebuild(['post'])
+        self.assertEqual(matching('chem'), ['Learning chemistry today'])
+
+        self.login_user1()
+        response = self.client.get('/search?q=chemistry')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Learning chemistry today', response.data)
+
+    def test_home_feed_timeline(self):
+        from datetime import datetime, timedelta
+        from models import TimelineEntry
+        from tasks import publish_scheduled_posts
+        from timeline import get_timeline_page, fan_out_post
+        from utils import encode_cursor
+        self.login_user1()
+        self.client.post(f'/follow/{self.user2.id}')
+
+        def publish(content):
+            post = Post(user_id=self.user2.id, content=content)
+            db.session.add(post)
+            fan_out_post(post)
+            db.session.commit()
+
+        # Posts are copied into followers' timelines when published
+        for i in range(3):
+            publish(f'Post {i}')
+        # Written two days ago, due now
+        scheduled = Post(user_id=self.user2.id, content='Scheduled post', post_status='scheduled',
+                         timestamp=datetime.utcnow() - timedelta(days=2),
+                         scheduled_for=datetime.utcnow() - timedelta(minutes=1))
+        db.session.add(scheduled)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user1.id).count(), 3)
+        publish_scheduled_posts(self.app)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user1.id).count(), 4)
+
+        posts, has_more = get_timeline_page(self.user1.id, limit=3)
+        self.assertEqual(posts[0].content, 'Scheduled post')
+        self.assertTrue(has_more)
+        older, has_more = get_timeline_page(self.user1.id, before=encode_cursor(posts[-1]), limit=3)
+        self.assertFalse(has_more)
+        self.assertEqual(len({p.id for p in posts + older}), 4)
+
+        # Authors over the fan-out limit are merged in at read time instead
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        publish('Celebrity post')
+        self.assertTrue(db.session.get(User, self.user2.id).high_fanout)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user1.id).count(), 4)
+        posts, _ = get_timeline_page(self.user1.id)
+        self.assertEqual(posts[0].content, 'Celebrity post')
+        self.assertEqual(len(posts), 5)
+
+        self.assertEqual(self.client.get('/feed?before=garbage').status_code, 400)
+
+        # Unfollowing empties the timeline
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 5000
+        User.query.get(self.user2.id).high_fanout = False
+        db.session.commit()
+        self.client.post(f'/unfollow/{self.user2.id}')
+        self.assertEqual(get_timeline_page(self.user1.id), ([], False))
+
+    def test_engagement_counters(self):
+        from models import Like, GenericComment, Share
+        from engagement import reconcile_counters
+        post = Post(user_id=self.user1.id, content='Counted post')
+        db.session.add(post)
+        db.session.commit()
+
+        like = Like(user_id=self.user2.id, target_type='post', target_id=post.id)
+        db.session.add_all([
+            like,
+            GenericComment(user_id=self.user2.id, target_type='post', target_id=post.id, content='Nice'),
+            GenericComment(user_id=self.user1.id, target_type='post', target_id=post.id, content='Thanks'),
+            Share(user_id=self.user2.id, post_id=post.id),
+        ])
+        db.session.commit()
+        self.assertEqual((post.like_count, post.comment_count, post.share_count), (1, 2, 1))
+
+        db.session.delete(like)
+        db.session.commit()
+        self.assertEqual(post.like_count, 0)
+
+        # Bulk deletes bypass the ORM events; reconciliation repairs the drift
+        GenericComment.query.filter_by(target_type='post', target_id=post.id).delete()
+        db.session.commit()
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(reconcile_counters(['post']), {'post': 1})
+        db.session.commit()
+        self.assertEqual(post.comment_count, 0)
+        self.assertEqual(reconcile_counters(), {'post': 0, 'reel': 0, 'project': 0, 'creative_work': 0})
+
+    def test_image_variants(self):
+        import hashlib
+        import io
+        from PIL import Image
+        from image_pipeline import image_pipeline, image_url
+        from models import ImageAsset, Blob
+        self.use_temporary_static_folder()
+
+        # A 2000x1000 photo taken with the camera on its side, carrying a GPS tag
+        exif = Image.Exif()
+        exif[0x0112] = 6 # Orientation: rotate 90 degrees clockwise
+        exif[0x8825] = {1: 'N'} # GPSInfo
+        upload = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(upload, format='JPEG', exif=exif)
+        upload.seek(0)
+
+        self.login_user1()
+        self.client.post('/create_post', data={
+            'content': 'Photo', 'media': (upload, 'photo.jpg', 'image/jpeg')
+        }, content_type='multipart/form-data')
+        image_pipeline.join()
+
+        path = Post.query.filter_by(content='Photo').one().media_url[0]
+        asset = ImageAsset.query.filter_by(path=path).one()
+
+        self.assertEqual(asset.status, 'ready')
+        self.assertEqual((asset.width, asset.height), (1000, 2000))
+        self.assertEqual({name: v['width'] for name, v in asset.variants.items()}, {'thumb': 320, 'medium': 800, 'full': 1000})
+        # 'full' would upscale, so it reuses the image's own width
+        self.assertEqual(asset.variants['full']['height'], 2000)
+        with Image.open(os.path.join(self.app.static_folder, asset.variants['thumb']['webp'])) as thumb:
+            self.assertEqual((thumb.format, thumb.size), ('WEBP', (320, 640)))
+            self.assertFalse(thumb.getexif())
+        with Image.open(os.path.join(self.app.static_folder, path)) as original:
+            self.assertEqual(original.size, (1000, 2000))
+            self.assertFalse(original.getexif())
+        # EXIF went before the upload was stored, so the blob still matches its name and size
+        with open(os.path.join(self.app.static_folder, path), 'rb') as f:
+            data = f.read()
+        self.assertIn(hashlib.sha256(data).hexdigest(), path)
+        self.assertEqual(Blob.query.filter_by(path=path).one().size, len(data))
+
+        with self.app.test_request_context():
+            self.assertTrue(image_url(path, 'thumb').endswith(asset.variants['thumb']['jpeg']))
+            self.assertTrue(image_url('uploads/images/unknown.png').endswith('uploads/images/unknown.png'))
+
+    def test_blob_store(self):
+        import hashlib
+        import io
+        from datetime import timedelta
+        from blob_store import rehome_uploads, collect_garbage
+        from models import Blob
+        self.use_temporary_static_folder()
+        data = b'%PDF-1.4 the same lecture notes'
+        digest = hashlib.sha256(data).hexdigest()
+
+        self.login_user1()
+        for content in ('First', 'Second'):
+            self.client.post('/create_post', data={
+                'content': content, 'media': (io.BytesIO(data), 'notes.pdf', 'application/pdf')
+            }, content_type='multipart/form-data')
+        first, second = Post.query.filter(Post.content.in_(['First', 'Second'])).order_by(Post.id).all()
+        path = first.media_url[0]
+        file_path = os.path.join(self.app.static_folder, path)
+
+        # Stored once, under its hash, and counted once per reference
+        self.assertEqual(path, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}.pdf')
+        self.assertEqual(second.media_url, [path])
+        blob = Blob.query.filter_by(path=path).one()
+        self.assertEqual((blob.size, blob.ref_count), (len(data), 2))
+        db.session.delete(second)
+        db.session.commit()
+        self.assertEqual(blob.ref_count, 1)
+
+        # A copy left in an old upload folder is folded into the existing blob
+        legacy = 'uploads/images/legacy_notes.pdf'
+        legacy_path = os.path.join(self.app.static_folder, legacy)
+        os.makedirs(os.path.dirname(legacy_path), exist_ok=True)
+        with open(legacy_path, 'wb') as f:
+            f.write(data)
+        third = Post(user_id=self.user2.id, content='Legacy', media_url=[legacy])
+        db.session.add(third)
+        db.session.commit()
+        self.assertEqual(rehome_uploads(), {legacy: path})
+        self.assertEqual(third.media_url, [path])
+        self.assertFalse(os.path.exists(legacy_path))
+        self.assertEqual(blob.ref_count, 2)
+
+        # Referenced blobs survive collection; unreferenced ones go
+        self.assertEqual(collect_garbage(timedelta(0)), 0)
+        db.session.delete(first)
+        db.session.delete(third)
+        db.session.commit()
+        self.assertEqual(collect_garbage(timedelta(0)), 1)
+        self.assertFalse(os.path.exists(file_path))
+        self.assertIsNone(Blob.query.filter_by(path=path).first())
+
 if __name__ == '__main__':
     unittest.main()
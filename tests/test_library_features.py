@@ -2,13 +2,16 @@ import unittest
 import sys
 import os
 import shutil
+import hashlib
+import tempfile
 from io import BytesIO
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
 from extensions import db
-from models import User, Category, LibraryMaterial, LibraryPurchase
+from models import User, Category, LibraryMaterial, LibraryPurchase, UploadSession
+from file_delivery import download_counter
 
 class TestConfig:
     TESTING = True
@@ -20,6 +23,10 @@ class TestConfig:
 class LibraryFeaturesTests(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
+        # Uploaded materials go to a throwaway static folder instead of the repository's
+        self.static_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_folder, True)
+        self.app.static_folder = self.static_folder
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -124,7 +131,121 @@ class LibraryFeaturesTests(unittest.TestCase):
         self.login('stud@test.com', 'pw')
         response = self.client.get(f'/library/{material.id}/download')
         self.assertEqual(response.status_code, 200)
+        response.close()
+        # Counts are written behind the download
+        self.assertEqual(download_counter.pending(material.id), 1)
+        download_counter.flush()
+        db.session.refresh(material)
         self.assertEqual(material.download_count, 1)
 
+    def test_download_delivery(self):
+        content = b"0123456789" * 10
+        material = LibraryMaterial(title='Free Notes', category_id=self.category.id, price_naira=0,
+                                   uploader_id=self.instructor.id, approved=True, file_path='library_files/free_notes.pdf')
+        db.session.add(material)
+        db.session.commit()
+        file_path = os.path.join(self.app.static_folder, material.file_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        self.login('stud@test.com', 'pw')
+
+        # Ranges resume an interrupted download
+        response = self.client.get(f'/library/{material.id}/download', headers={'Range': 'bytes=90-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[90:])
+        self.assertIn('Free_Notes.pdf', response.headers['Content-Disposition'])
+        response.close()
+        # ...without counting the resume as another download
+        self.assertEqual(download_counter.pending(material.id), 0)
+        response = self.client.get(f'/library/{material.id}/download', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        response.close()
+        self.assertEqual(download_counter.pending(material.id), 1)
+
+        # Signed links work without the session, until they are tampered with or expire
+        url = self.client.get(f'/library/{material.id}/download?link=1').get_json()['url']
+        self.client.get('/logout')
+        response = self.client.get(url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual((response.status_code, response.data), (206, content[:10]))
+        response.close()
+        self.assertEqual(self.client.get(url[:-2] + 'xx').status_code, 403)
+        self.app.config['FILE_URL_TTL'] = -1
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(download_counter.pending(material.id), 2)
+
+        # Offloaded, the worker only sends headers
+        self.app.config.update(FILE_DELIVERY='x-accel', FILE_DELIVERY_ACCEL_PREFIX='/protected/')
+        self.login('stud@test.com', 'pw')
+        response = self.client.get(f'/library/{material.id}/download')
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected/library_files/free_notes.pdf')
+        self.assertEqual(response.data, b'')
+
+        download_counter.flush()
+        db.session.refresh(material)
+        self.assertEqual(material.download_count, 3)
+
+    def test_resumable_library_upload(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.app.config.update(CHUNKED_UPLOAD_FOLDER=folder, CHUNKED_UPLOAD_CHUNK_SIZE=8)
+        content = b"sixteen byte pdf and a tail"
+        self.login('inst@test.com', 'pw')
+
+        response = self.client.post('/api/uploads', json={
+            'purpose': 'library', 'filename': 'big.pdf', 'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest()
+        })
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.get_json()['upload_id']
+        self.assertEqual(self.client.post('/api/uploads', json={
+            'purpose': 'library', 'filename': 'big.exe', 'size': 10, 'sha256': '0' * 64
+        }).status_code, 400)
+
+        self.assertEqual(self.client.put(f'/api/uploads/{upload_id}?offset=0', data=content[:8]).get_json()['offset'], 8)
+        # A retry of a chunk that already arrived, and one that skips ahead, both report where to resume
+        response = self.client.put(f'/api/uploads/{upload_id}?offset=0', data=content[:8])
+        self.assertEqual((response.status_code, response.get_json()['offset']), (409, 8))
+        self.assertEqual(self.client.put(f'/api/uploads/{upload_id}?offset=16', data=content[16:]).status_code, 409)
+        self.assertEqual(self.client.put(f'/api/uploads/{upload_id}?offset=8', data=content[8:]).status_code, 413)
+
+        self.client.put(f'/api/uploads/{upload_id}?offset=8', data=content[8:16])
+        self.assertEqual(self.client.post(f'/api/uploads/{upload_id}/finalize').status_code, 422)
+        self.client.put(f'/api/uploads/{upload_id}?offset=16', data=content[16:24])
+        self.client.put(f'/api/uploads/{upload_id}?offset=24', data=content[24:])
+        response = self.client.post(f'/api/uploads/{upload_id}/finalize')
+        self.assertEqual(response.status_code, 200)
+        saved_path = response.get_json()['path']
+        self.assertEqual(os.listdir(folder), [])
+
+        # Someone else can't see or claim it
+        self.login('stud@test.com', 'pw')
+        self.assertEqual(self.client.get(f'/api/uploads/{upload_id}').status_code, 404)
+
+        self.login('inst@test.com', 'pw')
+        self.client.post('/instructor/library/submit', data={
+            'title': 'Big Book', 'category_id': self.category.id, 'price_naira': 500, 'upload_id': upload_id
+        })
+        material = LibraryMaterial.query.filter_by(title='Big Book').first()
+        self.assertEqual(material.file_path, saved_path)
+        with open(os.path.join(self.app.static_folder, saved_path), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(db.session.get(UploadSession, upload_id).status, 'claimed')
+
+    def test_resumable_upload_checksum_mismatch(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.app.config.update(CHUNKED_UPLOAD_FOLDER=folder)
+        self.login('inst@test.com', 'pw')
+
+        upload_id = self.client.post('/api/uploads', json={
+            'purpose': 'library', 'filename': 'notes.pdf', 'size': 5, 'sha256': hashlib.sha256(b"hello").hexdigest()
+        }).get_json()['upload_id']
+        self.client.put(f'/api/uploads/{upload_id}?offset=0', data=b"hellp")
+        response = self.client.post(f'/api/uploads/{upload_id}/finalize')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['offset'], 0)
+        self.assertEqual(LibraryMaterial.query.count(), 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from flask_migrate import upgrade
+from app import create_app
+from extensions import db
+
+MIGRATIONS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'migrations'))
+
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class Config:
+            TESTING = True
+            SECRET_KEY = 'test'
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp_dir, 'app.db')
+
+        self.app = create_app(Config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def search_triggers(self):
+        return set(db.session.execute(db.text(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%\\_fts\\_%' ESCAPE '\\'"
+        )).scalars())
+
+    def test_table_rebuilds_keep_search_triggers(self):
+        expected = {f'{table}_fts_{suffix}' for table in ('chat_message', 'post', 'course', 'library_material')
+                    for suffix in ('ai', 'ad', 'au')}
+        upgrade(directory=MIGRATIONS)
+        self.assertEqual(self.search_triggers(), expected)
+
+        # Rows written after the rebuilds still reach the index
+        db.session.execute(db.text("INSERT INTO post (id, user_id, content, privacy, post_status, is_boosted) "
+                                   "VALUES (1, 1, 'migrated kittens', 'public', 'published', 0)"))
+        db.session.commit()
+        self.assertEqual(db.session.execute(db.text(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'kittens'"
+        )).scalars().all(), [1])
+        db.session.execute(db.text("INSERT INTO chat_message (id, room_id, user_id, content, timestamp, is_pinned, is_edited) "
+                                   "VALUES (1, 1, 1, 'archived kittens', '2026-01-01', 0, 0)"))
+        db.session.commit()
+        self.assertEqual(db.session.execute(db.text(
+            "SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH 'kittens'"
+        )).scalars().all(), [1])
+
+    def test_timelines_are_backfilled(self):
+        upgrade(directory=MIGRATIONS, revision='d4a7b2c8e1f3')
+        for user_id in (1, 2, 3):
+            db.session.execute(db.text(
+                "INSERT INTO user (id, name, email, role, can_send_messages, can_make_calls, profile_pic, "
+                "privacy_last_seen, privacy_profile_pic, privacy_about, is_premium) "
+                "VALUES (:id, 'User', :email, 'student', 1, 1, 'default.jpg', 'everyone', 'everyone', 'everyone', 0)"
+            ), {'id': user_id, 'email': f'user{user_id}@test.com'})
+        db.session.execute(db.text("INSERT INTO follow (follower_id, followed_id) VALUES (1, 2), (3, 2), (2, 1)"))
+        for post_id, author_id, status in ((1, 2, 'published'), (2, 2, 'draft'), (3, 2, 'published'), (4, 3, 'published')):
+            db.session.execute(db.text(
+                "INSERT INTO post (id, user_id, content, privacy, post_status, is_boosted, timestamp) "
+                "VALUES (:id, :author_id, 'Post', 'public', :status, 0, :timestamp)"
+            ), {'id': post_id, 'author_id': author_id, 'status': status, 'timestamp': f'2026-01-0{post_id} 00:00:00'})
+        db.session.commit()
+
+        upgrade(directory=MIGRATIONS, revision='e5b9c3d1f7a2')
+        entries = db.session.execute(db.text(
+            'SELECT user_id, post_id, author_id FROM timeline_entry ORDER BY user_id, post_id'
+        )).all()
+        self.assertEqual([tuple(entry) for entry in entries], [(1, 1, 2), (1, 3, 2), (3, 1, 2), (3, 3, 2)])
+
+if __name__ == "__main__":
+    unittest.main()
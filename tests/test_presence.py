@@ -0,0 +1,101 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from presence import MemoryPresenceStore, SQLitePresenceStore
+
+class PresenceStoreTests:
+    """Shared checks run against every presence backend."""
+
+    def test_online_and_offline(self):
+        self.store.set_online(1, 'sid-a')
+        self.assertTrue(self.store.is_online(1))
+        self.assertEqual(self.store.get_sid(1), 'sid-a')
+
+        # A newer connection replaces the old one, and the old one's disconnect is ignored
+        self.store.set_online(1, 'sid-b')
+        self.assertFalse(self.store.set_offline(1, 'sid-a'))
+        self.assertTrue(self.store.is_online(1))
+
+        self.assertTrue(self.store.set_offline(1, 'sid-b'))
+        self.assertFalse(self.store.is_online(1))
+
+    def test_entries_expire_without_heartbeat(self):
+        self.store.ttl = 0.05
+        self.store.set_online(1, 'sid-a')
+        self.store.join_call('call-1', 1, 'sid-a')
+        time.sleep(0.1)
+        self.assertFalse(self.store.is_online(1))
+        self.assertEqual(self.store.join_call('call-1', 2, 'sid-b'), {})
+
+        self.store.heartbeat(1, 'sid-a')
+        self.assertTrue(self.store.is_online(1))
+
+    def test_group_call_membership(self):
+        self.assertEqual(self.store.join_call('call-1', 1, 'sid-a'), {})
+        self.assertEqual(self.store.join_call('call-1', 2, 'sid-b'), {1: 'sid-a'})
+        self.assertEqual(self.store.join_call('call-1', 3, 'sid-c'), {1: 'sid-a', 2: 'sid-b'})
+
+        self.assertEqual(self.store.leave_call('call-1', 2), {1: 'sid-a', 3: 'sid-c'})
+        self.assertIsNone(self.store.leave_call('call-1', 2))
+
+        self.assertEqual(self.store.leave_all_calls(1, 'sid-a'), {'call-1': {3: 'sid-c'}})
+        self.assertEqual(self.store.leave_call('call-1', 3), {})
+
+    def test_disconnect_only_leaves_calls_joined_from_that_connection(self):
+        self.store.join_call('call-1', 1, 'sid-a')
+        self.store.join_call('call-1', 2, 'sid-b')
+        # User 1 reconnects from another tab, then the old tab disconnects
+        self.store.set_online(1, 'sid-new')
+        self.assertFalse(self.store.set_offline(1, 'sid-a'))
+        self.assertEqual(self.store.leave_all_calls(1, 'sid-new'), {})
+        self.assertEqual(self.store.leave_all_calls(1, 'sid-a'), {'call-1': {2: 'sid-b'}})
+
+    def test_heartbeat_only_refreshes_own_call_entries(self):
+        self.store.ttl = 0.2
+        self.store.join_call('call-1', 1, 'sid-a')
+        self.store.join_call('call-2', 1, 'sid-b')
+        time.sleep(0.12)
+        self.store.heartbeat(1, 'sid-a')
+        time.sleep(0.12)
+        self.assertEqual(self.store.join_call('call-1', 2, 'sid-c'), {1: 'sid-a'})
+        self.assertEqual(self.store.join_call('call-2', 2, 'sid-c'), {})
+
+
+class MemoryPresenceStoreTests(PresenceStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryPresenceStore()
+
+    def test_heartbeat_sweeps_expired_entries(self):
+        self.store.ttl = 0.05
+        self.store.set_online(1, 'sid-a')
+        self.store.join_call('call-1', 1, 'sid-a')
+        time.sleep(0.1)
+        self.store.heartbeat(2, 'sid-b')
+        self.assertEqual(list(self.store._sids), [2])
+        self.assertEqual(self.store._calls, {})
+
+
+class SQLitePresenceStoreTests(PresenceStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SQLitePresenceStore(os.path.join(self.tmp_dir, 'presence.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_state_is_shared_between_instances(self):
+        other_worker = SQLitePresenceStore(self.store.path)
+        self.store.set_online(1, 'sid-a')
+        self.store.join_call('call-1', 1, 'sid-a')
+        self.assertEqual(other_worker.get_sid(1), 'sid-a')
+        self.assertEqual(other_worker.join_call('call-1', 2, 'sid-b'), {1: 'sid-a'})
+
+
+if __name__ == "__main__":
+    unittest.main()
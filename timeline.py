@@ -0,0 +1,123 @@
+from flask import current_app
+from sqlalchemy import and_, or_, func, literal, select
+from sqlalchemy.orm import joinedload
+from extensions import db
+from models import Post, TimelineEntry, User, follow
+from utils import decode_cursor
+
+TIMELINE_PAGE_SIZE = 20
+
+# Posts copied into a timeline when its owner starts following someone
+FOLLOW_BACKFILL_SIZE = 50
+
+def _fanout_limit():
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', 5000)
+
+def fan_out_post(post):
+    """
+    Copies a newly published post into the timeline of every follower of its author.
+    Authors with more than TIMELINE_FANOUT_LIMIT followers are skipped and flagged as
+    high-fanout; their posts are merged into followers' feeds when read instead.
+    Does not commit; call it in the transaction that publishes the post.
+    """
+    db.session.flush() # applies column defaults such as post_status and timestamp
+    if post.post_status != 'published':
+        return
+
+    author = db.session.get(User, post.user_id)
+    if author.high_fanout:
+        return
+    follower_count = db.session.query(func.count()).select_from(follow).filter(
+        follow.c.followed_id == post.user_id
+    ).scalar()
+    if follower_count > _fanout_limit():
+        # Sticky: earlier posts stay reachable through the read-time merge
+        author.high_fanout = True
+        return
+    if not follower_count:
+        return
+
+    db.session.execute(TimelineEntry.__table__.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'],
+        select(follow.c.follower_id, literal(post.id), literal(post.user_id), literal(post.timestamp)).where(
+            follow.c.followed_id == post.user_id
+        )
+    ))
+
+def backfill_author(follower_id, author_id, limit=FOLLOW_BACKFILL_SIZE):
+    """Copies an author's recent posts into a new follower's timeline. Does not commit."""
+    author = db.session.get(User, author_id)
+    if author is None or author.high_fanout:
+        return
+
+    already_there = db.session.query(TimelineEntry.post_id).filter(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.author_id == author_id
+    )
+    recent_posts = db.session.query(Post.id, Post.timestamp).filter(
+        Post.user_id == author_id,
+        Post.post_status == 'published',
+        Post.id.notin_(already_there)
+    ).order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit).all()
+    db.session.add_all([
+        TimelineEntry(user_id=follower_id, post_id=post_id, author_id=author_id, timestamp=timestamp)
+        for post_id, timestamp in recent_posts
+    ])
+
+def remove_author(follower_id, author_id):
+    """Takes an author's posts out of a timeline, e.g. after an unfollow or block. Does not commit."""
+    TimelineEntry.query.filter_by(user_id=follower_id, author_id=author_id).delete(synchronize_session=False)
+
+def rebuild_timeline(user_id):
+    """Rebuilds one user's timeline from the people they follow. Does not commit."""
+    TimelineEntry.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    followed_ids = [row[0] for row in db.session.query(follow.c.followed_id).filter(follow.c.follower_id == user_id)]
+    for author_id in followed_ids:
+        backfill_author(user_id, author_id)
+
+def _before(timestamp_column, id_column, cursor):
+    timestamp, row_id = cursor
+    return or_(timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < row_id))
+
+def get_timeline_page(user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+    """
+    Returns (posts, has_more) for one page of a user's home feed, newest first.
+
+    Reads the materialized timeline with a keyset query over (timestamp, post_id), then
+    merges in posts from any high-fanout authors the user follows. Either way the cost of a
+    page depends on the page size, not on how many people the user follows.
+    `before` is a cursor from encode_cursor(last post of the previous page).
+    """
+    cursor = decode_cursor(before) if before else None
+
+    query = db.session.query(TimelineEntry.post_id, TimelineEntry.timestamp).filter(TimelineEntry.user_id == user_id)
+    if cursor:
+        query = query.filter(_before(TimelineEntry.timestamp, TimelineEntry.post_id, cursor))
+    candidates = query.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).limit(limit + 1).all()
+
+    high_fanout_ids = db.session.query(User.id).join(follow, follow.c.followed_id == User.id).filter(
+        follow.c.follower_id == user_id,
+        User.high_fanout.is_(True)
+    )
+    merged = db.session.query(Post.id, Post.timestamp).filter(
+        Post.user_id.in_(high_fanout_ids),
+        Post.post_status == 'published'
+    )
+    if cursor:
+        merged = merged.filter(_before(Post.timestamp, Post.id, cursor))
+    candidates += merged.order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit + 1).all()
+
+    # A post can be in both lists if its author crossed the fan-out limit after publishing it
+    page_ids = []
+    for post_id, _ in sorted({tuple(row) for row in candidates}, key=lambda row: (row[1], row[0]), reverse=True):
+        if post_id not in page_ids:
+            page_ids.append(post_id)
+    has_more = len(page_ids) > limit
+    page_ids = page_ids[:limit]
+
+    posts = {post.id: post for post in Post.query.options(
+        joinedload(Post.author),
+        joinedload(Post.original_post).joinedload(Post.author),
+        joinedload(Post.link_preview)
+    ).filter(Post.id.in_(page_ids))} if page_ids else {}
+    return [posts[post_id] for post_id in page_ids if post_id in posts], has_more
@@ -0,0 +1,125 @@
+import threading
+import time
+from extensions import socketio
+
+class TypingTracker:
+    """
+    Server-side typing state of every chat room, sent as coalesced 'typing_update' events.
+
+    Clients report 'typing_start' and 'typing_stop'; the tracker keeps who is typing where, and
+    a typer lapses TYPING_TIMEOUT seconds after their last 'typing_start' unless they refresh it.
+    The first change to a room schedules a flush TYPING_UPDATE_INTERVAL_MS later, and every change
+    until then joins it, so each room receives at most one update per interval carrying the full
+    list of typers. Reports that change nothing (a refresh, or a stop from someone not typing)
+    are not sent at all. TYPING_UPDATE_INTERVAL_MS = 0 sends each change straight away.
+    """
+
+    def __init__(self, app=None):
+        self.interval = 1.0
+        self.timeout = 6.0
+        self.sent = 0
+        self.coalesced = 0
+        self._typing = {} # {room_id: {user_id: (user_name, expires_at)}}
+        self._pending = set() # rooms with a flush scheduled
+        self._expiring = set() # rooms with a task waiting for typers to lapse
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with self._lock:
+            self.interval = app.config.get('TYPING_UPDATE_INTERVAL_MS', 1000) / 1000
+            self.timeout = app.config.get('TYPING_TIMEOUT', 6)
+            self._typing.clear()
+            self._pending.clear()
+            self._expiring.clear()
+
+    def start(self, room_id, user_id, user_name, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            typers = self._typing.setdefault(room_id, {})
+            changed = user_id not in typers
+            typers[user_id] = (user_name, now + self.timeout)
+            if not changed:
+                self.coalesced += 1
+        if changed:
+            self._changed(room_id)
+
+    def stop(self, room_id, user_id):
+        with self._lock:
+            typers = self._typing.get(room_id, {})
+            changed = typers.pop(user_id, None) is not None
+            if not changed:
+                self.coalesced += 1
+        if changed:
+            self._changed(room_id)
+
+    def stop_everywhere(self, user_id):
+        """Clears a user from every room, e.g. when their connection closes."""
+        with self._lock:
+            room_ids = [room_id for room_id, typers in self._typing.items() if typers.pop(user_id, None)]
+        for room_id in room_ids:
+            self._changed(room_id)
+
+    def typing(self, room_id):
+        """[{'user_id', 'user_name'}] of the room's current typers."""
+        with self._lock:
+            return [{'user_id': user_id, 'user_name': name}
+                    for user_id, (name, _) in self._typing.get(room_id, {}).items()]
+
+    def _changed(self, room_id):
+        with self._lock:
+            if room_id in self._pending:
+                self.coalesced += 1
+                return
+            self._pending.add(room_id)
+        if self.interval <= 0:
+            self.flush(room_id)
+        else:
+            socketio.start_background_task(self._flush_later, room_id)
+
+    def _flush_later(self, room_id):
+        socketio.sleep(self.interval)
+        self.flush(room_id)
+
+    def expire(self, room_id, now=None):
+        """Drops the room's lapsed typers, scheduling an update if there were any."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            typers = self._typing.get(room_id, {})
+            lapsed = [user_id for user_id, (_, expires_at) in typers.items() if expires_at <= now]
+            for user_id in lapsed:
+                del typers[user_id]
+        if lapsed:
+            self._changed(room_id)
+        return len(lapsed)
+
+    def _expire_later(self, room_id):
+        while True:
+            with self._lock:
+                typers = self._typing.get(room_id)
+                if not typers:
+                    self._typing.pop(room_id, None)
+                    self._expiring.discard(room_id)
+                    return
+                delay = min(expires_at for _, expires_at in typers.values()) - time.monotonic()
+            socketio.sleep(max(delay, 0))
+            self.expire(room_id)
+
+    def flush(self, room_id):
+        """Emits the room's pending update, if there is one."""
+        with self._lock:
+            if room_id not in self._pending:
+                return
+            self._pending.discard(room_id)
+            users = [{'user_id': user_id, 'user_name': name}
+                     for user_id, (name, _) in self._typing.get(room_id, {}).items()]
+            watch = bool(users) and room_id not in self._expiring
+            if watch:
+                self._expiring.add(room_id)
+        socketio.emit('typing_update', {'room_id': room_id, 'users': users}, to=room_id)
+        self.sent += 1
+        if watch:
+            socketio.start_background_task(self._expire_later, room_id)
+
+typing_tracker = TypingTracker()
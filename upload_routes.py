@@ -0,0 +1,99 @@
+import os
+import re
+from flask import Blueprint, request, jsonify, abort
+from flask_login import login_required, current_user
+from werkzeug.utils import secure_filename
+from extensions import db
+from models import UploadSession
+from chunked_uploads import (PURPOSES, allowed_extensions, chunk_size, max_size, start_upload, write_chunk,
+                             advance, finish_upload)
+from storage import within_quota
+
+uploads_bp = Blueprint('uploads', __name__, url_prefix='/api/uploads')
+
+SHA256_PATTERN = re.compile(r'^[0-9a-fA-F]{64}$')
+
+def _upload_state(upload):
+    return {
+        'upload_id': upload.id,
+        'offset': upload.received,
+        'size': upload.total_size,
+        'chunk_size': chunk_size(),
+        'status': upload.status,
+        'path': upload.result_path,
+    }
+
+def _own_upload(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+@uploads_bp.route('', methods=['POST'])
+@login_required
+def initiate_upload():
+    """Starts a resumable upload: {filename, size, sha256, purpose} -> {upload_id, offset, chunk_size}."""
+    data = request.get_json(silent=True) or request.form
+    purpose = data.get('purpose')
+    filename = secure_filename(data.get('filename') or '')
+    checksum = data.get('sha256') or ''
+    try:
+        total_size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be the file size in bytes.'}), 400
+
+    if purpose not in PURPOSES:
+        return jsonify({'error': f"purpose must be one of: {', '.join(PURPOSES)}."}), 400
+    if not filename or not SHA256_PATTERN.match(checksum):
+        return jsonify({'error': 'filename and a hex SHA-256 of the file are required.'}), 400
+    extensions = allowed_extensions(purpose)
+    if extensions is not None and os.path.splitext(filename)[1].lower().lstrip('.') not in extensions:
+        return jsonify({'error': 'Invalid file type.'}), 400
+    if total_size <= 0 or total_size > max_size():
+        return jsonify({'error': f'File size must be between 1 byte and {max_size()} bytes.'}), 400
+    if purpose == 'post_media' and not within_quota(current_user, total_size):
+        return jsonify({'error': 'This file would take you over your storage quota.'}), 413
+
+    upload = start_upload(current_user.id, purpose, filename, total_size, checksum)
+    db.session.commit()
+    return jsonify(_upload_state(upload)), 201
+
+@uploads_bp.route('/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Where to resume: the offset of the first byte the server does not have yet."""
+    return jsonify(_upload_state(_own_upload(upload_id)))
+
+@uploads_bp.route('/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """Receives the raw bytes of one chunk, starting at ?offset=, streamed straight to disk."""
+    upload = _own_upload(upload_id)
+    if upload.status != 'uploading':
+        return jsonify({'error': 'Upload is already finished.', **_upload_state(upload)}), 409
+    offset = request.args.get('offset', type=int)
+    if offset != upload.received:
+        # Out of order, or the client lost track after a dropped connection; tell it where to resume
+        return jsonify({'error': 'Unexpected offset.', **_upload_state(upload)}), 409
+    if request.content_length is not None and request.content_length > chunk_size():
+        return jsonify({'error': f'Chunks may be at most {chunk_size()} bytes.'}), 413
+
+    written = write_chunk(upload, offset, request.stream)
+    if written is None:
+        return jsonify({'error': 'Chunk runs past the declared file size.'}), 400
+    if not advance(upload, offset, written):
+        return jsonify({'error': 'Unexpected offset.', **_upload_state(upload)}), 409
+    return jsonify(_upload_state(upload))
+
+@uploads_bp.route('/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Checks the SHA-256 and saves the file; forms then submit `upload_id` instead of the file."""
+    upload = _own_upload(upload_id)
+    if upload.status != 'uploading':
+        return jsonify(_upload_state(upload))
+    saved_path, error = finish_upload(upload)
+    db.session.commit()
+    if error:
+        return jsonify({'error': error, **_upload_state(upload)}), 422
+    return jsonify(_upload_state(upload))
@@ -1,8 +1,12 @@
 import os
+import base64
+from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
 from models import PlatformSetting, ChatRoom, ChatRoomMember, User
 from extensions import db
+from image_pipeline import image_pipeline
+from blob_store import store_upload
 from sqlalchemy import or_, and_
 from sqlalchemy.orm import aliased
 
@@ -17,21 +21,17 @@ def save_chat_file(file):
     if '.' not in original_filename or original_filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
         return None, None # Invalid file type
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(original_filename)
-    new_filename = random_hex + f_ext
-
-    filepath = os.path.join(current_app.root_path, 'static/chat_files', new_filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
     try:
-        file.save(filepath)
+        relative_path = store_upload(file, f_ext)
     except Exception as e:
         print(f"Error saving file: {e}")
         return None, None
 
     # Return the path relative to the static folder and the original filename
-    return os.path.join('chat_files', new_filename), original_filename
+    image_pipeline.enqueue(relative_path)
+    return relative_path, original_filename
 
 BANNED_WORDS = {'profanity', 'badword', 'censorthis'} # Example list
 
@@ -51,17 +51,11 @@ def save_chat_room_cover_image(file):
         return None
     file.seek(0) # Reset file pointer
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    upload_folder = os.path.join(current_app.root_path, 'static/chat_room_covers')
-    os.makedirs(upload_folder, exist_ok=True)
-
-    filepath = os.path.join(upload_folder, new_filename)
-    file.save(filepath)
+    relative_path = store_upload(file, f_ext)
 
-    return os.path.join('chat_room_covers', new_filename)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
 
 def save_editor_image(file):
@@ -91,7 +85,9 @@ def save_editor_image(file):
     file.save(filepath)
 
     from flask import url_for
-    url = url_for('static', filename=os.path.join('uploads/images', new_filename))
+    relative_path = os.path.join('uploads/images', new_filename)
+    image_pipeline.enqueue(relative_path)
+    url = url_for('static', filename=relative_path)
     return url, None
 
 def filter_profanity(text):
@@ -117,17 +113,11 @@ def save_status_file(file):
         return None
     file.seek(0)
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    upload_folder = os.path.join(current_app.root_path, 'static/status_files')
-    os.makedirs(upload_folder, exist_ok=True)
-
-    filepath = os.path.join(upload_folder, new_filename)
-    file.save(filepath)
+    relative_path = store_upload(file, f_ext)
 
-    return os.path.join('status_files', new_filename)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
 def get_or_create_platform_setting(key, default_value):
     """Gets a platform setting or creates it with a default value if it doesn't exist."""
@@ -211,19 +201,13 @@ def save_post_media(file):
         return None, None # File too large
     file.seek(0)
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    upload_folder = os.path.join(current_app.root_path, 'static/post_media')
-    os.makedirs(upload_folder, exist_ok=True)
+    relative_path = store_upload(file, f_ext)
 
-    filepath = os.path.join(upload_folder, new_filename)
-    file.save(filepath)
+    media_type = 'image' if f_ext.lower() in ['.png', '.jpg', '.jpeg', '.gif'] else 'video'
 
-    media_type = 'image' if f_ext.lower() in ['.png', 'jpg', 'jpeg', '.gif'] else 'video'
-
-    return os.path.join('post_media', new_filename), media_type
+    image_pipeline.enqueue(relative_path)
+    return relative_path, media_type
 
 def save_community_cover_image(file):
     """Saves a cover image for a community."""
@@ -241,28 +225,23 @@ def save_community_cover_image(file):
         return None
     file.seek(0) # Reset file pointer
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
-
-    upload_folder = os.path.join(current_app.root_path, 'static/community_covers')
-    os.makedirs(upload_folder, exist_ok=True)
+    relative_path = store_upload(file, f_ext)
 
-    filepath = os.path.join(upload_folder, new_filename)
-    file.save(filepath)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
-    return os.path.join('community_covers', new_filename)
+UPLOAD_FILE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm', 'ogg', 'pdf', 'doc', 'docx'}
 
-def save_upload_file(file, folder):
+def save_upload_file(file, folder, max_size=50 * 1024 * 1024):
     """
     A generic file saver for uploads.
-    Saves a file to a specified subfolder within 'static/uploads'.
+    Saves a file to the blob store. `folder` ('images', 'videos', ...) used to pick a subfolder
+    of 'static/uploads'; blobs are placed by content hash, so it is no longer used.
+    `max_size` defaults to 50MB; chunked uploads pass their own, larger limit.
     """
-    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm', 'ogg', 'pdf', 'doc', 'docx'}
-    max_size = 50 * 1024 * 1024 # 50MB
-
     filename = secure_filename(file.filename)
-    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in UPLOAD_FILE_EXTENSIONS:
         return None # Invalid file type
 
     file.seek(0, os.SEEK_END)
@@ -271,14 +250,21 @@ def save_upload_file(file, folder):
         return None # File too large
     file.seek(0)
 
-    random_hex = os.urandom(8).hex()
     _, f_ext = os.path.splitext(filename)
-    new_filename = random_hex + f_ext
+    relative_path = store_upload(file, f_ext)
+    image_pipeline.enqueue(relative_path)
+    return relative_path
 
-    upload_folder = os.path.join(current_app.root_path, 'static/uploads', folder)
-    os.makedirs(upload_folder, exist_ok=True)
+def encode_cursor(row):
+    """Turns a row's (timestamp, id) position into an opaque keyset pagination cursor."""
+    raw = f"{row.timestamp.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
 
-    filepath = os.path.join(upload_folder, new_filename)
-    file.save(filepath)
-
-    return os.path.join('uploads', folder, new_filename)
+def decode_cursor(token):
+    """Reverses encode_cursor. Raises ValueError for tokens it did not produce."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        timestamp, row_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e